@@ -0,0 +1,407 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""End-to-end load benchmark of COS Alerter.
+
+Starts the daemon with a generated config of N clients and sends heartbeats to /alive at a fixed
+rate over keep-alive connections. The notification services are replaced by local HTTP servers:
+an Apprise "json://" webhook and a PagerDuty Events API (through notify.pagerduty_events_url).
+
+A few clients stop sending heartbeats once the load starts, to measure the lag between the
+moment they are considered down and the moment their notifications are received.
+
+For each fleet size, reports the heartbeats per second, the /alive latency (measured from the
+time each request was due, so that a slow server is not hidden by a slow sender), the CPU and
+memory used by the daemon and the notification lag.
+
+Usage:
+    python benchmarks/load.py --clients 10 1000 100000 --rate 2000 --duration 30
+"""
+
+import argparse
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+KEY = "benchmark"
+KEY_HASH = hashlib.sha512(KEY.encode()).hexdigest()
+
+# Time for the daemon to notice that a client is down (it checks every second) and to notify.
+NOTIFICATION_GRACE = 10
+
+_CLIENT_IN_MESSAGE = re.compile(r"instance: (\S+) seems to be down")
+_CLIENT_IN_DEDUP_KEY = re.compile(r"^(client-\d+)-")
+
+
+def free_port() -> int:
+    """Return a TCP port that is not in use."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Return the q-th quantile of values (nearest rank)."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Sinks:
+    """Local stand-ins for the notification services.
+
+    Records the first time each client was notified through each service.
+    """
+
+    def __init__(self):
+        self.notified: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def destinations(self) -> List[str]:
+        """Return the COS Alerter destinations pointing to the sinks."""
+        port = self.server.server_address[1]
+        return [f"json://127.0.0.1:{port}/apprise", "pagerduty://benchmark@benchmark"]
+
+    def record(self, service: str, clientid: Optional[str]):
+        """Record that a client was notified."""
+        if clientid is None:
+            return
+        with self._lock:
+            self.notified.setdefault((service, clientid), time.monotonic())
+
+    def _handler(self):
+        sinks = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):  # noqa: N802
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/v2/enqueue":
+                    if body.get("event_action") == "trigger":
+                        match = _CLIENT_IN_DEDUP_KEY.match(body.get("dedup_key", ""))
+                        sinks.record("pagerduty", match and match.group(1))
+                    reply = {"status": "success", "dedup_key": body.get("dedup_key", "")}
+                    self._reply(202, reply)
+                else:
+                    match = _CLIENT_IN_MESSAGE.search(body.get("message", ""))
+                    sinks.record("apprise", match and match.group(1))
+                    self._reply(200, {})
+
+            def _reply(self, status: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        """Stop the servers."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ProcessStats:
+    """CPU and memory usage of a process, read from /proc (Linux only)."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    def cpu_seconds(self) -> Optional[float]:
+        """Return the user and system CPU time used so far."""
+        try:
+            stat = Path(f"/proc/{self.pid}/stat").read_text()
+        except OSError:
+            return None
+        # The fields after the command name, which may contain spaces, start with the state.
+        fields = stat.rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def status(self) -> Dict[str, int]:
+        """Return the resident memory (kB) and the number of threads."""
+        values = {}
+        try:
+            lines = Path(f"/proc/{self.pid}/status").read_text().splitlines()
+        except OSError:
+            return values
+        for line in lines:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM", "Threads"):
+                values[name] = int(value.split()[0])
+        return values
+
+
+def write_config(path: Path, clients: int, down_interval: float, port: int, sinks: Sinks):
+    """Write a config watching `clients` clients."""
+    data = {
+        "watch": {
+            "down_interval": f"{down_interval:.0f}s",
+            "wait_for_first_connection": True,
+            "clients": {
+                f"client-{i}": {"key": KEY_HASH, "name": f"Client {i}"} for i in range(clients)
+            },
+        },
+        "notify": {
+            "destinations": sinks.destinations(),
+            "repeat_interval": "1h",
+            "pagerduty_events_url": sinks.url,
+        },
+        "log_level": "warning",
+        "web_listen_addr": f"127.0.0.1:{port}",
+    }
+    # JSON is valid YAML.
+    path.write_text(json.dumps(data))
+
+
+def start_daemon(config_path: Path, state_dir: Path, port: int, timeout: float):
+    """Start COS Alerter and wait until it answers."""
+    env = dict(os.environ, XDG_STATE_HOME=str(state_dir))
+    log = (state_dir / "cos-alerter.log").open("w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "cos_alerter.daemon", "--config", str(config_path)],
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"COS Alerter exited, see {log.name}")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/api/v1/summary")
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            pass
+        time.sleep(0.5)
+    process.kill()
+    raise RuntimeError("COS Alerter did not start in time.")
+
+
+def stop_daemon(process: subprocess.Popen):
+    """Stop COS Alerter."""
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class Sender:
+    """Send heartbeats over a keep-alive connection."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.connection = None
+
+    def send(self, clientid: str) -> bool:
+        """Send a heartbeat and return whether it was accepted."""
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            self.connection.request("POST", f"/alive?clientid={clientid}&key={KEY}")
+            response = self.connection.getresponse()
+            response.read()
+            return response.status == 200
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return False
+
+
+def drive(port: int, clientids: List[str], rate: float, duration: float, workers: int):
+    """Send heartbeats at `rate` per second, cycling through the clients.
+
+    Returns:
+        The latencies of the requests, counted from when they were due, and the number of errors.
+    """
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    start = time.monotonic() + 0.1
+
+    def work(worker: int):
+        sender = Sender(port)
+        mine = clientids[worker::workers]
+        period = workers / rate
+        local_latencies = []
+        local_errors = 0
+        for n in range(int(duration * rate / workers)):
+            due = start + n * period
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not sender.send(mine[n % len(mine)]):
+                local_errors += 1
+            local_latencies.append(time.monotonic() - due)
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def run(clients: int, args) -> dict:
+    """Benchmark a fleet of `clients` clients."""
+    outages = min(args.outages, clients - 1)
+    # Each client must receive heartbeats well within the down interval.
+    down_interval = max(args.down_interval, 3 * (clients - outages) / args.rate)
+    duration = max(args.duration, down_interval + NOTIFICATION_GRACE)
+    workers = min(args.workers, clients - outages)
+    port = free_port()
+    sinks = Sinks()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        write_config(tmp / "cos-alerter.yaml", clients, down_interval, port, sinks)
+        process = start_daemon(tmp / "cos-alerter.yaml", tmp, port, args.startup_timeout)
+        try:
+            stats = ProcessStats(process.pid)
+            idle = stats.status()
+
+            # The clients of the outages send a single heartbeat, then go silent.
+            sender = Sender(port)
+            down_at = {}
+            for i in range(outages):
+                sender.send(f"client-{i}")
+                down_at[f"client-{i}"] = time.monotonic() + down_interval
+
+            cpu_start = stats.cpu_seconds()
+            start = time.monotonic()
+            clientids = [f"client-{i}" for i in range(outages, clients)]
+            latencies, errors = drive(port, clientids, args.rate, duration, workers)
+            elapsed = time.monotonic() - start
+            cpu_end = stats.cpu_seconds()
+            loaded = stats.status()
+        finally:
+            stop_daemon(process)
+            sinks.close()
+
+    lags = {
+        service: [
+            sinks.notified[(service, clientid)] - down
+            for clientid, down in down_at.items()
+            if (service, clientid) in sinks.notified
+        ]
+        for service in ("apprise", "pagerduty")
+    }
+    return {
+        "clients": clients,
+        "down_interval": down_interval,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "cpu_percent": (
+            100 * (cpu_end - cpu_start) / elapsed
+            if cpu_start is not None and cpu_end is not None
+            else None
+        ),
+        "idle_rss_kb": idle.get("VmRSS"),
+        "rss_kb": loaded.get("VmRSS"),
+        "peak_rss_kb": loaded.get("VmHWM"),
+        "threads": loaded.get("Threads"),
+        "outages": outages,
+        "notified": {service: len(values) for service, values in lags.items()},
+        "notification_lag_p50": percentile(lags["apprise"] + lags["pagerduty"], 0.5),
+        "notification_lag_max": max(lags["apprise"] + lags["pagerduty"], default=None),
+    }
+
+
+def _format(value, scale=1.0, digits=1) -> str:
+    return "-" if value is None else f"{value * scale:.{digits}f}"
+
+
+def print_result(result: dict):
+    """Print one line of results."""
+    print(
+        f"{result['clients']:>8} "
+        f"{_format(result['requests_per_second'], digits=0):>8} "
+        f"{_format(result['latency_p50'], 1000, 2):>8} "
+        f"{_format(result['latency_p99'], 1000, 2):>8} "
+        f"{result['errors']:>6} "
+        f"{_format(result['cpu_percent']):>6} "
+        f"{_format(result['rss_kb'], 1 / 1024):>8} "
+        f"{result['threads'] or '-':>7} "
+        f"{sum(result['notified'].values())}/{2 * result['outages']:<4} "
+        f"{_format(result['notification_lag_p50'], digits=2):>7} "
+        f"{_format(result['notification_lag_max'], digits=2):>7}",
+        flush=True,
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--clients",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 10000, 100000],
+        help="Fleet sizes to benchmark.",
+    )
+    parser.add_argument("--rate", type=float, default=1000, help="Heartbeats per second.")
+    parser.add_argument(
+        "--duration", type=float, default=30, help="Minimum duration of the load, in seconds."
+    )
+    parser.add_argument(
+        "--down-interval",
+        type=float,
+        default=10,
+        help="Minimum down interval, in seconds. Raised so that each client gets heartbeats.",
+    )
+    parser.add_argument("--outages", type=int, default=10, help="Clients that go down.")
+    parser.add_argument("--workers", type=int, default=8, help="Keep-alive connections.")
+    parser.add_argument(
+        "--startup-timeout", type=float, default=600, help="Time allowed to start the daemon."
+    )
+    parser.add_argument("--output", type=Path, help="Write the results to this JSON file.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Run the benchmark."""
+    args = parse_args(argv)
+    print(
+        " clients    req/s  p50(ms)  p99(ms) errors   cpu%  rss(MB) threads notified"
+        " lag p50 lag max"
+    )
+    results = []
+    for clients in args.clients:
+        result = run(clients, args)
+        print_result(result)
+        results.append(result)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
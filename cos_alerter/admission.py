@@ -0,0 +1,169 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Admission control of the heartbeats.
+
+When many Alertmanagers send heartbeats at once, for example when they reconnect after an
+outage, requests wait longer and longer before being handled and heartbeats arrive late. Rather
+than letting the queue grow, heartbeats are rejected right away with a "Retry-After" header when:
+
+- too many heartbeats are being handled (503),
+- the request already waited too long before reaching COS Alerter (503),
+- a heartbeat of the same client is already being handled (429).
+
+Heartbeats of clients that are close to their down deadline, or already down, are admitted
+beyond the normal limit and regardless of how long they waited, since rejecting them could cause
+a false notification. Only authenticated heartbeats can have priority or be rejected as
+duplicates, so that a request can not use the ID of another client to get ahead of the others or
+to get the heartbeats of that client rejected.
+
+Admission control requires the asyncio runtime. With the threads runtime, waitress queues the
+requests until one of its threads is free, so no more heartbeats than threads would ever be
+handled, and how long they waited would only be known from a proxy.
+"""
+
+import contextlib
+import random
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .alerter import config, state
+
+ADMISSION_REJECTED = Counter(
+    "cos_alerter_admission_rejected",
+    "Number of heartbeat requests rejected by admission control, by reason.",
+    ["reason"],
+    registry=None,
+)
+QUEUE_TIME = Histogram(
+    "cos_alerter_request_queue_seconds",
+    "Time heartbeat requests waited before being handled, when known.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+    registry=None,
+)
+IN_FLIGHT = Gauge(
+    "cos_alerter_heartbeats_in_flight",
+    "Number of heartbeats being handled, as counted by admission control.",
+    registry=None,
+)
+
+
+def parse_request_start(header: str) -> Optional[float]:
+    """Parse an X-Request-Start header, as set by proxies such as nginx or HAProxy.
+
+    Accepts "t=<timestamp>" or "<timestamp>" in seconds, milliseconds or microseconds.
+
+    Returns:
+        The unix timestamp, or None if the header is invalid.
+    """
+    header = header.strip()
+    if header.startswith("t="):
+        header = header[2:]
+    try:
+        timestamp = float(header)
+    except ValueError:
+        return None
+    # Tell the units apart by the magnitude: 1e11 seconds is in the year 5138.
+    if timestamp > 1e14:
+        return timestamp / 1e6
+    if timestamp > 1e11:
+        return timestamp / 1e3
+    return timestamp
+
+
+def queue_time(environ: Dict[str, Any]) -> Optional[float]:
+    """Return how long a request waited before being handled, if known.
+
+    The asyncio runtime records when it received the request. Otherwise a proxy in front of
+    COS Alerter can set the X-Request-Start header. This is measured with the real clocks.
+    """
+    received = environ.get("cos_alerter.request_start")
+    if received is not None:
+        return max(time.monotonic() - received, 0.0)
+    header = environ.get("HTTP_X_REQUEST_START")
+    if header is None:
+        return None
+    timestamp = parse_request_start(header)
+    if timestamp is None:
+        return None
+    return max(time.time() - timestamp, 0.0)
+
+
+def is_urgent(clientid: Optional[str], window: float) -> bool:
+    """Return whether a client is down or will be within `window` seconds.
+
+    The client state is read without taking the lock.
+    """
+    data = state["clients"].get(clientid)
+    if data is None or data["alert_time"] is None:
+        return False
+    deadline = max(data["alert_time"], state["start_time"]) + data["down_interval"]
+    return deadline - state["clock"].monotonic() < window
+
+
+def retry_after() -> int:
+    """Return a random delay before retrying, in seconds, so that rejected clients spread out."""
+    return random.randint(1, max(1, int(config["admission"]["max_retry_after"])))
+
+
+class AdmissionController:
+    """Count the heartbeats being handled and decide which ones to admit."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self._clients = set()
+
+    @contextlib.contextmanager
+    def admit(self, clientid: Optional[str], environ: Dict[str, Any]) -> Iterator[Optional[str]]:
+        """Admit a heartbeat for the duration of the context.
+
+        Args:
+            clientid: The client sending the heartbeat, if the request is authenticated.
+            environ: The WSGI environ of the request.
+
+        Yields:
+            None if the heartbeat is admitted, otherwise the reason for rejecting it:
+            "overloaded", "queue_time" or "duplicate".
+        """
+        reason, admitted = self._enter(clientid, environ)
+        if reason is not None:
+            ADMISSION_REJECTED.labels(reason=reason).inc()
+        try:
+            yield reason
+        finally:
+            if admitted:
+                with self._lock:
+                    self.in_flight -= 1
+                    self._clients.discard(clientid)
+
+    def _enter(self, clientid: Optional[str], environ: Dict[str, Any]):
+        """Return the reason for rejecting a heartbeat, and whether it is counted as in flight."""
+        settings = config["admission"]
+        if not settings["enabled"]:
+            return None, False
+        urgent = is_urgent(clientid, settings["priority_window"])
+        waited = queue_time(environ)
+        if waited is not None:
+            QUEUE_TIME.observe(waited)
+            if waited > settings["max_queue_time"] and not urgent:
+                return "queue_time", False
+        limit = settings["max_in_flight"] + (settings["priority_in_flight"] if urgent else 0)
+        with self._lock:
+            if clientid is not None and clientid in self._clients:
+                return "duplicate", False
+            # The asyncio runtime also counts the requests waiting for a thread. Neither count
+            # includes this request.
+            if max(self.in_flight, environ.get("cos_alerter.in_flight", 0)) >= limit:
+                return "overloaded", False
+            self.in_flight += 1
+            if clientid is not None:
+                self._clients.add(clientid)
+        return None, True
+
+
+controller = AdmissionController()
+IN_FLIGHT.set_function(lambda: controller.in_flight)
@@ -0,0 +1,425 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Single process runtime built on asyncio.
+
+With "runtime: asyncio", one event loop serves HTTP, checks the clients and sends the
+notifications, instead of waitress threads, one thread per client and one thread per notification:
+
+- A minimal HTTP/1.1 server parses the requests on the event loop and calls the WSGI apps in a
+  fixed pool of threads, so idle or slow connections do not hold a thread.
+- The clients are checked when their next deadline is reached rather than every second, by a
+  single thread so that the event loop never waits for the lock of a client or for the disk.
+- Notifications are sent as tasks, by a fixed pool of threads.
+
+The number of threads does not depend on the number of clients or connections.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import heapq
+import io
+import logging
+import sys
+import time
+import urllib.parse
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import handoff
+from .alerter import CHECK_INTERVAL, AlerterState, config, send_all_notifications, state, up_time
+from .metrics import CHECK_ERRORS, CHECK_LAG
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+# Seconds an idle connection is kept open.
+KEEPALIVE_TIMEOUT = 30
+
+REASONS = {400: "Bad Request", 413: "Content Too Large", 431: "Request Header Fields Too Large"}
+
+
+class BadRequestError(Exception):
+    """The request can not be parsed."""
+
+    def __init__(self, status: int = 400):
+        super().__init__(REASONS[status])
+        self.status = status
+
+
+def parse_head(head: bytes) -> Tuple[str, str, str, List[Tuple[str, str]]]:
+    """Parse the request line and headers of an HTTP request.
+
+    Returns:
+        The method, target, HTTP version and headers (with lower case names).
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise BadRequestError()
+    if not version.startswith("HTTP/1."):
+        raise BadRequestError()
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(":")
+        if not separator or not name or name != name.strip():
+            raise BadRequestError()
+        headers.append((name.lower(), value.strip()))
+    return method, target, version, headers
+
+
+def make_environ(
+    method: str,
+    target: str,
+    version: str,
+    headers: List[Tuple[str, str]],
+    body: bytes,
+    server: Tuple[str, int],
+    peer,
+) -> Dict[str, object]:
+    """Return the WSGI environ of a request."""
+    path, _, query = target.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": urllib.parse.unquote(path, "latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": version,
+        "REMOTE_ADDR": peer[0] if isinstance(peer, tuple) else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in headers:
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        elif "_" not in name:
+            # Headers with underscores are dropped, as they could be confused with dashes.
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_app(app, environ: Dict[str, object]):
+    """Call a WSGI app. Runs in a thread of the pool.
+
+    Returns:
+        The status, the headers, the first chunk of the body (or None), an iterator over the
+        other chunks and the iterable returned by the app, which must be closed.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response.get("sent"):
+            raise exc_info[1].with_traceback(exc_info[2])
+        response["status"] = status
+        response["headers"] = headers
+
+    result = app(environ, start_response)
+    iterator = iter(result)
+    # Apps may only call start_response when the first chunk is read.
+    first = next(iterator, None)
+    response["sent"] = True
+    return response["status"], response["headers"], first, iterator, result
+
+
+class HTTPServer:
+    """Serve a WSGI app over HTTP/1.1 from the event loop."""
+
+    def __init__(self, app, executor: concurrent.futures.Executor):
+        self.app = app
+        self.executor = executor
+        # Requests being handled or waiting for a thread, for admission control.
+        self.in_flight = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve the requests of a connection until it is closed."""
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader, writer) -> bool:
+        """Serve a request. Returns whether the connection can be reused."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+            received = time.monotonic()
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return False  # The client closed the connection.
+        except asyncio.LimitOverrunError:
+            await self._error(writer, 431)
+            return False
+        try:
+            method, target, version, headers = parse_head(head)
+            body = await self._read_body(reader, headers)
+        except BadRequestError as e:
+            await self._error(writer, e.status)
+            return False
+        environ = make_environ(
+            method,
+            target,
+            version,
+            headers,
+            body,
+            writer.get_extra_info("sockname"),
+            writer.get_extra_info("peername"),
+        )
+        environ["cos_alerter.request_start"] = received
+        connection = dict(headers).get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        return await self._respond(writer, environ, version, keep_alive)
+
+    async def _read_body(self, reader, headers) -> bytes:
+        names = dict(headers)
+        if "transfer-encoding" in names:
+            raise BadRequestError()  # Not needed by the clients of COS Alerter.
+        try:
+            length = int(names.get("content-length", "0"))
+        except ValueError:
+            raise BadRequestError()
+        if length < 0:
+            raise BadRequestError()
+        if length > MAX_BODY_SIZE:
+            raise BadRequestError(413)
+        return await reader.readexactly(length)
+
+    async def _error(self, writer, status: int):
+        message = REASONS[status].encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: {len(message)}\r\n"
+            "Content-Type: text/plain\r\nConnection: close\r\n\r\n".encode("latin-1") + message
+        )
+        await writer.drain()
+
+    async def _respond(self, writer, environ, version: str, keep_alive: bool) -> bool:
+        loop = asyncio.get_running_loop()
+        # The app runs in several threads of the pool, always with the same context variables, such
+        # as those of the Flask request context while a response is streamed.
+        context = contextvars.copy_context()
+        # The other requests being handled when this one was queued.
+        environ["cos_alerter.in_flight"] = self.in_flight
+        self.in_flight += 1
+        try:
+            status, headers, first, iterator, result = await loop.run_in_executor(
+                self.executor, lambda: context.run(call_app, self.app, environ)
+            )
+        except Exception:
+            logger.exception(
+                "Error while handling %s %s.", environ["REQUEST_METHOD"], environ["PATH_INFO"]
+            )
+            writer.write(
+                b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+            await writer.drain()
+            return False
+        finally:
+            self.in_flight -= 1
+        try:
+            names = {name.lower() for name, _ in headers}
+            chunked = "content-length" not in names and version == "HTTP/1.1"
+            keep_alive = keep_alive and (chunked or "content-length" in names)
+            head = [f"{version} {status}"] + [f"{name}: {value}" for name, value in headers]
+            if chunked:
+                head.append("Transfer-Encoding: chunked")
+            head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            if environ["REQUEST_METHOD"] != "HEAD":
+                await self._write_body(writer, context, first, iterator, chunked)
+            await writer.drain()
+        finally:
+            if hasattr(result, "close"):
+                await loop.run_in_executor(self.executor, context.run, result.close)
+        return keep_alive
+
+    async def _write_body(
+        self,
+        writer,
+        context: contextvars.Context,
+        first: Optional[bytes],
+        iterator: Iterator[bytes],
+        chunked: bool,
+    ):
+        """Write the chunks of the body, reading them from the app in the pool."""
+        loop = asyncio.get_running_loop()
+        chunk = first
+        while chunk is not None:
+            if chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+            chunk = await loop.run_in_executor(
+                self.executor, lambda: context.run(next, iterator, None)
+            )
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+
+
+class Checker:
+    """Check the clients when their deadlines are reached.
+
+    Deadlines come from AlerterState.next_deadline(). A client whose status changed for another
+    reason than a check (e.g. a heartbeat or a silence) is checked on the next tick. Every client is
+    also checked at least every max_check_lag / 2 seconds, so that /ready can tell a stalled
+    checker from idle clients.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines: Dict[str, float] = {}
+        self._cursor = 0
+        now = state["clock"].monotonic()
+        for clientid in state["clients"]:
+            self._schedule(clientid, now)
+
+    def _schedule(self, clientid: str, deadline: float):
+        """Check a client at `deadline`, unless it is already due earlier."""
+        if self._deadlines.get(clientid, float("inf")) <= deadline:
+            return
+        self._deadlines[clientid] = deadline
+        heapq.heappush(self._heap, (deadline, clientid))
+
+    def tick(self):
+        """Check the clients that are due."""
+        now = state["clock"].monotonic()
+        state["timers"].run_pending(now)
+        self._cursor, changed = state["index"].changed_since(self._cursor)
+        for clientid in changed:
+            self._schedule(clientid, now)
+        while self._heap and self._heap[0][0] <= now:
+            deadline, clientid = heapq.heappop(self._heap)
+            if self._deadlines.get(clientid) != deadline:
+                continue  # Replaced by an earlier deadline.
+            del self._deadlines[clientid]
+            self._check(clientid, deadline, now)
+
+    def _check(self, clientid: str, due: float, now: float):
+        with AlerterState(clientid) as client_state:
+            client_state.data["last_evaluated"] = now
+            client_state.data["check_lag"] = now - due
+            CHECK_LAG.observe(now - due)
+            try:
+                client_state.check()
+            except Exception:
+                logger.exception("Error while checking %s.", clientid)
+                CHECK_ERRORS.inc()
+            deadline = client_state.next_deadline()
+        latest = now + max(config["max_check_lag"] / 2, CHECK_INTERVAL)
+        if deadline is None:
+            deadline = latest
+        # A deadline in the past means that the client must be checked again, but not right away.
+        self._schedule(clientid, min(max(deadline, now + CHECK_INTERVAL), latest))
+
+    async def run(self, executor: concurrent.futures.Executor):
+        """Check the clients every CHECK_INTERVAL, forever.
+
+        The checks run in `executor`, which must have a single thread. They take the locks of the
+        clients, which heartbeats may hold while resolving PagerDuty incidents, and expiring
+        silences writes the state to the disk.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(executor, self.tick)
+            except Exception:  # pragma: no cover
+                logger.exception("Error while checking the clients.")
+            await asyncio.sleep(CHECK_INTERVAL)
+
+
+class NotificationDispatcher:
+    """Send notifications as tasks of the event loop, by a fixed pool of threads.
+
+    It can be called from any thread, as state["dispatch"].
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, executor: concurrent.futures.Executor):
+        self._loop = loop
+        self._executor = executor
+        self.tasks = set()
+
+    def __call__(self, **kwargs):
+        """Send the notifications described by the arguments of send_all_notifications()."""
+        self._loop.call_soon_threadsafe(self._start, kwargs)
+
+    def _start(self, kwargs):
+        task = self._loop.create_task(self._send(kwargs))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, kwargs):
+        try:
+            await self._loop.run_in_executor(
+                self._executor, functools.partial(send_all_notifications, **kwargs)
+            )
+        except Exception:
+            logger.exception("Error while sending the notifications for %s.", kwargs["dedup_key"])
+
+
+async def serve(servers: List[Tuple[object, str, str]], run_for: Optional[int] = None):
+    """Serve the WSGI apps on their addresses and check the clients.
+
+    Args:
+        servers: The WSGI apps with the names of their sockets and the "HOST:PORT" addresses to
+            serve them on. See handoff.listen_socket().
+        run_for: If set, only run for "run_for" seconds after the start of COS Alerter.
+    """
+    loop = asyncio.get_running_loop()
+    # The event streams of the dashboard hold on to their threads, so they get their own.
+    http_executor = concurrent.futures.ThreadPoolExecutor(
+        config["http_threads"] + config["max_event_streams"], thread_name_prefix="http"
+    )
+    notification_executor = concurrent.futures.ThreadPoolExecutor(
+        config["notification_threads"], thread_name_prefix="notify"
+    )
+    check_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="check")
+    state["dispatch"] = NotificationDispatcher(loop, notification_executor)
+    http_servers = []
+    for app, name, listen_addr in servers:
+        http_servers.append(
+            await asyncio.start_server(
+                HTTPServer(app, http_executor).handle,
+                sock=handoff.listen_socket(name, listen_addr),
+                limit=MAX_HEADER_SIZE,
+            )
+        )
+        logger.info("Serving HTTP on %s", listen_addr)
+
+    def stop_accepting():
+        """Stop accepting connections, the new process accepts them."""
+        for server in http_servers:
+            server.close()
+
+    handoff.on_handed_off(functools.partial(loop.call_soon_threadsafe, stop_accepting))
+    checker = asyncio.create_task(Checker().run(check_executor))
+    try:
+        while (run_for is None or up_time() < run_for) and not handoff.finished():
+            await asyncio.sleep(1)
+    finally:
+        checker.cancel()
+        for server in http_servers:
+            server.close()
+        # The calls still queued in the executors are cancelled with their tasks by asyncio.run().
+        for executor in (http_executor, notification_executor, check_executor):
+            executor.shutdown(wait=False)
+
+
+def run(servers: List[Tuple[object, str, str]], run_for: Optional[int] = None):
+    """Run the asyncio runtime until "run_for" seconds after the start, or forever."""
+    asyncio.run(serve(servers, run_for))
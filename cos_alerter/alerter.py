@@ -22,8 +22,18 @@ from pdpyras import EventsAPISession
 from ruamel.yaml import YAML
 from ruamel.yaml.constructor import DuplicateKeyError
 
+from .clock import Clock
+from .contention import call_site, sample_uncontended
+from .index import LabelIndex, StatusIndex
+from .scheduler import Scheduler
+from .silences import SilenceStore
+from .stats import HeartbeatStats
+
 logger = logging.getLogger(__name__)
 
+# Seconds between two checks of a client by client_loop().
+CHECK_INTERVAL = 1
+
 
 class Config:
     """Representation of the config file."""
@@ -45,6 +55,92 @@ class Config:
                 return False
         return True
 
+    def _resolve_intervals(self) -> Dict[str, Dict[str, float]]:
+        """Resolve the interval overrides into a table of intervals (in seconds) per client.
+
+        A value set on the client takes precedence over the value set on its group, which takes
+        precedence over the global value.
+        """
+        groups = self.data["watch"]["groups"] or {}
+        intervals = {}
+        for clientid, client_info in self.data["watch"]["clients"].items():
+            group_name = client_info.get("group")
+            if group_name is not None and group_name not in groups:
+                logger.critical("Unknown group %s for client %s. Exiting...", group_name, clientid)
+                sys.exit(1)
+            group = groups.get(group_name) or {}
+            client_intervals = {
+                "down_interval": self.data["watch"]["down_interval"],
+                "repeat_interval": self.data["notify"]["repeat_interval"],
+            }
+            for key in client_intervals:
+                value = client_info.get(key, group.get(key))
+                if value is not None:
+                    client_intervals[key] = durationpy.from_str(value).total_seconds()
+            # The adaptive down interval never exceeds the configured one unless told so.
+            client_intervals["max_down_interval"] = (
+                self.data["watch"]["adaptive_down_interval"]["max"]
+                or client_intervals["down_interval"]
+            )
+            intervals[clientid] = client_intervals
+        return intervals
+
+    def _parse_durations(self):
+        """Convert the durations of the config to seconds."""
+        self.data["watch"]["down_interval"] = durationpy.from_str(
+            self.data["watch"]["down_interval"]
+        ).total_seconds()
+        self.data["watch"]["coalesce_window"] = durationpy.from_str(
+            self.data["watch"]["coalesce_window"]
+        ).total_seconds()
+        self.data["notify"]["repeat_interval"] = durationpy.from_str(
+            self.data["notify"]["repeat_interval"]
+        ).total_seconds()
+        for key in ("profile_duration", "max_check_lag"):
+            self.data[key] = durationpy.from_str(self.data[key]).total_seconds()
+        replication = self.data["replication"]
+        replication["interval"] = durationpy.from_str(replication["interval"]).total_seconds()
+        leadership = self.data["leadership"]
+        leadership["lease_duration"] = durationpy.from_str(
+            leadership["lease_duration"]
+        ).total_seconds()
+        admission = self.data["admission"]
+        for key in ("priority_window", "max_queue_time", "max_retry_after"):
+            admission[key] = durationpy.from_str(admission[key]).total_seconds()
+        adaptive = self.data["watch"]["adaptive_down_interval"]
+        adaptive["min"] = durationpy.from_str(adaptive["min"]).total_seconds()
+        if adaptive["max"] is not None:
+            adaptive["max"] = durationpy.from_str(adaptive["max"]).total_seconds()
+
+    def _validate_options(self):
+        """Exit if the optional settings are invalid or inconsistent."""
+        if self.data["runtime"] not in ("threads", "asyncio"):
+            logger.critical('runtime must be "threads" or "asyncio". Exiting...')
+            sys.exit(1)
+        # Waitress queues the requests out of sight of admission control, see admission.py.
+        if self.data["admission"]["enabled"] and self.data["runtime"] != "asyncio":
+            logger.critical("admission requires the asyncio runtime. Exiting...")
+            sys.exit(1)
+        if self.data["api_workers"] > 0 and not self.data["dashboard_listen_addr"]:
+            logger.critical("api_workers requires dashboard_listen_addr. Exiting...")
+            sys.exit(1)
+        replication = self.data["replication"]
+        if replication["peers"] and not replication["peer_key"]:
+            logger.critical("Replication peers require replication.peer_key. Exiting...")
+            sys.exit(1)
+        if replication["key"] is not None and len(replication["key"]) != 128:
+            logger.critical("Invalid SHA-512 hash for replication.key in config. Exiting...")
+            sys.exit(1)
+        # The API workers could not apply the heartbeats of the peers to the clients.
+        if replication["key"] and self.data["api_workers"] > 0:
+            logger.critical("Replication is not supported with api_workers. Exiting...")
+            sys.exit(1)
+
+        admin_key = self.data["admin_key"]
+        if admin_key is not None and len(admin_key) != 128:
+            logger.critical("Invalid SHA-512 hash for admin_key in config. Exiting...")
+            sys.exit(1)
+
     def reload(self):
         """Reload config values from the disk."""
         yaml = YAML(typ="rt")
@@ -73,19 +169,28 @@ class Config:
                 sys.exit(1)
 
         deep_update(self.data, user_data)
-        self.data["watch"]["down_interval"] = durationpy.from_str(
-            self.data["watch"]["down_interval"]
-        ).total_seconds()
-        self.data["notify"]["repeat_interval"] = durationpy.from_str(
-            self.data["notify"]["repeat_interval"]
-        ).total_seconds()
-
-        # if dashboard address key is missing, set it to None
-        dashboard_addr = None
-        try:
-            dashboard_addr = self.data["dashboard_listen_addr"]
-        except KeyError:
-            self.data["dashboard_listen_addr"] = dashboard_addr
+        self._parse_durations()
+        self.data["intervals"] = self._resolve_intervals()
+
+        # if an optional key (commented out in the defaults) is missing, set it to None
+        for key in (
+            "dashboard_listen_addr",
+            "metrics_listen_addr",
+            "datagram_listen_addr",
+            "admin_key",
+        ):
+            if key not in self.data:
+                self.data[key] = None
+
+        self._validate_options()
+
+        # Inverted index of the client labels, used to select clients for bulk operations.
+        self.data["label_index"] = LabelIndex(
+            {
+                clientid: client_info.get("labels") or {}
+                for clientid, client_info in self.data["watch"]["clients"].items()
+            }
+        )
 
         # Static variables. We define them here so it is easy to expose them later as config
         # values if needed.
@@ -93,6 +198,7 @@ class Config:
         if not base_dir.exists():
             base_dir.mkdir(parents=True)
         self.data["clients_file"] = base_dir / "clients.state"
+        self.data["silences_file"] = base_dir / "silences.json"
         self.data["base_dir"] = base_dir
 
 
@@ -132,10 +238,23 @@ class AlerterState:
     def __enter__(self):
         """Enter method for the context manager.
 
-        Acquires an exclusive lock on the backend file and loads it in to memory.
+        Acquires an exclusive lock on the backend file and loads it in to memory. The time spent
+        waiting for the lock is recorded for the calling function, see contention.py.
         """
         logger.debug("Acquiring lock for %s.", self.clientid)
-        self.data["lock"].acquire()
+        lock = self.data["lock"]
+        if lock.acquire(blocking=False):
+            # Did not wait. Only recorded once in a while, to keep the common case cheap.
+            self._site = call_site(sys._getframe(1)) if sample_uncontended() else None
+            if self._site is not None:
+                self._site.wait.observe(0.0)
+                self._acquired = time.perf_counter()
+            return self
+        self._site = call_site(sys._getframe(1))
+        start = time.perf_counter()
+        lock.acquire()
+        self._acquired = time.perf_counter()
+        self._site.wait.observe(self._acquired - start)
         return self
 
     def __exit__(self, _, __, ___):
@@ -144,20 +263,36 @@ class AlerterState:
         Dumps the new state to disk then releases the lock.
         """
         logger.debug("Releasing lock for %s.", self.clientid)
+        if self._site is not None:
+            self._site.hold.observe(time.perf_counter() - self._acquired)
         self.data["lock"].release()
 
     @staticmethod
-    def initialize():
+    def initialize(
+        clock: Optional[Clock] = None,
+        dispatcher: Optional[typing.Callable[..., None]] = None,
+        snapshot: Optional[dict] = None,
+    ):
         """Initialize the global state object.
 
         Note: This method does not do any locking so do not call it when there might be other
         threads running.
+
+        Args:
+            clock: The source of time. Defaults to the real clock.
+            dispatcher: Called with the arguments of send_all_notifications() to send the
+                notifications. Defaults to sending them in a new thread.
+            snapshot: The state handed off by the previous process, see pause_for_handoff().
+                Takes the place of the state dumped on disk.
         """
         logger.info("Initializing COS Alerter.")
-        current_date = datetime.datetime.now(datetime.timezone.utc)
-        current_time = time.monotonic()
+        state["clock"] = clock or Clock()
+        state["dispatch"] = dispatcher or dispatch_in_thread
+        current_date = state["clock"].now()
+        current_time = state["clock"].monotonic()
         state["start_date"] = datetime.datetime.timestamp(current_date)
         state["start_time"] = current_time
+        state["handed_off"] = False
 
         # state["clients"] should be of the form:
         # {
@@ -165,7 +300,13 @@ class AlerterState:
         #         "lock": <client_lock>,
         #         "alert_time": <alert_time>,
         #         "notify_time": <notify_time>,
-        #         "silenced_until": <optional_utc_timestamp>
+        #         "silenced_until": <optional_utc_timestamp>,
+        #         "silence_deadline": <optional_monotonic_time_at_which_the_silence_expires>,
+        #         "heartbeats": <HeartbeatStats>,
+        #         "down_interval": <seconds_without_alert_before_down>,
+        #         "repeat_interval": <seconds_between_notifications>,
+        #         "last_evaluated": <monotonic_time_of_the_last_check_by_client_loop>,
+        #         "check_lag": <seconds_the_last_check_ran_after_it_was_due>
         #     },
         #     ...
         # }
@@ -177,10 +318,18 @@ class AlerterState:
                 "alert_time": alert_time,
                 "notify_time": None,
                 "silenced_until": None,
+                "silence_deadline": None,
+                "heartbeats": HeartbeatStats(),
+                "down_interval": config["intervals"][client_id]["down_interval"],
+                "repeat_interval": config["intervals"][client_id]["repeat_interval"],
+                "last_evaluated": None,
+                "check_lag": None,
             }
 
+        if snapshot is not None:
+            AlerterState._restore_snapshot(snapshot)
         # Recover any state that was dumped on last exit.
-        if config["clients_file"].exists():
+        elif config["clients_file"].exists():
             with config["clients_file"].open() as f:
                 existing_clients = json.load(f)
             config["clients_file"].unlink()
@@ -191,28 +340,24 @@ class AlerterState:
                         "notify_time"
                     ]
 
-        for client_id, client_state in state["clients"].items():
-            client_state["silenced_until"] = AlerterState._load_silenced_until(client_id)
-
-    @staticmethod
-    def _load_silenced_until(client_id: str) -> Optional[datetime.datetime]:
-        data_path: Path = config["base_dir"] / f"{client_id}.silenced"
-        if not data_path.exists():
-            return None
-        with data_path.open() as f:
-            silenced_until = json.load(f)
-        if silenced_until is None:
-            return None
-        return datetime.datetime.fromisoformat(silenced_until)
-
-    @staticmethod
-    def _save_silenced_until(client_id: str, silenced_until: Optional[datetime.datetime]):
-        data_path: Path = config["base_dir"] / f"{client_id}.silenced"
-        silence_value = None
-        if silenced_until is not None:
-            silence_value = silenced_until.isoformat()
-        with data_path.open("w") as f:
-            json.dump(silence_value, f)
+        # Silences expire through timers rather than being compared to the current time on every
+        # check. The timers are run by the daemon, see Scheduler.start().
+        state["timers"] = Scheduler(AlerterState.expire_silences, state["clock"])
+        state["silences"] = SilenceStore(config["silences_file"])
+        silences = state["silences"].load(state["clients"])
+        for client_id, silenced_until in silences.items():
+            AlerterState(client_id)._set_silence_deadline(silenced_until)
+
+        # state["index"] holds the clients grouped by status so that the dashboard can filter
+        # them without evaluating every client. It is kept up to date by refresh_status().
+        state["index"] = StatusIndex(
+            {
+                client_id: client_info.get("name", "")
+                for client_id, client_info in config["watch"]["clients"].items()
+            }
+        )
+        for client_id in state["clients"]:
+            AlerterState(client_id).refresh_status()
 
     # This is difficult to test in unit tests because it acquires and does not release all of the
     # locks. When integration tests have been solved we need to remove the "no cover" from this
@@ -238,6 +383,53 @@ class AlerterState:
         with config["clients_file"].open("w") as f:
             json.dump(clients_without_locks, f)
 
+    @staticmethod
+    def pause_for_handoff() -> dict:
+        """Stop applying heartbeats and sending notifications, and return the state to hand off.
+
+        The monotonic times of the snapshot remain valid in another process on the same host.
+        The start time is handed off too, so that the new process does not give the clients
+        another down interval. Silences are read from disk by the new process.
+        """
+        for client in state["clients"]:
+            state["clients"][client]["lock"].acquire()
+        try:
+            state["handed_off"] = True
+            return {
+                "start_date": state["start_date"],
+                "start_time": state["start_time"],
+                "clients": {
+                    client: {
+                        key: state["clients"][client][key]
+                        for key in ("alert_time", "notify_time", "heartbeats")
+                    }
+                    for client in state["clients"]
+                },
+            }
+        finally:
+            for client in state["clients"]:
+                state["clients"][client]["lock"].release()
+
+    @staticmethod
+    def resume_after_handoff():
+        """Apply heartbeats and send notifications again after a failed handoff."""
+        state["handed_off"] = False
+
+    @staticmethod
+    def _restore_snapshot(snapshot: dict):
+        """Restore the state handed off by the previous process.
+
+        The adaptive down intervals are derived again from the heartbeat statistics, with the
+        settings of the new config.
+        """
+        state["start_date"] = snapshot["start_date"]
+        state["start_time"] = snapshot["start_time"]
+        for client, data in snapshot["clients"].items():
+            if client in state["clients"]:
+                state["clients"][client].update(data)
+                if config["watch"]["adaptive_down_interval"]["enabled"]:
+                    AlerterState(client)._adapt_down_interval()
+
     @staticmethod
     def clients():
         """Return a list of clientids."""
@@ -246,8 +438,53 @@ class AlerterState:
 
     def silence_until(self, utc_datatime: Optional[datetime.datetime]):
         """Silence notifications until a given point in time."""
+        self._set_silenced_until(utc_datatime)
+        state["silences"].update({self.clientid: utc_datatime})
+
+    def _set_silenced_until(self, utc_datatime: Optional[datetime.datetime]):
+        """Silence notifications in memory only."""
+        self._set_silence_deadline(utc_datatime)
+        state["index"].mark_changed(self.clientid)
+        self.refresh_status()
+
+    def _set_silence_deadline(self, utc_datatime: Optional[datetime.datetime]):
+        """Convert the end of the silence to a monotonic deadline and set a timer for it."""
         self.data["silenced_until"] = utc_datatime
-        AlerterState._save_silenced_until(self.clientid, utc_datatime)
+        if utc_datatime is None:
+            self.data["silence_deadline"] = None
+            state["timers"].cancel(self.clientid)
+            return
+        remaining = utc_datatime - state["clock"].now()
+        self.data["silence_deadline"] = state["clock"].monotonic() + remaining.total_seconds()
+        state["timers"].schedule(self.clientid, self.data["silence_deadline"])
+
+    @staticmethod
+    def expire_silences(clientids: List[str]):
+        """Timer handler ending the silences of clients.
+
+        Clears the silences, saves them in a single write and checks the clients right away.
+        """
+        now = state["clock"].monotonic()
+        expired = []
+        for clientid in clientids:
+            with AlerterState(clientid) as client_state:
+                deadline = client_state.data["silence_deadline"]
+                if deadline is None or deadline > now:
+                    continue  # The silence was changed in the meantime.
+                logger.info("Silence of %s expired.", clientid)
+                client_state._set_silenced_until(None)
+                expired.append(clientid)
+                client_state.check()
+        if expired:
+            state["silences"].update(dict.fromkeys(expired))
+
+    @staticmethod
+    def silence_clients(clientids: List[str], utc_datatime: Optional[datetime.datetime]):
+        """Silence notifications for several clients, saving the silences in a single write."""
+        for clientid in clientids:
+            with AlerterState(clientid) as client_state:
+                client_state._set_silenced_until(utc_datatime)
+        state["silences"].update(dict.fromkeys(clientids, utc_datatime))
 
     def get_silenced_until(self) -> Optional[datetime.datetime]:
         """Return the end of silencing in effect."""
@@ -262,20 +499,53 @@ class AlerterState:
 
     def is_silenced(self) -> bool:
         """Return if there is silencing in effect."""
-        silenced_until = self.get_silenced_until()
-        now = datetime.datetime.now(datetime.timezone.utc)
-        if silenced_until is None:
-            return False
-        return now < silenced_until
+        deadline = self.data["silence_deadline"]
+        return deadline is not None and state["clock"].monotonic() < deadline
 
-    def reset_alert_timeout(self):
-        """Set the "last alert time" to right now."""
+    def reset_alert_timeout(self, arrival: Optional[float] = None):
+        """Set the "last alert time" to right now, or to the monotonic time `arrival`."""
         # In case an instance was down, resolve the PagerDuty incident before resetting the last alert time
         if self.is_down():
             self.resolve_existing_alerts()
-        self.silence_until(None)
+        if self.data["silenced_until"] is not None:
+            self.silence_until(None)
         logger.debug("Resetting alert timeout for %s.", self.clientid)
-        self.data["alert_time"] = time.monotonic()
+        now = state["clock"].monotonic() if arrival is None else arrival
+        self.data["alert_time"] = now
+        self.data["heartbeats"].record(now)
+        if config["watch"]["adaptive_down_interval"]["enabled"]:
+            self._adapt_down_interval()
+        # The time of the last heartbeat changed even if the status did not.
+        state["index"].mark_changed(self.clientid)
+        self.refresh_status()
+
+    def _adapt_down_interval(self):
+        """Derive the down interval from the observed time between heartbeats."""
+        adaptive = config["watch"]["adaptive_down_interval"]
+        heartbeats = self.data["heartbeats"]
+        # At least two heartbeats are needed to have a gap.
+        if heartbeats.count < max(adaptive["min_heartbeats"], 2):
+            return
+        down_interval = heartbeats.sketch.quantile(0.99) * adaptive["factor"]
+        max_down_interval = config["intervals"][self.clientid]["max_down_interval"]
+        self.data["down_interval"] = min(max(down_interval, adaptive["min"]), max_down_interval)
+
+    def heartbeat_stats(self) -> dict:
+        """Return statistics about the gaps between the heartbeats of this client."""
+        stats = self.data["heartbeats"].summary()
+        stats["down_interval"] = self.data["down_interval"]
+        return stats
+
+    def check(self):
+        """Update the status of the client and send notifications if needed.
+
+        The lock must be held.
+        """
+        logger.debug("Checking Alertmanager status.")
+        self.refresh_status()
+        if self.should_act():
+            logger.debug("Alertmanager is down and not silenced.")
+            self.notify()
 
     def should_act(self) -> bool:
         """We should act if and only if the instance is down but not silenced."""
@@ -287,7 +557,8 @@ class AlerterState:
 
     def _set_notify_time(self):
         """Set the "last notification time" to right now."""
-        self.data["notify_time"] = time.monotonic()
+        self.data["notify_time"] = state["clock"].monotonic()
+        self.refresh_status()
 
     def is_down(self) -> bool:
         """Determine if Alertmanager should be considered down based on the last alert."""
@@ -296,16 +567,51 @@ class AlerterState:
         # We need to take the max of the alert and the start time, so that we only count time when
         # cos-alerter was running.
         return (
-            time.monotonic() - max(self.data["alert_time"], self.start_time)
-            > config["watch"]["down_interval"]
+            state["clock"].monotonic() - max(self.data["alert_time"], self.start_time)
+            > self.data["down_interval"]
+        )
+
+    def next_deadline(self) -> Optional[float]:
+        """Return the monotonic time after which the outcome of check() may change.
+
+        Returns None if it can only change when a heartbeat is received. A deadline in the past
+        means that the client should be checked right away.
+        """
+        if self.data["alert_time"] is None:
+            return None
+        if not self.is_down():
+            return max(self.data["alert_time"], self.start_time) + self.data["down_interval"]
+        if self.data["notify_time"] is None:
+            deadline = state["clock"].monotonic()
+        else:
+            deadline = self.data["notify_time"] + self.data["repeat_interval"]
+        if self.is_silenced():
+            # Nothing is sent before the silence ends.
+            deadline = max(deadline, self.data["silence_deadline"])
+        return deadline
+
+    def status(self) -> str:
+        """Return the status of the client: "up", "down" or "unknown".
+
+        A client which never sent a heartbeat is down, as for the notifications, once it was
+        expected to send one (when wait_for_first_connection is false). Until then it is unknown.
+        """
+        if self.is_down():
+            return "down"
+        return "unknown" if self.last_alert_datetime() is None else "up"
+
+    def refresh_status(self):
+        """Update the status index with the current status of this client."""
+        state["index"].update(
+            self.clientid, self.status(), self.is_silenced(), bool(self._recently_notified())
         )
 
     def _recently_notified(self) -> bool:
         """Determine if a notification has been previously sent within the repeat interval."""
         return (
             state["clients"][self.clientid]["notify_time"]
-            and not time.monotonic() - self.data["notify_time"]
-            > config["notify"]["repeat_interval"]
+            and not state["clock"].monotonic() - self.data["notify_time"]
+            > self.data["repeat_interval"]
         )
 
     def last_alert_datetime(self) -> typing.Optional[datetime.datetime]:
@@ -319,6 +625,13 @@ class AlerterState:
         actual_alert_timestamp = (self.data["alert_time"] - self.start_time) + self.start_date
         return datetime.datetime.fromtimestamp(actual_alert_timestamp, datetime.timezone.utc)
 
+    def last_notify_datetime(self) -> typing.Optional[datetime.datetime]:
+        """Return the actual time the last notification was sent, if any."""
+        if self.data["notify_time"] is None:
+            return None
+        actual_notify_timestamp = (self.data["notify_time"] - self.start_time) + self.start_date
+        return datetime.datetime.fromtimestamp(actual_notify_timestamp, datetime.timezone.utc)
+
     def notify(self):
         """Send out notifications of the missing Alertmanager if necessary."""
         # If we have already notified recently, do nothing.
@@ -326,6 +639,12 @@ class AlerterState:
             logger.debug("Recently notified. Skipping.")
             return
 
+        if not is_leader():
+            # The leader sends it. notify_time is left unset so that this instance sends it if it
+            # takes over while the client is still down.
+            logger.debug("Not the leader. Skipping notifications for %s.", self.clientid)
+            return
+
         logger.info("Sending notifications for %s.", self.clientid)
         self._set_notify_time()
         last_alert_datetime = self.last_alert_datetime()
@@ -340,22 +659,18 @@ class AlerterState:
             It has not alerted COS-Alerter {last_alert_string}.
             """)
 
-        # Sending notifications can be a long operation so handle that in a separate thread.
-        # This avoids interfering with the execution of the main loop.
-        notify_thread = threading.Thread(
-            target=send_all_notifications,
-            kwargs={
-                "title": title,
-                "body": body,
-                "destinations": split_destinations(config["notify"]["destinations"]),
-                "incident_type": "trigger",
-                "dedup_key": f"{self.clientid}-{self.last_alert_datetime()}",
-            },
+        state["dispatch"](
+            title=title,
+            body=body,
+            destinations=split_destinations(config["notify"]["destinations"]),
+            incident_type="trigger",
+            dedup_key=f"{self.clientid}-{self.last_alert_datetime()}",
         )
-        notify_thread.start()
 
     def resolve_existing_alerts(self):
         """Resolves the current alerts."""
+        if not is_leader():
+            return
         categorized_destinations = split_destinations(config["notify"]["destinations"])
         handle_pagerduty_incidents(
             incident_type="resolve",
@@ -364,15 +679,96 @@ class AlerterState:
         )
 
 
+def coalesce_heartbeat(clientid: str, arrival: float) -> bool:
+    """Apply a repeat heartbeat without taking the lock of the client, if possible.
+
+    This is possible when the last heartbeat applied under the lock was received less than
+    "coalesce_window" ago, so that the client is up, and when the client is not silenced: only the
+    time of the last heartbeat changes. The heartbeat statistics are not updated. The first
+    heartbeat of a client is always applied under the lock, and so is the first one after each
+    window, so that the statistics of a client sending heartbeats steadily keep advancing.
+
+    A client silenced while its heartbeat is coalesced stays silenced, as if the heartbeat was
+    received first.
+
+    Returns:
+        Whether the heartbeat was applied. Otherwise it must be applied under the lock.
+    """
+    data = state["clients"][clientid]
+    last_applied = data["heartbeats"].last_arrival()
+    if data["alert_time"] is None or last_applied is None:
+        return False
+    window = min(config["watch"]["coalesce_window"], data["down_interval"])
+    if not 0 <= arrival - last_applied < window:
+        return False
+    if data["silenced_until"] is not None or state["handed_off"]:
+        return False
+    # A single assignment, atomic for the readers holding the lock.
+    data["alert_time"] = arrival
+    # pause_for_handoff() may have taken the snapshot before the assignment. The heartbeat is then
+    # refused under the lock, so that the client sends it again to the new process.
+    if state["handed_off"]:
+        return False
+    state["index"].mark_changed(clientid)
+    return True
+
+
+def is_leader() -> bool:
+    """Return whether this instance sends the notifications.
+
+    Always true unless a leader lease is configured, and false once the state was handed off to
+    a new process.
+    """
+    if state.get("handed_off"):
+        return False
+    lease = state.get("lease")
+    return lease is None or lease.is_leader()
+
+
+def dispatch_in_thread(**kwargs):
+    """Send notifications in a separate thread.
+
+    Sending notifications can be a long operation so handle that in a separate thread. This
+    avoids interfering with the execution of the main loop.
+    """
+    notify_thread = threading.Thread(
+        target=send_all_notifications, kwargs=kwargs, name=f"notify:{kwargs['dedup_key']}"
+    )
+    notify_thread.start()
+
+
 def now_datetime():
     """Return the current datetime using the monotonic clock."""
-    now_timestamp = (time.monotonic() - state["start_time"]) + state["start_date"]
+    now_timestamp = (state["clock"].monotonic() - state["start_time"]) + state["start_date"]
     return datetime.datetime.fromtimestamp(now_timestamp, datetime.timezone.utc)
 
 
 def up_time():
     """Return number of seconds that the daemon has been running."""
-    return time.monotonic() - state["start_time"]
+    return state["clock"].monotonic() - state["start_time"]
+
+
+def checker_health() -> Dict[str, typing.Any]:
+    """Return how well the clients are being checked.
+
+    The client states are read without taking the locks.
+
+    Returns:
+        A dict with "max_lag", the largest delay of the last check of a client behind the time it
+        was due, and "stalled", the clients that were not checked for longer than max_check_lag.
+    """
+    now = state["clock"].monotonic()
+    threshold = config["max_check_lag"] + CHECK_INTERVAL
+    max_lag = 0.0
+    stalled = []
+    for clientid, data in state["clients"].items():
+        lag = data["check_lag"]
+        if lag is not None and lag > max_lag:
+            max_lag = lag
+        last_evaluated = data["last_evaluated"]
+        if now - (state["start_time"] if last_evaluated is None else last_evaluated) > threshold:
+            stalled.append(clientid)
+    return {"max_lag": max_lag, "stalled": stalled}
 
 
 def split_destinations(destinations: List[str]) -> Dict[str, List[str]]:
@@ -430,6 +826,7 @@ def handle_pagerduty_incidents(
     for source in destinations:
         integration_key = source.split("//")[1].split("@")[0]
         session = EventsAPISession(integration_key)
+        session.url = config["notify"]["pagerduty_events_url"]
 
         if incident_type == "trigger":
             session.trigger(source="cos-alerter", summary=incident_summary, dedup_key=dedup_key)
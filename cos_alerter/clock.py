@@ -0,0 +1,61 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Sources of time.
+
+All the time readings of COS Alerter go through a clock, which allows replacing real time with
+virtual time to simulate long periods deterministically.
+"""
+
+import datetime
+import time
+
+
+class Clock:
+    """The real clock."""
+
+    def monotonic(self) -> float:
+        """Return the value of a monotonic clock, in seconds."""
+        return time.monotonic()
+
+    def now(self) -> datetime.datetime:
+        """Return the current UTC date and time."""
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def sleep(self, seconds: float):
+        """Wait for some time."""
+        time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """A clock that only moves when told to.
+
+    Sleeping advances the clock instantly, so it is only suitable for single threaded use.
+    """
+
+    def __init__(self, start: datetime.datetime, monotonic_start: float = 1000.0):
+        self._start = start
+        self._monotonic_start = monotonic_start
+        self._monotonic = monotonic_start
+
+    def monotonic(self) -> float:
+        """Return the virtual monotonic time."""
+        return self._monotonic
+
+    def now(self) -> datetime.datetime:
+        """Return the virtual date and time."""
+        return self._start + datetime.timedelta(seconds=self._monotonic - self._monotonic_start)
+
+    def sleep(self, seconds: float):
+        """Advance the clock by `seconds`."""
+        self.advance(seconds)
+
+    def advance(self, seconds: float):
+        """Advance the clock by `seconds`."""
+        self._monotonic += seconds
+
+    def set(self, monotonic: float):
+        """Move the clock forward to a monotonic time."""
+        if monotonic < self._monotonic:
+            raise ValueError("A monotonic clock can not go backwards.")
+        self._monotonic = monotonic
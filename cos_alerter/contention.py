@@ -0,0 +1,81 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Measurement of the contention on the locks of the clients.
+
+The time spent waiting for a client lock and the time it is then held are recorded per call
+site, that is per function entering the AlerterState context manager (e.g. "server.alive" or
+"daemon.client_loop").
+
+To keep the overhead low on the hot paths, only the acquisitions that had to wait are always
+recorded. One in SAMPLE_EVERY of the acquisitions that did not wait is recorded, with a wait of
+zero, so the counts of the histograms are not the number of acquisitions.
+"""
+
+import itertools
+from pathlib import Path
+from typing import Dict
+
+from prometheus_client import Histogram
+
+SAMPLE_EVERY = 64
+
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+LOCK_WAIT = Histogram(
+    "cos_alerter_lock_wait_seconds",
+    "Time spent waiting to acquire the lock of a client, by call site.",
+    ["site"],
+    buckets=BUCKETS,
+    registry=None,
+)
+LOCK_HOLD = Histogram(
+    "cos_alerter_lock_hold_seconds",
+    "Time the lock of a client was held, by call site.",
+    ["site"],
+    buckets=BUCKETS,
+    registry=None,
+)
+
+
+class CallSite:
+    """The histograms of a call site, with the label values bound once."""
+
+    __slots__ = ("wait", "hold")
+
+    def __init__(self, name: str):
+        self.wait = LOCK_WAIT.labels(site=name)
+        self.hold = LOCK_HOLD.labels(site=name)
+
+
+# Call sites by code object. There is a fixed number of them.
+_sites: Dict[object, CallSite] = {}
+_uncontended = itertools.count()
+
+
+def sample_uncontended() -> bool:
+    """Return whether to record an acquisition which did not wait."""
+    return next(_uncontended) % SAMPLE_EVERY == 0
+
+
+def call_site(frame) -> CallSite:
+    """Return the call site of the function running in `frame`."""
+    code = frame.f_code
+    site = _sites.get(code)
+    if site is None:
+        site = _sites.setdefault(code, CallSite(f"{Path(code.co_filename).stem}.{code.co_name}"))
+    return site
+
+
+def summary() -> Dict[str, Dict[str, float]]:
+    """Return the number of acquisitions and the total wait and hold times of each call site."""
+    sites = {}
+    for histogram, kind in ((LOCK_WAIT, "wait"), (LOCK_HOLD, "hold")):
+        for metric in histogram.collect():
+            for sample in metric.samples:
+                site = sites.setdefault(sample.labels["site"], {})
+                if sample.name.endswith("_count"):
+                    site["count"] = sample.value
+                elif sample.name.endswith("_sum"):
+                    site[f"{kind}_seconds"] = sample.value
+    return sites
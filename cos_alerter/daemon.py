@@ -5,18 +5,34 @@
 """Daemon process for COS Alerter."""
 
 import argparse
+import atexit
+import functools
 import logging
 import signal
 import sys
 import threading
 import time
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
-import waitress
+from prometheus_client import make_wsgi_app
+from waitress.server import create_server
 
-from .alerter import AlerterState, config, send_test_notification, up_time
+from . import aio, datagram, handoff
+from .alerter import (
+    CHECK_INTERVAL,
+    AlerterState,
+    config,
+    send_test_notification,
+    state,
+    up_time,
+)
+from .leadership import Lease
 from .logging import LEVELS, init_logging
-from .server import create_app
+from .metrics import CHECK_ERRORS, CHECK_LAG, METRICS_REGISTRY, register_collectors
+from .profiling import profiler
+from .replication import Replicator
+from .server import create_app, server_threads
+from .workers import HeartbeatTable, ingest_loop, start_workers, stop_workers
 
 logger = logging.getLogger("cos_alerter.daemon")
 
@@ -35,6 +51,15 @@ def sigterm(_, __):  # pragma: no cover
     sys.exit()
 
 
+def sighup(_, __):  # pragma: no cover
+    """Signal handler for SIGHUP which hands off to a new process, see handoff.py."""
+    logger.info("Received SIGHUP.")
+    handoff_thread = threading.Thread(
+        target=handoff.hand_off, args=(handoff.command_line(),), name="handoff", daemon=True
+    )
+    handoff_thread.start()
+
+
 def sigusr1(_, __):  # pragma: no cover
     """Signal handler for SIGUSR1 which sends a test notification."""
     logger.info("Received SIGUSR1.")
@@ -42,6 +67,12 @@ def sigusr1(_, __):  # pragma: no cover
     send_thread.start()
 
 
+def sigusr2(_, __):  # pragma: no cover
+    """Signal handler for SIGUSR2 which starts or stops a profile."""
+    logger.info("Received SIGUSR2.")
+    profiler.toggle(config["base_dir"], config["profile_duration"])
+
+
 def parse_args(args: List[str]) -> argparse.Namespace:
     """Parse the command line arguments."""
     parser = argparse.ArgumentParser()
@@ -60,16 +91,165 @@ def parse_args(args: List[str]) -> argparse.Namespace:
 
 
 def client_loop(clientid):
-    """Run the main loop for the specified client."""
+    """Run the main loop for the specified client.
+
+    Records when the client was last checked and how late the check ran compared to when it was
+    due. A failing check is logged and counted, and does not stop the loop.
+    """
     # Main loop
-    state = AlerterState(clientid=clientid)
+    client_state = AlerterState(clientid=clientid)
+    clock = state["clock"]
+    due = clock.monotonic()
     while True:
-        with state:
-            logger.debug("Checking Alertmanager status.")
-            if state.should_act():
-                logger.debug("Alertmanager is down and not silenced.")
-                state.notify()
-        time.sleep(1)
+        with client_state:
+            now = clock.monotonic()
+            client_state.data["last_evaluated"] = now
+            client_state.data["check_lag"] = now - due
+            CHECK_LAG.observe(now - due)
+            try:
+                client_state.check()
+            except Exception:
+                logger.exception("Error while checking %s.", clientid)
+                CHECK_ERRORS.inc()
+        due = clock.monotonic() + CHECK_INTERVAL
+        clock.sleep(CHECK_INTERVAL)
+
+
+def start_server_thread(app, name: str, listen_addr: str):
+    """Serve a WSGI app with waitress in a daemon thread.
+
+    The socket is inherited from the previous process if any, see handoff.py.
+    clear_untrusted_proxy_headers is set to suppress a DeprecationWarning.
+    """
+    sock = handoff.listen_socket(name, listen_addr)
+    server = create_server(
+        app, sockets=[sock], threads=server_threads(app), clear_untrusted_proxy_headers=True
+    )
+    handoff.on_handed_off(functools.partial(stop_accepting, server))
+    server.print_listen("Serving on http://{}:{}")
+    server_thread = threading.Thread(target=server.run)
+    server_thread.daemon = True
+    server_thread.start()
+
+
+def stop_accepting(server):
+    """Stop accepting connections on a waitress server, the new process accepts them."""
+    server.accepting = False
+    server.pull_trigger()
+
+
+def start_api_workers(workers: int, listen_addr: str):
+    """Fork the API worker processes and apply the heartbeats they receive.
+
+    The workers are forked before any other thread is started, since forking a process with
+    running threads could leave locks held forever in the workers.
+    """
+    # The app is created before forking so that the workers do not all do it.
+    api_app = create_app(include_api=True, include_dashboard=False, include_metrics=False)
+    table = HeartbeatTable(config["watch"]["clients"], workers)
+    pids = start_workers(api_app, table, workers, listen_addr)
+    atexit.register(stop_workers, pids)
+    ingest_thread = threading.Thread(
+        target=ingest_loop, args=(table,), name="heartbeat-ingest", daemon=True
+    )
+    ingest_thread.start()
+
+
+def create_servers() -> List[Tuple[object, str, str]]:
+    """Create the WSGI apps to serve and return them with the names and addresses of the sockets.
+
+    If dashboard_listen_addr exists, the API and the dashboard are served on their own addresses.
+    With API workers, the API is served by the workers, which are started right away.
+    """
+    dashboard_listen_addr = config["dashboard_listen_addr"]
+    metrics_listen_addr = config["metrics_listen_addr"]
+    web_listen_addr = config["web_listen_addr"]
+    include_metrics = not metrics_listen_addr
+    servers = []
+
+    if dashboard_listen_addr:
+        logger.info(
+            "Starting API server on %s, dashboard on %s",
+            config["web_listen_addr"],
+            dashboard_listen_addr,
+        )
+
+        # API server
+        if config["api_workers"] > 0:
+            start_api_workers(config["api_workers"], web_listen_addr)
+        else:
+            api_app = create_app(
+                include_api=True, include_dashboard=False, include_metrics=include_metrics
+            )
+            servers.append((api_app, "web", web_listen_addr))
+
+        # Dashboard server
+        dashboard_app = create_app(
+            include_api=False, include_dashboard=True, include_metrics=include_metrics
+        )
+        servers.append((dashboard_app, "dashboard", dashboard_listen_addr))
+
+    else:
+        logger.info("Starting API server and dashboard on %s", config["web_listen_addr"])
+        app = create_app(include_api=True, include_dashboard=True, include_metrics=include_metrics)
+        servers.append((app, "web", web_listen_addr))
+
+    if metrics_listen_addr:
+        logger.info("Starting metrics server on %s", metrics_listen_addr)
+        register_collectors(METRICS_REGISTRY)
+        servers.append((make_wsgi_app(METRICS_REGISTRY), "metrics", metrics_listen_addr))
+    return servers
+
+
+def start_datagram_listener():
+    """Receive heartbeat datagrams, if configured, in the background."""
+    address = config["datagram_listen_addr"]
+    if not address:
+        return
+    try:
+        sock = handoff.listen_socket("datagram", address, datagram.bind)
+    except (ValueError, OSError) as e:
+        logger.critical("Can not listen for heartbeat datagrams on %s: %s. Exiting...", address, e)
+        sys.exit(1)
+    logger.info("Receiving heartbeat datagrams on %s", address)
+    datagram_thread = threading.Thread(
+        target=datagram.serve, args=(sock,), name="datagram", daemon=True
+    )
+    datagram_thread.start()
+
+
+def start_replication():
+    """Send the heartbeats to the peers, if any, in the background."""
+    replication = config["replication"]
+    if not replication["peers"]:
+        return
+    logger.info("Replicating heartbeats with %s", ", ".join(replication["peers"]))
+    replicator = Replicator(replication["peers"], replication["peer_key"])
+    state["replicator"] = replicator
+    replication_thread = threading.Thread(
+        target=replicator.run, args=(replication["interval"],), name="replication"
+    )
+    replication_thread.daemon = True
+    replication_thread.start()
+
+
+def start_lease():
+    """Take the leader lease, if configured, before checking the clients and keep renewing it."""
+    leadership = config["leadership"]
+    if not leadership["lease_file"]:
+        return
+    lease = Lease(
+        leadership["lease_file"], leadership["lease_duration"], leadership["instance_id"]
+    )
+    state["lease"] = lease
+    try:
+        lease.renew()
+    except OSError:
+        logger.exception("Failed to take the lease %s.", lease.path)
+    logger.info("Lease %s held by this instance: %s", lease.path, lease.is_leader())
+    atexit.register(lease.release)
+    lease_thread = threading.Thread(target=lease.run, name="lease", daemon=True)
+    lease_thread.start()
 
 
 def main(run_for: Optional[int] = None, argv: List[str] = sys.argv):
@@ -84,13 +264,16 @@ def main(run_for: Optional[int] = None, argv: List[str] = sys.argv):
     config.set_path(args.config)
     config.reload()
     init_logging(args)
-    AlerterState.initialize()
+    handoff.load_inherited()
+    AlerterState.initialize(snapshot=handoff.receive_state())
 
     # Observe signal handlers
     try:  # pragma: no cover
         signal.signal(signal.SIGINT, sigint)
         signal.signal(signal.SIGTERM, sigterm)
+        signal.signal(signal.SIGHUP, sighup)
         signal.signal(signal.SIGUSR1, sigusr1)
+        signal.signal(signal.SIGUSR2, sigusr2)
         logger.debug("Signal handlers set.")
     except ValueError as e:
         # If we are not in the main thread, we can not start the signal handlers.
@@ -98,70 +281,34 @@ def main(run_for: Optional[int] = None, argv: List[str] = sys.argv):
         if not str(e) == "signal only works in main thread of the main interpreter":
             raise  # pragma: no cover
 
+    servers = create_servers()
+    start_datagram_listener()
+    start_replication()
+    start_lease()
+    handoff.confirm()
+
+    if config["runtime"] == "asyncio":
+        aio.run(servers, run_for)
+        return
+
     # Start the web server(s).
     # Starting in a thread rather than a new process allows waitress to inherit the log level
     # from the daemon. It also facilitates communication over memory rather than files.
-    # clear_untrusted_proxy_headers is set to suppress a DeprecationWarning.
-    # If dashboard_lister_addr exists, serve api and dashboard in their own respective addresses
-
-    dashboard_listen_addr = config["dashboard_listen_addr"]
-    web_listen_addr = config["web_listen_addr"]
-
-    if dashboard_listen_addr:
-        logger.info(
-            "Starting API server on %s, dashboard on %s",
-            config["web_listen_addr"],
-            dashboard_listen_addr,
-        )
-
-        # API server
-        api_app = create_app(include_api=True, include_dashboard=False)
-        api_server_thread = threading.Thread(
-            target=waitress.serve,
-            args=(api_app,),
-            kwargs={
-                "clear_untrusted_proxy_headers": True,
-                "listen": web_listen_addr,
-            },
-        )
-        api_server_thread.daemon = True
-        api_server_thread.start()
+    for app, name, listen_addr in servers:
+        start_server_thread(app, name, listen_addr)
 
-        # Dashboard server
-        dashboard_app = create_app(include_api=False, include_dashboard=True)
-        dashboard_server_thread = threading.Thread(
-            target=waitress.serve,
-            args=(dashboard_app,),
-            kwargs={
-                "clear_untrusted_proxy_headers": True,
-                "listen": dashboard_listen_addr,
-            },
-        )
-        dashboard_server_thread.daemon = True
-        dashboard_server_thread.start()
-
-    else:
-        logger.info("Starting API server and dashboard on %s", config["web_listen_addr"])
-        app = create_app(include_api=True, include_dashboard=True)
-        server_thread = threading.Thread(
-            target=waitress.serve,
-            args=(app,),
-            kwargs={
-                "clear_untrusted_proxy_headers": True,
-                "listen": web_listen_addr,
-            },
-        )
-        server_thread.daemon = True
-        server_thread.start()
+    state["timers"].start()
 
     for clientid in config["watch"]["clients"]:
-        client_thread = threading.Thread(target=client_loop, args=(clientid,))
+        client_thread = threading.Thread(
+            target=client_loop, args=(clientid,), name=f"client_loop:{clientid}"
+        )
         client_thread.daemon = True  # Makes this thread exit when the main thread exits.
         logger.info("Starting worker thread for client: %s", clientid)
         client_thread.start()
 
     while True:
-        if run_for is not None and up_time() >= run_for:
+        if (run_for is not None and up_time() >= run_for) or handoff.finished():
             return
         time.sleep(1)
 
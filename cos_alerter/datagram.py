@@ -0,0 +1,105 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+r"""Heartbeats received as datagrams, over UDP or a Unix socket.
+
+A heartbeat packet holds the client ID and the key, separated by a newline and encoded as UTF-8:
+
+    printf 'clientid\nkey' | socat - UDP:127.0.0.1:8090
+
+Packets are authenticated with the same keys as /alive and have the same effect. They are not
+answered: the sender finds out about invalid packets from the logs and the heartbeat metrics of
+COS Alerter. A single thread receives all the packets, without any HTTP parsing.
+"""
+
+import logging
+import os
+import socket
+import stat
+from typing import Tuple, Union
+
+from . import handoff
+from .alerter import config
+from .metrics import HEARTBEAT_RESULTS
+from .server import _is_key_correct, apply_heartbeat
+
+logger = logging.getLogger(__name__)
+
+# Heartbeat packets are much smaller than this. Longer packets are truncated and rejected.
+MAX_PACKET_SIZE = 1024
+
+
+def parse_address(address: str) -> Tuple[socket.AddressFamily, Union[str, Tuple[str, int]]]:
+    """Parse a "udp://HOST:PORT" or "unix:///PATH" address.
+
+    Returns:
+        The address family and the address to bind: a path for AF_UNIX, otherwise a host and a
+        port.
+    """
+    scheme, _, location = address.partition("://")
+    if scheme == "unix" and location:
+        return socket.AF_UNIX, location
+    if scheme == "udp":
+        host, _, port = location.rpartition(":")
+        if host and port.isdigit():
+            host = host.strip("[]")
+            family = socket.AF_INET6 if ":" in host else socket.AF_INET
+            return family, (host, int(port))
+    raise ValueError(f'Invalid address "{address}", expected "udp://HOST:PORT" or "unix:///PATH"')
+
+
+def handle_packet(packet: bytes) -> str:
+    """Apply a heartbeat packet.
+
+    Returns:
+        The result of the heartbeat, as counted in the heartbeat metrics.
+    """
+    try:
+        clientid, key = packet.decode().split("\n")
+    except ValueError:  # Covers UnicodeDecodeError.
+        result = "bad_request"
+    else:
+        if clientid not in config["watch"]["clients"]:
+            result = "unknown_client"
+        elif not _is_key_correct(clientid, key):
+            result = "unauthorized"
+        else:
+            result = "unavailable" if apply_heartbeat(clientid) == "unavailable" else "accepted"
+    HEARTBEAT_RESULTS[result].inc()
+    return result
+
+
+def bind(address: str) -> socket.socket:
+    """Return a datagram socket bound to an address."""
+    family, sockaddr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if isinstance(sockaddr, str):
+        # Remove the socket left by a previous run, but nothing else.
+        try:
+            if stat.S_ISSOCK(os.stat(sockaddr).st_mode):
+                os.unlink(sockaddr)
+        except FileNotFoundError:
+            pass
+    sock.bind(sockaddr)
+    return sock
+
+
+def serve(sock: socket.socket):
+    """Receive heartbeat packets forever."""
+    while True:
+        packet, sender = sock.recvfrom(MAX_PACKET_SIZE)
+        try:
+            result = handle_packet(packet)
+        except Exception:  # pragma: no cover
+            logger.exception("Error while handling a heartbeat packet from %s.", sender)
+            continue
+        if result == "accepted":
+            logger.debug("Received heartbeat packet from %s.", sender)
+        elif result == "unavailable":
+            # Handing off to a new process: requeue the packet on the socket it shares with this
+            # process. Stop receiving if the new process took over, otherwise resume.
+            sock.sendto(packet, sock.getsockname())
+            if handoff.wait_for_outcome():
+                return
+        else:
+            logger.warning("Rejected heartbeat packet from %s: %s.", sender, result)
@@ -0,0 +1,294 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Restart without downtime by handing off the listening sockets and the state.
+
+On SIGHUP, COS Alerter starts a new process with the same command line, for example after an
+upgrade, and hands off to it:
+
+1. The new process inherits the listening sockets, following the convention of systemd socket
+   activation (file descriptors from 3, LISTEN_FDS and LISTEN_FDNAMES), and one end of a socket
+   pair named "handoff". Connections keep being queued on the sockets meanwhile.
+2. Once its config is loaded, the new process writes "ready" on the socket pair.
+3. The old process stops applying heartbeats and sending notifications, and sends a snapshot of
+   the state of the clients. From then on, it answers heartbeats with 503 and "Retry-After: 1".
+4. The new process restores the snapshot, starts serving and writes "started".
+5. The old process tells systemd, if it is used, that the new process is the main process of the
+   service. It stops accepting connections, releases the leader lease, if any, and exits after
+   DRAIN seconds.
+
+If the new process fails before writing "started", the old process resumes.
+
+The new process is a child of the old one, so the service manager must keep running it once the
+old one exits: with systemd, the service must have Type=notify. Pebble does not follow a new main
+process, so handoff is disabled with COS_ALERTER_HANDOFF=disabled in the environment there.
+
+Sockets activated by systemd are used the same way, with FileDescriptorName= set to "web",
+"dashboard", "metrics" or "datagram".
+"""
+
+import fcntl
+import logging
+import os
+import pickle
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from .alerter import AlerterState, config, state
+
+logger = logging.getLogger(__name__)
+
+SD_LISTEN_FDS_START = 3
+# How long the new process can take to load its config, and then to restore the snapshot.
+READY_TIMEOUT = 60
+STARTED_TIMEOUT = 30
+# How long the old process keeps answering the requests it already accepted.
+DRAIN = 5
+
+_inherited: Dict[str, socket.socket] = {}
+_listeners: Dict[str, socket.socket] = {}
+_channel: Optional[socket.socket] = None
+_lock = threading.Lock()
+_handed_off_at: Optional[float] = None
+_callbacks: List[Callable[[], object]] = []
+
+
+def load_inherited(environ=os.environ):
+    """Take the sockets passed by the previous process or by systemd.
+
+    The variables are removed from the environment so that they are not passed on.
+    """
+    global _channel
+    count = environ.pop("LISTEN_FDS", None)
+    names = environ.pop("LISTEN_FDNAMES", "").split(":")
+    pid = environ.pop("LISTEN_PID", None)
+    # Unlike systemd, the previous process does not know the PID of this process.
+    if count is None or (pid is not None and int(pid) != os.getpid()):
+        return
+    for offset in range(int(count)):
+        fd = SD_LISTEN_FDS_START + offset
+        os.set_inheritable(fd, False)
+        sock = socket.socket(fileno=fd)
+        name = names[offset] if offset < len(names) else "unknown"
+        if name == "handoff":
+            _channel = sock
+        else:
+            _inherited[name] = sock
+    logger.info("Inherited sockets: %s", ", ".join(sorted(_inherited)) or "none")
+
+
+def bind_tcp(listen_addr: str) -> socket.socket:
+    """Return a TCP socket listening on "HOST:PORT"."""
+    host, _, port = listen_addr.rpartition(":")
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+        host.strip("[]"), int(port), type=socket.SOCK_STREAM
+    )[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sockaddr)
+    sock.listen(1024)
+    return sock
+
+
+def listen_socket(
+    name: str, listen_addr: str, bind: Callable[[str], socket.socket] = bind_tcp
+) -> socket.socket:
+    """Return the inherited socket with this name, or bind a new one.
+
+    The socket is handed off to the next process under the same name. An inherited socket is
+    used even if the address changed in the config: changing addresses requires a restart.
+    """
+    sock = _inherited.pop(name, None)
+    if sock is None:
+        sock = bind(listen_addr)
+    _listeners[name] = sock
+    return sock
+
+
+def command_line() -> List[str]:
+    """Return the command line to start this program again.
+
+    Before Python 3.10, the options of the interpreter are not known and are not passed on.
+    """
+    if hasattr(sys, "orig_argv"):
+        return list(sys.orig_argv)
+    spec = getattr(sys.modules["__main__"], "__spec__", None)
+    if spec is not None:  # Started with "python -m".
+        return [sys.executable, "-m", spec.name, *sys.argv[1:]]
+    return [sys.executable, *sys.argv]
+
+
+def on_handed_off(callback: Callable[[], object]):
+    """Register a function called once the new process took over, e.g. to stop a server."""
+    _callbacks.append(callback)
+
+
+def receive_state() -> Optional[dict]:
+    """Return the state handed off by the previous process, if started by a handoff."""
+    if _channel is None:
+        return None
+    _channel.sendall(b"ready\n")
+    chunks = []
+    while chunk := _channel.recv(65536):
+        chunks.append(chunk)
+    # Only the previous process, which started this one, holds the other end.
+    return pickle.loads(b"".join(chunks))
+
+
+def confirm():
+    """Tell the previous process that this one took over, and tell systemd if it is used."""
+    global _channel
+    if _channel is not None:
+        # The previous process tells systemd.
+        _channel.sendall(b"started\n")
+        _channel.close()
+        _channel = None
+    else:
+        notify_systemd("READY=1")
+
+
+def notify_systemd(message: str):
+    """Send a message to systemd if it expects some (Type=notify), otherwise do nothing."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]  # Abstract namespace.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(message.encode(), address)
+        except OSError:
+            logger.exception("Failed to notify systemd.")
+
+
+def spawn(argv: List[str], fds: Dict[str, int]) -> int:
+    """Start a process passing it file descriptors as systemd does.
+
+    Returns:
+        The PID of the process.
+    """
+    names = list(fds)
+    # Copies above the target range, so that placing them does not overwrite one another.
+    copies = [
+        fcntl.fcntl(fds[name], fcntl.F_DUPFD_CLOEXEC, SD_LISTEN_FDS_START + len(names))
+        for name in names
+    ]
+    env = dict(os.environ, LISTEN_FDS=str(len(names)), LISTEN_FDNAMES=":".join(names))
+    actions = [
+        (os.POSIX_SPAWN_DUP2, copy, SD_LISTEN_FDS_START + offset)
+        for offset, copy in enumerate(copies)
+    ]
+    try:
+        return os.posix_spawn(sys.executable, argv, env, file_actions=actions)
+    finally:
+        for copy in copies:
+            os.close(copy)
+
+
+def _read_line(channel: socket.socket, timeout: float) -> bytes:
+    """Read a line from the new process, empty if it closed the channel or did not answer."""
+    channel.settimeout(timeout)
+    line = b""
+    try:
+        while not line.endswith(b"\n"):
+            chunk = channel.recv(1)
+            if not chunk:
+                break
+            line += chunk
+    except OSError:  # Covers timeouts.
+        pass
+    return line.strip()
+
+
+def _abort(pid: int):
+    """Stop a new process that failed to take over."""
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+
+def hand_off(argv: List[str]) -> bool:
+    """Hand off to a new process started with `argv`.
+
+    Returns:
+        Whether the new process took over. Otherwise this process resumes.
+    """
+    global _handed_off_at
+    if config["api_workers"] > 0:
+        logger.error("Handoff is not supported with api_workers. Restart instead.")
+        return False
+    if os.environ.get("COS_ALERTER_HANDOFF") == "disabled":
+        logger.error("Handoff is disabled by COS_ALERTER_HANDOFF. Restart instead.")
+        return False
+    if not _lock.acquire(blocking=False):
+        logger.warning("A handoff is already in progress.")
+        return False
+    try:
+        if _handed_off_at is not None:
+            return False
+        pid = _take_over(argv)
+        if pid is None:
+            return False
+        notify_systemd(f"MAINPID={pid}")
+        for callback in _callbacks:
+            callback()
+        lease = state.get("lease")
+        if lease is not None:
+            lease.release()
+        _handed_off_at = time.monotonic()
+        logger.info("Exiting in %d seconds.", DRAIN)
+        return True
+    finally:
+        _lock.release()
+
+
+def _take_over(argv: List[str]) -> Optional[int]:
+    """Start the new process and send it the state.
+
+    Returns:
+        The PID of the new process if it took over, otherwise None.
+    """
+    channel, child = socket.socketpair()
+    with channel:
+        fds = {name: sock.fileno() for name, sock in _listeners.items()}
+        pid = spawn(argv, {**fds, "handoff": child.fileno()})
+        child.close()
+        logger.info("Started process %d, handing off %s.", pid, ", ".join(fds))
+        if _read_line(channel, READY_TIMEOUT) != b"ready":
+            logger.error("Process %d did not get ready. Resuming.", pid)
+            _abort(pid)
+            return None
+        snapshot = AlerterState.pause_for_handoff()
+        try:
+            channel.sendall(pickle.dumps(snapshot))
+            channel.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass  # The process is gone, this is handled below.
+        if _read_line(channel, STARTED_TIMEOUT) != b"started":
+            logger.error("Process %d did not take over. Resuming.", pid)
+            _abort(pid)
+            AlerterState.resume_after_handoff()
+            return None
+    logger.info("Process %d took over.", pid)
+    return pid
+
+
+def wait_for_outcome() -> bool:
+    """Wait until the handoff in progress, if any, succeeds or fails.
+
+    Returns:
+        Whether this process handed off.
+    """
+    with _lock:
+        return _handed_off_at is not None
+
+
+def finished() -> bool:
+    """Return whether this process handed off and finished answering its pending requests."""
+    return _handed_off_at is not None and time.monotonic() - _handed_off_at >= DRAIN
@@ -0,0 +1,286 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Incrementally maintained indexes over the status of the clients."""
+
+import queue
+import secrets
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+STATUSES = ("up", "down", "unknown")
+FILTERS = STATUSES + ("silenced",)
+COUNTERS = FILTERS + ("notified",)
+SORT_KEYS = ("name", "client_id", "status")
+
+# Order in which statuses are listed when sorting by status. Most urgent first.
+_STATUS_ORDER = ("down", "unknown", "up")
+
+
+class Subscription:
+    """A bounded queue of status change events for one subscriber."""
+
+    def __init__(self, maxsize: int):
+        self.events = queue.Queue(maxsize)
+        # Set when the subscriber fell behind and events were dropped.
+        self.overflowed = False
+
+
+class StatusIndex:
+    """Sets of client IDs keyed by status.
+
+    The index is updated by the state layer whenever the status of a client may have changed, so
+    that queries such as "all the down clients" only touch the matching clients instead of
+    evaluating the whole fleet.
+
+    Every change also bumps a revision number which can be used as a cursor to find the clients
+    that changed since a previous query, and status changes are pushed to subscribers. Revisions
+    start over with every index, so each index has a random epoch to tell its revisions apart.
+    """
+
+    def __init__(self, names: Dict[str, str]):
+        """Create an empty index.
+
+        Args:
+            names: Mapping of client ID to display name, used for searching and sorting.
+        """
+        self._lock = threading.Lock()
+        self._names = {clientid: name.lower() for clientid, name in names.items()}
+        self._sort_keys = {
+            "name": lambda clientid: (self._names[clientid], clientid),
+            "client_id": lambda clientid: clientid,
+        }
+        self._ordered = {
+            key: sorted(names, key=self._sort_keys[key]) for key in ("name", "client_id")
+        }
+        self._members = {key: set() for key in COUNTERS}
+        self._status = {}
+        self.epoch = secrets.token_hex(4)
+        self.revision = 0
+        # Client IDs ordered by the revision of their last change, oldest first.
+        self._changes = OrderedDict()
+        self._subscriptions = set()
+
+    def update(self, clientid: str, status: str, silenced: bool, notified: bool = False) -> bool:
+        """Record the current status of a client.
+
+        Args:
+            clientid: The client to update.
+            status: One of "up", "down" or "unknown".
+            silenced: Whether notifications are silenced for the client.
+            notified: Whether a notification was sent within the repeat interval.
+
+        Returns:
+            True if the status, silencing or notification state of the client changed.
+        """
+        with self._lock:
+            previous = self._status.get(clientid)
+            if previous == (status, silenced, notified):
+                return False
+            if previous is not None:
+                self._members[previous[0]].discard(clientid)
+            self._members[status].add(clientid)
+            for key, member in (("silenced", silenced), ("notified", notified)):
+                if member:
+                    self._members[key].add(clientid)
+                else:
+                    self._members[key].discard(clientid)
+            self._status[clientid] = (status, silenced, notified)
+            self._record_change(clientid)
+            if previous is not None and previous[:2] == (status, silenced):
+                # The dashboard does not show notifications.
+                return True
+            self._publish(
+                {
+                    "client_id": clientid,
+                    "status": status,
+                    "is_silenced": silenced,
+                    "previous_status": previous[0] if previous is not None else None,
+                    "was_silenced": previous[1] if previous is not None else None,
+                    "revision": self.revision,
+                }
+            )
+            return True
+
+    def subscribe(
+        self, limit: Optional[int] = None, maxsize: int = 1000
+    ) -> Optional[Subscription]:
+        """Start receiving status change events.
+
+        The subscriber must read the events fast enough. If its queue fills up it is dropped and
+        `Subscription.overflowed` is set so that it can start over from a full reload.
+
+        Args:
+            limit: The maximum number of subscriptions, if any.
+            maxsize: The maximum number of events waiting to be read by the subscriber.
+
+        Returns:
+            The subscription, or None if there are already `limit` subscriptions.
+        """
+        subscription = Subscription(maxsize)
+        with self._lock:
+            if limit is not None and len(self._subscriptions) >= limit:
+                return None
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Stop receiving status change events."""
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def subscriber_count(self) -> int:
+        """Return the number of active subscriptions."""
+        return len(self._subscriptions)
+
+    def _publish(self, event: dict):
+        """Push an event to all subscribers. Must be called with the lock held."""
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.events.put_nowait(event)
+            except queue.Full:
+                subscription.overflowed = True
+                self._subscriptions.discard(subscription)
+
+    def mark_changed(self, clientid: str):
+        """Record a change of a client which does not affect its status (e.g. a heartbeat)."""
+        with self._lock:
+            self._record_change(clientid)
+
+    def _record_change(self, clientid: str):
+        """Bump the revision for a client. Must be called with the lock held."""
+        self.revision += 1
+        self._changes[clientid] = self.revision
+        self._changes.move_to_end(clientid)
+
+    def changed_since(self, cursor: int) -> Tuple[int, List[str]]:
+        """Return the clients which changed after a given revision.
+
+        This only walks the clients that changed, newest first, until it reaches the cursor.
+
+        Returns:
+            A tuple of the current revision, to be used as the next cursor, and the client IDs
+            which changed after `cursor`, oldest change first.
+        """
+        with self._lock:
+            changed = []
+            for clientid in reversed(self._changes):
+                if self._changes[clientid] <= cursor:
+                    break
+                changed.append(clientid)
+            return self.revision, changed[::-1]
+
+    def count(self, key: str) -> int:
+        """Return the number of clients with a status, silenced or recently notified."""
+        return len(self._members[key])
+
+    def statuses(self) -> Dict[str, Tuple[str, bool, bool]]:
+        """Return a snapshot of (status, silenced, notified) for every client."""
+        with self._lock:
+            return dict(self._status)
+
+    def counts(self) -> Dict[str, int]:
+        """Return a consistent snapshot of all the counters and the current revision."""
+        with self._lock:
+            counts = {key: len(members) for key, members in self._members.items()}
+            counts["total"] = len(self._status)
+            counts["revision"] = self.revision
+            return counts
+
+    def page(
+        self,
+        status: Optional[str] = None,
+        search: Optional[str] = None,
+        sort: str = "name",
+        reverse: bool = False,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> Tuple[int, List[str]]:
+        """Return a page of client IDs matching the filters.
+
+        Args:
+            status: Only return clients with this status (or silenced clients).
+            search: Only return clients whose name or ID contains this string (case insensitive).
+            sort: One of "name", "client_id" or "status".
+            reverse: Reverse the sort order.
+            offset: Number of matching clients to skip.
+            limit: Maximum number of clients to return.
+
+        Returns:
+            A tuple of the total number of matching clients and the requested page.
+        """
+        with self._lock:
+            if status is None and search is None and sort in self._ordered:
+                # Fast path: no filtering, the order is precomputed.
+                ordered = self._ordered[sort]
+                total = len(ordered)
+                if reverse:
+                    end = max(total - offset, 0)
+                    start = max(end - limit, 0) if limit is not None else 0
+                    return total, ordered[start:end][::-1]
+                end = offset + limit if limit is not None else None
+                return total, ordered[offset:end]
+
+            candidates = self._members[status] if status is not None else self._status
+            if search:
+                needle = search.lower()
+                candidates = [
+                    clientid
+                    for clientid in candidates
+                    if needle in self._names[clientid] or needle in clientid.lower()
+                ]
+            if sort == "status":
+                candidates = sorted(
+                    candidates,
+                    key=lambda clientid: (
+                        _STATUS_ORDER.index(self._status[clientid][0]),
+                        self._sort_keys["name"](clientid),
+                    ),
+                    reverse=reverse,
+                )
+            else:
+                candidates = sorted(candidates, key=self._sort_keys[sort], reverse=reverse)
+        end = offset + limit if limit is not None else None
+        return len(candidates), candidates[offset:end]
+
+
+class LabelIndex:
+    """Inverted index from label key and value to the clients carrying that label."""
+
+    def __init__(self, labels: Dict[str, Dict[str, str]]):
+        """Build the index.
+
+        Args:
+            labels: Mapping of client ID to the labels of the client.
+        """
+        self._clients = {}
+        for clientid, client_labels in labels.items():
+            for key, value in client_labels.items():
+                self._clients.setdefault((str(key), str(value)), set()).add(clientid)
+
+    @staticmethod
+    def parse_selector(selector: str) -> Dict[str, str]:
+        """Parse a selector of the form "key1=value1,key2=value2".
+
+        Raises:
+            ValueError: If the selector is empty or malformed.
+        """
+        matchers = {}
+        for matcher in selector.split(","):
+            key, sep, value = matcher.partition("=")
+            if not sep or not key.strip():
+                raise ValueError(f"Invalid label matcher: {matcher!r}")
+            matchers[key.strip()] = value.strip()
+        return matchers
+
+    def select(self, matchers: Dict[str, str]) -> Set[str]:
+        """Return the clients carrying all the given labels."""
+        sets = sorted(
+            (self._clients.get(item, set()) for item in matchers.items()),
+            key=len,
+        )
+        if not sets:
+            return set()
+        # Start from the smallest set so that the cost is bounded by the smallest match.
+        return sets[0].intersection(*sets[1:])
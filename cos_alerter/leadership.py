@@ -0,0 +1,136 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Leader lease deciding which of several COS Alerter instances sends the notifications.
+
+The lease is a JSON file on storage shared by the instances, naming the instance holding it and
+when it expires. It is read and written under an exclusive flock() so that only one instance can
+take it at a time. The leader renews the lease three times per lease duration. If the leader stops
+renewing it, another instance takes it over once it expires.
+
+An instance stops considering itself the leader as soon as its own lease would have expired, even
+if it could not read the lease file, so two instances never send notifications at the same time
+unless their clocks drift apart by more than the lease duration.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import socket
+from typing import Optional
+
+from prometheus_client import Counter, Histogram
+
+from .alerter import state
+
+logger = logging.getLogger(__name__)
+
+LEADERSHIP_CHANGES = Counter(
+    "cos_alerter_leadership_changes",
+    "Number of times this instance became or stopped being the leader.",
+    registry=None,
+)
+FAILOVER = Histogram(
+    "cos_alerter_leader_failover_seconds",
+    "Time between the last renewal of the lease by the previous leader and its takeover by this "
+    "instance.",
+    buckets=(1.0, 2.5, 5.0, 10.0, 15.0, 20.0, 30.0, 60.0, 120.0, 300.0),
+    registry=None,
+)
+
+
+def default_instance_id() -> str:
+    """Return an identifier that is unique among the instances."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Lease:
+    """A lease held through a lock file."""
+
+    def __init__(self, path: str, duration: float, instance_id: Optional[str] = None):
+        self.path = path
+        self.duration = duration
+        self.instance_id = instance_id or default_instance_id()
+        self._leader = False
+        self._valid_until = 0.0
+        self._released = False
+
+    def is_leader(self) -> bool:
+        """Return whether this instance holds a lease that has not expired."""
+        return self._leader and state["clock"].monotonic() < self._valid_until
+
+    def _set_leader(self, leader: bool):
+        if leader != self._leader:
+            LEADERSHIP_CHANGES.inc()
+            if leader:
+                logger.info("This instance is now the leader.")
+            else:
+                logger.warning("This instance is not the leader anymore.")
+        self._leader = leader
+
+    def renew(self) -> bool:
+        """Take or renew the lease if it is free, expired or already ours.
+
+        Returns:
+            Whether this instance is the leader.
+        """
+        clock = state["clock"]
+        started = clock.monotonic()
+        now = clock.now().timestamp()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if self._released:
+                return False
+            try:
+                lease = json.loads(f.read() or "{}")
+            except ValueError:
+                logger.warning("Invalid lease file %s. Taking it over.", self.path)
+                lease = {}
+            holder = lease.get("holder")
+            if holder not in (None, self.instance_id) and lease.get("expires", 0) > now:
+                self._set_leader(False)
+                return False
+            if holder not in (None, self.instance_id):
+                FAILOVER.observe(now - lease.get("renewed", now))
+                logger.info("Taking over the expired lease of %s.", holder)
+            f.seek(0)
+            f.truncate()
+            json.dump(
+                {"holder": self.instance_id, "renewed": now, "expires": now + self.duration}, f
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        self._valid_until = started + self.duration
+        self._set_leader(True)
+        return True
+
+    def release(self):
+        """Give up the lease for good, so that another instance can take it over right away."""
+        self._released = True
+        if not self._leader:
+            return
+        self._leader = False
+        LEADERSHIP_CHANGES.inc()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                lease = json.loads(f.read() or "{}")
+            except ValueError:
+                lease = {}
+            if lease.get("holder") == self.instance_id:
+                f.seek(0)
+                f.truncate()
+        logger.info("Released the lease.")
+
+    def run(self):
+        """Take or renew the lease until it is released."""
+        clock = state["clock"]
+        while not self._released:
+            try:
+                self.renew()
+            except OSError:
+                logger.exception("Failed to renew the lease %s.", self.path)
+            clock.sleep(self.duration / 3)
@@ -0,0 +1,282 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Prometheus metrics about the state of the clients."""
+
+from typing import Dict, Protocol
+
+from prometheus_client import (
+    PLATFORM_COLLECTOR,
+    PROCESS_COLLECTOR,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from .admission import ADMISSION_REJECTED, IN_FLIGHT, QUEUE_TIME
+from .alerter import checker_health, config, is_leader, state
+from .contention import LOCK_HOLD, LOCK_WAIT
+from .index import STATUSES
+from .leadership import FAILOVER, LEADERSHIP_CHANGES
+from .replication import REPLICATED_HEARTBEATS, REPLICATION_BATCHES
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Registry used when metrics are served on their own address (metrics_listen_addr). It only holds
+# the COS Alerter metrics and the process metrics, not the per-request Flask metrics.
+METRICS_REGISTRY = CollectorRegistry()
+METRICS_REGISTRY.register(PROCESS_COLLECTOR)
+METRICS_REGISTRY.register(PLATFORM_COLLECTOR)
+
+HEARTBEATS = Counter(
+    "cos_alerter_heartbeats",
+    "Number of heartbeat requests received, by result.",
+    ["result"],
+    registry=None,
+)
+
+
+class ResultCounter(Protocol):
+    """Counter of heartbeat results: a Prometheus counter, or one in shared memory in workers."""
+
+    def inc(self, amount: float = 1):
+        """Increment the counter."""
+
+
+# Bind the label values once so that counting a heartbeat is a single increment.
+HEARTBEAT_RESULTS: Dict[str, ResultCounter] = {
+    result: HEARTBEATS.labels(result=result)
+    for result in ("accepted", "bad_request", "unknown_client", "unauthorized", "unavailable")
+}
+
+COALESCED_HEARTBEATS = Counter(
+    "cos_alerter_heartbeats_coalesced",
+    "Number of accepted heartbeats applied without locking the client, see coalesce_window.",
+    registry=None,
+)
+
+CHECK_LAG = Histogram(
+    "cos_alerter_check_lag_seconds",
+    "Delay of the checks of the clients behind the time they were due.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+    registry=None,
+)
+CHECK_ERRORS = Counter(
+    "cos_alerter_check_errors",
+    "Number of checks of a client that failed with an error.",
+    registry=None,
+)
+
+
+class StatusCollector:
+    """Expose the status counters maintained by the status index.
+
+    The counters are updated as the clients change status so a scrape does not depend on the
+    size of the fleet.
+    """
+
+    def collect(self):
+        """Yield the metrics. Called by the Prometheus client on every scrape."""
+        if "index" not in state:
+            return
+        counts = state["index"].counts()
+        clients = GaugeMetricFamily(
+            "cos_alerter_clients", "Number of clients by status.", labels=["status"]
+        )
+        for status in STATUSES:
+            clients.add_metric([status], counts[status])
+        yield clients
+        yield GaugeMetricFamily(
+            "cos_alerter_clients_silenced",
+            "Number of clients with notifications silenced.",
+            value=counts["silenced"],
+        )
+        yield GaugeMetricFamily(
+            "cos_alerter_clients_recently_notified",
+            "Number of clients notified about within the repeat interval.",
+            value=counts["notified"],
+        )
+
+
+class CheckerCollector:
+    """Expose whether the clients are checked in time."""
+
+    def collect(self):
+        """Yield the metrics. Called by the Prometheus client on every scrape."""
+        if "index" not in state:
+            return
+        health = checker_health()
+        yield GaugeMetricFamily(
+            "cos_alerter_check_max_lag_seconds",
+            "Largest delay of the last check of a client behind the time it was due.",
+            value=health["max_lag"],
+        )
+        yield GaugeMetricFamily(
+            "cos_alerter_check_stalled_clients",
+            "Number of clients not checked for longer than max_check_lag.",
+            value=len(health["stalled"]),
+        )
+
+
+class LeaderCollector:
+    """Expose whether this instance sends the notifications."""
+
+    def collect(self):
+        """Yield the metrics. Called by the Prometheus client on every scrape."""
+        yield GaugeMetricFamily(
+            "cos_alerter_leader",
+            "Whether this instance sends the notifications (1) or leaves them to another (0).",
+            value=1 if is_leader() else 0,
+        )
+
+
+class ClientCollector:
+    """Expose per-client metrics, computed at scrape time.
+
+    The client states are read in a single pass without taking the client locks. Individual
+    values may be slightly out of date but a scrape never blocks a heartbeat.
+    """
+
+    def collect(self):
+        """Yield the metrics. Called by the Prometheus client on every scrape."""
+        if "index" not in state:
+            return
+        limit = config["per_client_metrics_limit"]
+        if limit == 0:
+            return
+        statuses = state["index"].statuses()
+        clients = state["clients"]
+        selected = self._select(statuses, limit)
+
+        heartbeat_age = GaugeMetricFamily(
+            "cos_alerter_client_last_heartbeat_age_seconds",
+            "Seconds since the last heartbeat from the client.",
+            labels=["client_id"],
+        )
+        down = GaugeMetricFamily(
+            "cos_alerter_client_down", "Whether the client is down.", labels=["client_id"]
+        )
+        silenced = GaugeMetricFamily(
+            "cos_alerter_client_silenced",
+            "Whether notifications for the client are silenced.",
+            labels=["client_id"],
+        )
+        silenced_until = GaugeMetricFamily(
+            "cos_alerter_client_silenced_until_timestamp_seconds",
+            "Unix time at which the silence of the client expires.",
+            labels=["client_id"],
+        )
+        last_notification = GaugeMetricFamily(
+            "cos_alerter_client_last_notification_timestamp_seconds",
+            "Unix time of the last notification sent about the client.",
+            labels=["client_id"],
+        )
+        heartbeat_interval = GaugeMetricFamily(
+            "cos_alerter_client_heartbeat_interval_seconds",
+            "Estimated quantiles of the time between heartbeats from the client.",
+            labels=["client_id", "quantile"],
+        )
+        down_interval = GaugeMetricFamily(
+            "cos_alerter_client_down_interval_seconds",
+            "Time without a heartbeat after which the client is considered down.",
+            labels=["client_id"],
+        )
+        heartbeat_jitter = GaugeMetricFamily(
+            "cos_alerter_client_heartbeat_jitter_seconds",
+            "Moving average of the deviation of the time between heartbeats from its mean.",
+            labels=["client_id"],
+        )
+        last_evaluated = GaugeMetricFamily(
+            "cos_alerter_client_last_evaluated_timestamp_seconds",
+            "Unix time of the last check of the client.",
+            labels=["client_id"],
+        )
+
+        now = state["clock"].monotonic()
+        start_time = state["start_time"]
+        start_date = state["start_date"]
+        for clientid in selected:
+            data = clients[clientid]
+            status, is_silenced, _ = statuses[clientid]
+            labels = [clientid]
+            alert_time = data["alert_time"]
+            if alert_time is not None and alert_time != start_time:
+                heartbeat_age.add_metric(labels, now - alert_time)
+            down.add_metric(labels, 1 if status == "down" else 0)
+            silenced.add_metric(labels, 1 if is_silenced else 0)
+            if is_silenced and data["silenced_until"] is not None:
+                silenced_until.add_metric(labels, data["silenced_until"].timestamp())
+            notify_time = data["notify_time"]
+            if notify_time is not None:
+                last_notification.add_metric(labels, notify_time - start_time + start_date)
+            down_interval.add_metric(labels, data["down_interval"])
+            if data["last_evaluated"] is not None:
+                last_evaluated.add_metric(labels, data["last_evaluated"] - start_time + start_date)
+            heartbeats = data["heartbeats"]
+            if heartbeats.mean_gap is not None:
+                for quantile in QUANTILES:
+                    heartbeat_interval.add_metric(
+                        [clientid, str(quantile)], heartbeats.sketch.quantile(quantile)
+                    )
+                heartbeat_jitter.add_metric(labels, heartbeats.jitter)
+
+        yield heartbeat_age
+        yield down
+        yield silenced
+        yield silenced_until
+        yield last_notification
+        yield heartbeat_interval
+        yield heartbeat_jitter
+        yield down_interval
+        yield last_evaluated
+        yield GaugeMetricFamily(
+            "cos_alerter_client_series_dropped",
+            "Number of clients left out of the per-client metrics because of the limit.",
+            value=len(clients) - len(selected),
+        )
+
+    @staticmethod
+    def _select(statuses, limit):
+        """Return the IDs of the clients to export, at most `limit` unless it is negative."""
+        clients = state["clients"]
+        if limit < 0 or limit >= len(clients):
+            return list(clients)
+        # Clients that are down are the most interesting so export them first.
+        down = [clientid for clientid, status in statuses.items() if status[0] == "down"]
+        down_set = set(down)
+        selected = down[:limit]
+        for clientid in clients:
+            if len(selected) >= limit:
+                break
+            if clientid not in down_set:
+                selected.append(clientid)
+        return selected
+
+
+_registered = set()
+
+
+def register_collectors(registry: CollectorRegistry = REGISTRY):
+    """Register the COS Alerter collectors. Does nothing if they are already registered."""
+    if id(registry) in _registered:
+        return
+    registry.register(StatusCollector())
+    registry.register(CheckerCollector())
+    registry.register(ClientCollector())
+    registry.register(LeaderCollector())
+    registry.register(HEARTBEATS)
+    registry.register(COALESCED_HEARTBEATS)
+    registry.register(LOCK_WAIT)
+    registry.register(LOCK_HOLD)
+    registry.register(CHECK_LAG)
+    registry.register(CHECK_ERRORS)
+    registry.register(REPLICATION_BATCHES)
+    registry.register(REPLICATED_HEARTBEATS)
+    registry.register(LEADERSHIP_CHANGES)
+    registry.register(FAILOVER)
+    registry.register(ADMISSION_REJECTED)
+    registry.register(QUEUE_TIME)
+    registry.register(IN_FLIGHT)
+    _registered.add(id(registry))
@@ -0,0 +1,182 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""On-demand profiling of the running daemon.
+
+A profile covers a bounded window of time and produces, in a directory:
+
+- threads-<time>.txt: the stack of every thread when the profile started.
+- cpu-<time>.folded: the stacks sampled during the window in the "collapsed" format used by
+  flamegraph.pl and speedscope, one "thread;frame;frame... count" line per distinct stack. Only
+  the threads which used CPU time since the previous sample are sampled, not the waiting ones.
+- memory-<time>.tracemalloc: a snapshot of the memory allocated during the window, which can be
+  loaded with tracemalloc.Snapshot.load().
+- locks-<time>.json: the time spent waiting for and holding the client locks by each call site
+  since the start of the daemon.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import contention
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.01
+# Threads sampled per SAMPLE_INTERVAL at most. With more threads, e.g. one per client, the
+# interval grows so that the cost of sampling does not grow with the size of the fleet.
+THREADS_PER_INTERVAL = 100
+MAX_DURATION = 600
+# Frames kept by tracemalloc for each allocation.
+TRACEMALLOC_FRAMES = 10
+
+
+def thread_dump() -> str:
+    """Return the stacks of all the threads."""
+    frames = sys._current_frames()
+    sections = []
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident) if thread.ident is not None else None
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        daemon = " daemon" if thread.daemon else ""
+        sections.append(f'Thread "{thread.name}" ({thread.ident}{daemon}):\n{stack}')
+    return "\n".join(sections)
+
+
+def _cpu_time(ident: int) -> Optional[float]:
+    """Return the CPU time used by a thread, or None if it exited."""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except OSError:
+        return None
+
+
+def _collapse(frame) -> List[str]:
+    """Return the functions of a stack, outermost first."""
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+        frame = frame.f_back
+    functions.reverse()
+    return functions
+
+
+class Profiler:
+    """Sampling CPU profiler and memory snapshots for a bounded window of time.
+
+    The stacks of the threads using CPU time are sampled from a background thread, so the
+    profiled threads are not slowed down beyond the cost of holding the GIL while sampling.
+    """
+
+    def __init__(self, sample_interval: float = SAMPLE_INTERVAL):
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def running(self) -> bool:
+        """Return whether a profile is being taken."""
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def start(self, directory: Path, duration: float) -> Optional[Dict[str, Path]]:
+        """Start profiling for `duration` seconds (at most MAX_DURATION).
+
+        Returns:
+            The paths of the files that will be written, or None if a profile is already running.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return None
+            stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+            paths = {
+                "threads": directory / f"threads-{stamp}.txt",
+                "cpu": directory / f"cpu-{stamp}.folded",
+                "memory": directory / f"memory-{stamp}.tracemalloc",
+                "locks": directory / f"locks-{stamp}.json",
+            }
+            paths["threads"].write_text(thread_dump())
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(paths, min(duration, MAX_DURATION)),
+                name="profiler",
+                daemon=True,
+            )
+            self._thread.start()
+        logger.info("Profiling for %.0f seconds.", duration)
+        return paths
+
+    def stop(self):
+        """Stop profiling early. The results are written by the profiling thread."""
+        self._stop.set()
+
+    def toggle(self, directory: Path, duration: float):
+        """Start profiling, or stop if a profile is running."""
+        if self.running():
+            self.stop()
+        else:
+            self.start(directory, duration)
+
+    def join(self):
+        """Wait for the profile to be written."""
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self, paths: Dict[str, Path], duration: float):
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            samples = self._sample(duration)
+            tracemalloc.take_snapshot().dump(str(paths["memory"]))
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+        with paths["cpu"].open("w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        paths["locks"].write_text(json.dumps(contention.summary(), indent=2, sort_keys=True))
+        logger.info("Profile written to %s.", paths["cpu"].parent)
+
+    def interval(self, threads: int) -> float:
+        """Return the time between two samples when there are `threads` threads."""
+        return self.sample_interval * max(1.0, threads / THREADS_PER_INTERVAL)
+
+    def _sample(self, duration: float) -> collections.Counter:
+        """Sample the stacks of the other threads using CPU until the end of the window."""
+        samples = collections.Counter()
+        own = threading.get_ident()
+        names = {}
+        cpu_times = {}
+        end = time.monotonic() + duration
+        while time.monotonic() < end and not self._stop.is_set():
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                cpu_time = _cpu_time(ident)
+                previous = cpu_times.get(ident)
+                cpu_times[ident] = cpu_time
+                if cpu_time is None or previous is None or cpu_time == previous:
+                    continue  # Waiting, or first seen.
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = [names.get(ident, str(ident))] + _collapse(frame)
+                samples[";".join(stack)] += 1
+            self._stop.wait(self.interval(len(frames)))
+        return samples
+
+
+profiler = Profiler()
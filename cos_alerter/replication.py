@@ -0,0 +1,157 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Replication of the heartbeats between COS Alerter instances.
+
+Every instance sends the time of the heartbeats it received to its peers, in batches holding the
+latest heartbeat of each client since the previous batch. Times are sent as wall clock timestamps
+since the monotonic clocks of two hosts can not be compared. A heartbeat received from a peer is
+applied if it is newer than the last heartbeat known for the client, so the order and repetition
+of the batches do not matter.
+"""
+
+import concurrent.futures
+import json
+import logging
+import threading
+import urllib.error
+import urllib.request
+from typing import Dict, Iterable
+
+from prometheus_client import Counter
+
+from .alerter import AlerterState, config, state
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a peer to answer.
+TIMEOUT = 5
+
+REPLICATION_BATCHES = Counter(
+    "cos_alerter_replication_batches",
+    "Number of batches of heartbeats sent to a peer, by result.",
+    ["peer", "result"],
+    registry=None,
+)
+REPLICATED_HEARTBEATS = Counter(
+    "cos_alerter_replicated_heartbeats",
+    "Number of heartbeats received from the peers, by result.",
+    ["result"],
+    registry=None,
+)
+
+
+class Replicator:
+    """Batches of the heartbeats to send to each peer."""
+
+    def __init__(self, peers: Iterable[str], key: str):
+        self.peers = list(peers)
+        self._key = key
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, float]] = {peer: {} for peer in self.peers}
+
+    def record(self, clientid: str, timestamp: float):
+        """Queue a heartbeat received at `timestamp` for all the peers."""
+        with self._lock:
+            for pending in self._pending.values():
+                if pending.get(clientid, 0) < timestamp:
+                    pending[clientid] = timestamp
+
+    def _take(self, peer: str) -> Dict[str, float]:
+        with self._lock:
+            batch = self._pending[peer]
+            self._pending[peer] = {}
+        return batch
+
+    def _restore(self, peer: str, batch: Dict[str, float]):
+        """Queue a batch again after failing to send it, keeping the newest heartbeats."""
+        with self._lock:
+            pending = self._pending[peer]
+            for clientid, timestamp in batch.items():
+                if pending.get(clientid, 0) < timestamp:
+                    pending[clientid] = timestamp
+
+    def send(self):
+        """Send the pending heartbeats to all the peers in parallel.
+
+        A batch that could not be sent is sent again with the next one, so a peer that was
+        unreachable catches up when it comes back.
+        """
+        # One thread per peer, so that a peer that does not answer does not delay the others.
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(self.peers)), thread_name_prefix="replication"
+        ) as executor:
+            for _ in executor.map(self._send_to, self.peers):
+                pass
+
+    def _send_to(self, peer: str):
+        """Send the pending heartbeats to a peer."""
+        batch = self._take(peer)
+        if not batch:
+            return
+        request = urllib.request.Request(
+            f"{peer.rstrip('/')}/api/v1/replication",
+            data=json.dumps({"heartbeats": batch}).encode(),
+            headers={
+                "Authorization": f"Bearer {self._key}",
+                "Content-Type": "application/json",
+            },
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT):
+                pass
+        except (OSError, urllib.error.URLError) as e:
+            logger.warning("Failed to send %d heartbeats to %s: %s", len(batch), peer, e)
+            self._restore(peer, batch)
+            REPLICATION_BATCHES.labels(peer=peer, result="error").inc()
+        else:
+            REPLICATION_BATCHES.labels(peer=peer, result="sent").inc()
+
+    def run(self, interval: float):
+        """Send the pending heartbeats every `interval` seconds, forever."""
+        clock = state["clock"]
+        while True:
+            clock.sleep(interval)
+            self.send()
+
+
+def record_heartbeat(clientid: str, arrival: float):
+    """Queue a heartbeat received by this instance at the monotonic time `arrival` for the peers.
+
+    Does nothing if replication is not enabled.
+    """
+    replicator = state.get("replicator")
+    if replicator is not None:
+        replicator.record(clientid, arrival - state["start_time"] + state["start_date"])
+
+
+def merge(heartbeats: Dict[str, float]) -> Dict[str, int]:
+    """Apply heartbeats received from a peer, keeping the newest heartbeat of each client.
+
+    Args:
+        heartbeats: The wall clock timestamp of the last heartbeat of clients.
+
+    Returns:
+        The number of heartbeats that were "applied", "stale" (not newer than the last known one)
+        or for an "unknown" client.
+    """
+    counts = {"applied": 0, "stale": 0, "unknown": 0}
+    clock = state["clock"]
+    for clientid, timestamp in heartbeats.items():
+        if clientid not in config["watch"]["clients"]:
+            counts["unknown"] += 1
+            continue
+        # A timestamp ahead of this host (clocks are never perfectly in sync) counts as now.
+        arrival = min(timestamp - state["start_date"] + state["start_time"], clock.monotonic())
+        with AlerterState(clientid) as client_state:
+            alert_time = client_state.data["alert_time"]
+            if alert_time is not None and alert_time >= arrival:
+                counts["stale"] += 1
+                continue
+            client_state.reset_alert_timeout(arrival)
+        counts["applied"] += 1
+    for result, count in counts.items():
+        if count:
+            REPLICATED_HEARTBEATS.labels(result=result).inc(count)
+    return counts
@@ -0,0 +1,95 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Timers firing at monotonic deadlines."""
+
+import heapq
+import itertools
+import logging
+import threading
+from typing import Callable, Dict, Generic, Hashable, List, Optional, TypeVar
+
+from .clock import Clock
+
+logger = logging.getLogger(__name__)
+
+Key = TypeVar("Key", bound=Hashable)
+
+
+class Scheduler(Generic[Key]):
+    """A set of keyed timers handled by a single thread.
+
+    Each key has at most one deadline. When deadlines pass, the handler is called once with all
+    the keys that are due, so that their expiry can be processed as a batch. Keys with the same
+    deadline are handled in the order in which they were scheduled.
+    """
+
+    def __init__(self, handler: Callable[[List[Key]], None], clock: Optional[Clock] = None):
+        self._handler = handler
+        self._clock = clock or Clock()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._heap = []
+        self._deadlines: Dict[Key, float] = {}
+
+    def schedule(self, key: Key, deadline: float):
+        """Fire `key` at `deadline` (monotonic seconds), replacing any previous deadline."""
+        with self._condition:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._sequence), key))
+            self._condition.notify()
+
+    def cancel(self, key: Key):
+        """Cancel the timer for `key`, if any."""
+        with self._condition:
+            self._deadlines.pop(key, None)
+
+    def next_deadline(self) -> Optional[float]:
+        """Return the earliest pending deadline."""
+        with self._condition:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _discard_stale(self):
+        """Drop the heap entries that were cancelled or rescheduled. Requires the lock."""
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now: float) -> List[Key]:
+        """Remove and return the keys whose deadline passed. Requires the lock."""
+        due = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+            self._discard_stale()
+        return due
+
+    def run_pending(self, now: Optional[float] = None):
+        """Call the handler for the keys that are due, if any."""
+        with self._condition:
+            due = self._pop_due(self._clock.monotonic() if now is None else now)
+        if due:
+            self._handler(due)
+
+    def run(self):
+        """Fire the timers as they expire. Never returns."""
+        while True:
+            with self._condition:
+                deadline = self.next_deadline()
+                timeout = None if deadline is None else max(deadline - self._clock.monotonic(), 0)
+                self._condition.wait(timeout)
+            try:
+                self.run_pending()
+            except Exception:  # pragma: no cover
+                logger.exception("Error while firing timers.")
+
+    def start(self) -> threading.Thread:
+        """Run the timers in a daemon thread."""
+        thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        thread.start()
+        return thread
@@ -4,52 +4,80 @@
 """HTTP server for COS Alerter."""
 
 import datetime
+import functools
 import hashlib
 import hmac
+import json
 import logging
-from typing import Optional
+import math
+import queue
+from typing import Optional, Tuple
 
 import timeago
-from flask import Flask, redirect, render_template, request
+from flask import Flask, Response, redirect, render_template, request, stream_with_context
 from prometheus_flask_exporter import PrometheusMetrics
 
-from .alerter import AlerterState, config, now_datetime
+from . import admission
+from .alerter import (
+    AlerterState,
+    checker_health,
+    coalesce_heartbeat,
+    config,
+    now_datetime,
+    state,
+)
+from .index import FILTERS, SORT_KEYS, LabelIndex
+from .metrics import COALESCED_HEARTBEATS, HEARTBEAT_RESULTS, register_collectors
+from .profiling import MAX_DURATION, profiler
+from .replication import merge, record_heartbeat
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 
-def create_app(include_api: bool = True, include_dashboard: bool = True) -> Flask:
+# Threads of each waitress server, besides those of the event streams, see server_threads().
+SERVER_THREADS = 4
+EVENT_STREAM_KEEPALIVE = 15
+# How often the dashboards which could not get an event stream reload the clients.
+POLL_INTERVAL = 15
+
+
+def create_app(
+    include_api: bool = True, include_dashboard: bool = True, include_metrics: bool = True
+) -> Flask:
     """Create Flask app with specified endpoints.
 
     Args:
-        include_api: Whether to include the /alive API endpoint
+        include_api: Whether to include the /alive API endpoint and the replication endpoint
         include_dashboard: Whether to include the / dashboard endpoint
+        include_metrics: Whether to instrument the requests and include the /metrics endpoint.
+            Set it to False when metrics are served on their own address.
 
     Returns:
         Flask application instance
     """
     app = Flask(__name__)
-    metrics = PrometheusMetrics(app)  # noqa: F841
+    if include_metrics:
+        metrics = PrometheusMetrics(app)  # noqa: F841
+        register_collectors()
 
     if include_dashboard:
-
-        @app.route("/", methods=["GET"])
-        def dashboard_route():
-            return dashboard()
-
-        @app.route("/clients/<client_id>", methods=["GET"])
-        def user_details(client_id):
-            return client_details(client_id)
-
-        @app.route("/silence/<client_id>", methods=["POST"])
-        def silence(client_id):
-            return silence_client(client_id)
+        _add_dashboard_routes(app)
 
     if include_api:
 
         @app.route("/alive", methods=["POST"])
         def alive_route():
-            return alive()
+            return admitted_alive()
+
+        @app.route("/api/v1/replication", methods=["POST"])
+        def replication_route():
+            return replicate()
+
+    @app.route("/ready", methods=["GET"])
+    def ready_route():
+        return ready()
 
     @app.before_request
     def log_request_wrapper():
@@ -58,69 +86,371 @@ def create_app(include_api: bool = True, include_dashboard: bool = True) -> Flas
     return app
 
 
+def _add_dashboard_routes(app: Flask):
+    """Add the dashboard and the read-only status endpoints to the app."""
+
+    @app.route("/", methods=["GET"])
+    def dashboard_route():
+        return dashboard()
+
+    @app.route("/clients/<client_id>", methods=["GET"])
+    def user_details(client_id):
+        return client_details(client_id)
+
+    @app.route("/silence/<client_id>", methods=["POST"])
+    def silence(client_id):
+        return silence_client(client_id)
+
+    @app.route("/api/v1/clients", methods=["GET"])
+    def clients_api_route():
+        return clients_api()
+
+    @app.route("/api/v1/summary", methods=["GET"])
+    def summary_api_route():
+        return summary_api()
+
+    @app.route("/events", methods=["GET"])
+    def events_route():
+        return events()
+
+    @app.route("/api/v1/admin/silence", methods=["POST"])
+    def bulk_silence_route():
+        return bulk_silence()
+
+    @app.route("/api/v1/admin/profile", methods=["POST", "DELETE"])
+    def profile_route():
+        return profile()
+
+
+def get_client_data(clientid):
+    """Return a dict with the raw state of a client."""
+    with AlerterState(clientid) as client_state:
+        return {
+            "client_id": clientid,
+            "client_name": config["watch"]["clients"][clientid].get("name", ""),
+            "status": client_state.status(),
+            "last_heartbeat": client_state.last_alert_datetime(),
+            "is_silenced": client_state.is_silenced(),
+            "silenced_until": client_state.get_silenced_until(),
+            "last_notification": client_state.last_notify_datetime(),
+            "labels": dict(config["watch"]["clients"][clientid].get("labels") or {}),
+        }
+
+
 def get_client_details(clientid):
-    """Return a dict with various details about a client."""
+    """Return a dict with various details about a client, formatted for humans."""
     now = now_datetime()
-    with AlerterState(clientid) as state:
-        last_alert = state.last_alert_datetime()
-        alert_time = timeago.format(last_alert, now) if last_alert is not None else "never"
-        silenced_until = state.get_silenced_until()
-        remaining_silence = (
+    data = get_client_data(clientid)
+    last_alert = data["last_heartbeat"]
+    silenced_until = data["silenced_until"]
+    return {
+        "client_id": clientid,
+        "client_name": data["client_name"],
+        "status": data["status"],
+        "alert_time": timeago.format(last_alert, now) if last_alert is not None else "never",
+        "is_silenced": data["is_silenced"],
+        "silenced_until": silenced_until.isoformat() if silenced_until is not None else None,
+        "remaining_silence": (
             timeago.format(silenced_until, now) if silenced_until is not None else "never"
+        ),
+    }
+
+
+def _timestamp(value: Optional[datetime.datetime]) -> Optional[float]:
+    """Convert an optional datetime to a unix timestamp."""
+    return value.timestamp() if value is not None else None
+
+
+def clients_api():
+    """Stream the state of the clients as newline-delimited JSON.
+
+    With the "since" query parameter, only the clients whose state changed after that cursor are
+    returned. The cursor for the next query is returned in the "X-Cursor" header. A cursor of a
+    previous process, e.g. before a restart, cannot be compared to the current revisions: all the
+    clients are returned then, and the "X-Full-Resync" header is set.
+    """
+    index = state["index"]
+    headers = {}
+    since = request.args.get("since")
+    revision = None
+    if since is not None:
+        epoch, _, digits = since.rpartition("-")
+        # Not isdigit(), which accepts digits that int() does not parse, such as "²".
+        if not (digits.isascii() and digits.isdecimal()):
+            return 'Parameter "since" must be a cursor returned in "X-Cursor".', 400
+        if epoch == index.epoch:
+            revision = int(digits)
+        else:
+            headers["X-Full-Resync"] = "true"
+    if revision is None:
+        cursor = index.revision
+        _, clientids = index.page(sort="client_id")
+    else:
+        cursor, clientids = index.changed_since(revision)
+    headers["X-Cursor"] = f"{index.epoch}-{cursor}"
+
+    def generate():
+        for clientid in clientids:
+            data = get_client_data(clientid)
+            for key in ("last_heartbeat", "silenced_until", "last_notification"):
+                data[key] = _timestamp(data[key])
+            yield json.dumps(data) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers=headers,
+    )
+
+
+def summary_api():
+    """Return the number of clients by status.
+
+    The counts are maintained incrementally by the status index so this does not depend on the
+    size of the fleet.
+    """
+    return state["index"].counts()
+
+
+def server_threads(app) -> int:
+    """Return the number of threads of the waitress server serving an app.
+
+    Every event stream holds on to a thread for as long as the browser is connected, so the
+    servers of the dashboard get a thread per stream on top of SERVER_THREADS: the streams never
+    take the threads serving the heartbeats.
+    """
+    if isinstance(app, Flask) and "events_route" in app.view_functions:
+        return SERVER_THREADS + config["max_event_streams"]
+    return SERVER_THREADS
+
+
+def events():
+    """Push client status changes to the dashboard as Server-Sent Events.
+
+    Each "status" event carries the same fields as the dashboard rows for the client that changed.
+    A "reset" event tells the browser to reload the page because it fell behind. When too many
+    streams are open, a single "poll" event tells the browser to reload the clients every
+    "interval" seconds instead.
+    """
+    subscription = state["index"].subscribe(limit=config["max_event_streams"])
+    if subscription is None:
+        return Response(
+            f"event: poll\ndata: {json.dumps({'interval': POLL_INTERVAL})}\n\n",
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
         )
-        status = "up" if not state.is_down() else "down"
-        if last_alert is None:
-            status = "unknown"
-        client_name = config["watch"]["clients"][clientid].get("name", "")
-        return {
-            "client_id": clientid,
-            "client_name": client_name,
-            "status": status,
-            "alert_time": alert_time,
-            "is_silenced": state.is_silenced(),
-            "silenced_until": state.get_silenced_until_iso_str(),
-            "remaining_silence": remaining_silence,
-        }
+
+    def generate():
+        try:
+            # Sent right away so that the headers are flushed to the browser.
+            yield f"retry: {EVENT_STREAM_KEEPALIVE * 1000}\n\n"
+            while True:
+                if subscription.overflowed and subscription.events.empty():
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                try:
+                    event = subscription.events.get(timeout=EVENT_STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                data = get_client_details(event["client_id"])
+                data["previous_status"] = event["previous_status"]
+                data["was_silenced"] = event["was_silenced"]
+                yield f"id: {event['revision']}\nevent: status\ndata: {json.dumps(data)}\n\n"
+        finally:
+            state["index"].unsubscribe(subscription)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
 
 
 def dashboard():
-    """Endpoint for the COS Alerter dashboard."""
-    clients = [get_client_details(clientid) for clientid in AlerterState.clients()]
-    return render_template("dashboard.html", clients=clients)
+    """Endpoint for the COS Alerter dashboard.
 
+    Supports the query parameters "status" (up, down, unknown or silenced), "q" (search in the
+    client names and IDs), "sort" (name, client_id or status), "order" (asc or desc), "page" and
+    "per_page". Only the clients of the requested page are formatted.
+    """
+    params = request.args
+    status = params.get("status") or None
+    if status is not None and status not in FILTERS:
+        return f"Invalid status filter. Must be one of: {', '.join(FILTERS)}.", 400
+    sort = params.get("sort", "name")
+    if sort not in SORT_KEYS:
+        return f"Invalid sort key. Must be one of: {', '.join(SORT_KEYS)}.", 400
+    order = params.get("order", "asc")
+    if order not in ("asc", "desc"):
+        return 'Invalid order. Must be "asc" or "desc".', 400
+    page = params.get("page", 1, type=int)
+    per_page = params.get("per_page", DEFAULT_PAGE_SIZE, type=int)
+    if page < 1 or not 1 <= per_page <= MAX_PAGE_SIZE:
+        return f"Invalid page. per_page must be between 1 and {MAX_PAGE_SIZE}.", 400
+    search = params.get("q") or None
+
+    total, clientids = state["index"].page(
+        status=status,
+        search=search,
+        sort=sort,
+        reverse=order == "desc",
+        offset=(page - 1) * per_page,
+        limit=per_page,
+    )
+    clients = [get_client_details(clientid) for clientid in clientids]
+    counts = {key: state["index"].count(key) for key in FILTERS}
+    return render_template(
+        "dashboard.html",
+        clients=clients,
+        counts=counts,
+        total=total,
+        page=page,
+        pages=max((total + per_page - 1) // per_page, 1),
+        query={
+            key: value
+            for key, value in (
+                ("status", status),
+                ("q", search),
+                ("sort", sort),
+                ("order", order),
+                ("per_page", per_page),
+            )
+            if value is not None
+        },
+    )
 
-def alive():
-    """Endpoint for Alertmanager instances to send their heartbeat alerts."""
-    # TODO Decide if we should validate the request.
+
+def admitted_alive():
+    """Handle a heartbeat, unless admission control rejects it."""
+    if not config["admission"]["enabled"]:
+        return alive()
+    clientid, error = authenticate_heartbeat()
+    # Unauthenticated heartbeats are admitted without a client, see admission.py.
+    admitted_client = clientid if error is None else None
+    with admission.controller.admit(admitted_client, request.environ) as rejection:
+        if rejection is not None:
+            # Counted in cos_alerter_admission_rejected: a warning for each one would flood the
+            # logs when overloaded.
+            logger.debug("Rejected heartbeat of %s: %s.", clientid, rejection)
+            status = 429 if rejection == "duplicate" else 503
+            retry_after = str(admission.retry_after())
+            return f"Heartbeat rejected: {rejection}.", status, {"Retry-After": retry_after}
+        return alive((clientid, error))
+
+
+def authenticate_heartbeat() -> Tuple[Optional[str], Optional[str]]:
+    """Find the client sending a heartbeat and check its key.
+
+    Returns:
+        The client ID if it was provided once, and why the heartbeat is invalid, if it is:
+        "missing" or "repeated" parameters, "unknown_client" or "unauthorized".
+    """
     params = request.args
     clientid_list = params.getlist("clientid")  # params is a werkzeug.datastructures.MultiDict
     key_list = params.getlist("key")
-
     if len(clientid_list) < 1 or len(key_list) < 1:
+        return None, "missing"
+    if len(clientid_list) > 1 or len(key_list) > 1:
+        return None, "repeated"
+    clientid = clientid_list[0]
+    if clientid not in config["watch"]["clients"]:
+        return clientid, "unknown_client"
+    # Hash the key and compare with the stored hashed key
+    if not _is_key_correct(clientid, key_list[0]):
+        return clientid, "unauthorized"
+    return clientid, None
+
+
+def alive(authentication: Optional[Tuple[Optional[str], Optional[str]]] = None):
+    """Endpoint for Alertmanager instances to send their heartbeat alerts.
+
+    Args:
+        authentication: The result of authenticate_heartbeat(), if it was already called.
+    """
+    # TODO Decide if we should validate the request.
+    clientid, error = authentication or authenticate_heartbeat()
+    if error == "missing":
         logger.warning("Request %s is missing clientid or key.", request.url)
+        HEARTBEAT_RESULTS["bad_request"].inc()
         return 'Parameters "clientid" and "key" are required.', 400
-    if len(clientid_list) > 1 or len(key_list) > 1:
+    if error == "repeated":
         logger.warning("Request %s specified clientid or key more than once.", request.url)
+        HEARTBEAT_RESULTS["bad_request"].inc()
         return 'Parameters "clientid" and "key" should be provided exactly once.', 400
-    clientid = clientid_list[0]
-    key = key_list[0]
-
-    # Find the client with the specified clientid
-    client_info = config["watch"]["clients"].get(clientid)
-    if not client_info:
+    if error == "unknown_client":
         logger.warning("Request %s specified an unknown clientid.", request.url)
+        HEARTBEAT_RESULTS["unknown_client"].inc()
         return 'Clientid {params["clientid"]} not found. ', 404
-
-    # Hash the key and compare with the stored hashed key
-    if not _is_key_correct(clientid, key):
+    if error == "unauthorized" or clientid is None:
         logger.warning("Request %s provided an incorrect key.", request.url)
+        HEARTBEAT_RESULTS["unauthorized"].inc()
         return "Incorrect key for the specified clientid.", 401
-    logger.info("Received alert from Alertmanager clientid: %s.", clientid)
-    with AlerterState(clientid) as state:
-        state.reset_alert_timeout()
+    result = apply_heartbeat(clientid)
+    if result == "unavailable":
+        HEARTBEAT_RESULTS["unavailable"].inc()
+        return "Handed off to a new process, retry.", 503, {"Retry-After": "1"}
+    if result == "applied":
+        logger.info("Received alert from Alertmanager clientid: %s.", clientid)
+    HEARTBEAT_RESULTS["accepted"].inc()
     return "Success!"
 
 
+def apply_heartbeat(clientid: str) -> str:
+    """Record an authenticated heartbeat of a client.
+
+    Returns:
+        "applied", "coalesced" if it was a repeat heartbeat applied without locking the client
+        (see coalesce_heartbeat()), or "unavailable" if the state was handed off to a new process.
+    """
+    arrival = state["clock"].monotonic()
+    table = state.get("heartbeat_table")
+    if table is not None:
+        # In an API worker, the daemon process applies the heartbeat.
+        table.record(clientid, arrival)
+        return "applied"
+    if coalesce_heartbeat(clientid, arrival):
+        COALESCED_HEARTBEATS.inc()
+        record_heartbeat(clientid, arrival)
+        return "coalesced"
+    with AlerterState(clientid) as client_state:
+        # Checked under the lock so that no heartbeat is applied after the snapshot is taken.
+        if state["handed_off"]:
+            return "unavailable"
+        client_state.reset_alert_timeout()
+        record_heartbeat(clientid, client_state.data["alert_time"])
+    return "applied"
+
+
+def ready():
+    """Endpoint for readiness probes.
+
+    Fails when the checks of the clients run late or when some clients are not checked anymore,
+    so that an overloaded or broken instance is noticed before it misses a notification.
+    """
+    if "heartbeat_table" in state:
+        return _worker_ready(state["heartbeat_table"])
+    health = checker_health()
+    stalled = health["stalled"]
+    is_ready = health["max_lag"] <= config["max_check_lag"] and not stalled
+    body = {
+        "ready": is_ready,
+        "max_lag_seconds": health["max_lag"],
+        "stalled_clients": len(stalled),
+        # Only a few of the stalled clients, the list could be huge.
+        "stalled_examples": stalled[:10],
+    }
+    return body, 200 if is_ready else 503
+
+
+def _worker_ready(table):
+    """Readiness of an API worker, which is that of the daemon process it reports to."""
+    is_ready, age = table.checker_status(state["clock"].monotonic())
+    # The daemon process publishes its readiness every second.
+    is_ready = is_ready and age <= config["max_check_lag"]
+    return {"ready": is_ready, "checker_status_age_seconds": age}, 200 if is_ready else 503
+
+
 def _is_key_correct(clientid: str, key: Optional[str]) -> bool:
     """Check the provided client key.
 
@@ -133,11 +463,41 @@ def _is_key_correct(clientid: str, key: Optional[str]) -> bool:
     return hmac.compare_digest(stored_hash, client_hash)
 
 
+def _is_admin_request() -> bool:
+    """Check the admin key provided as a bearer token.
+
+    It assumes that an admin key is configured.
+    """
+    scheme, _, key = request.headers.get("Authorization", "").partition(" ")
+    if scheme != "Bearer" or not key:
+        return False
+    client_hash = hashlib.sha512(key.encode()).hexdigest()
+    return hmac.compare_digest(config["admin_key"], client_hash)
+
+
+def admin_endpoint(func):
+    """Decorator for endpoints requiring the admin key."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if config["admin_key"] is None:
+            return "The admin API is disabled.", 403
+        if not _is_admin_request():
+            return "Invalid credentials", 401
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 def client_details(client_id):
     """Return a page with client-level features."""
     if client_id not in config["watch"]["clients"]:
         return f"Clientid {client_id} not found.", 404
-    return render_template("client-details.html", client=get_client_details(client_id))
+    with AlerterState(client_id) as client_state:
+        heartbeats = client_state.heartbeat_stats()
+    return render_template(
+        "client-details.html", client=get_client_details(client_id), heartbeats=heartbeats
+    )
 
 
 def silence_client(client_id):
@@ -153,15 +513,108 @@ def silence_client(client_id):
     if silence_period_h is None:
         return "Invalid silence period.", 400
 
-    now = datetime.datetime.now(datetime.timezone.utc)
+    now = state["clock"].now()
     silence_until = now + datetime.timedelta(hours=silence_period_h)
-    with AlerterState(client_id) as state:
-        state.silence_until(silence_until)
+    with AlerterState(client_id) as client_state:
+        client_state.silence_until(silence_until)
     return redirect("/")
 
 
+@admin_endpoint
+def bulk_silence():
+    """Endpoint for silencing all the clients matching a label selector.
+
+    Expects a JSON body such as {"selector": "region=eu,env=prod", "duration_h": 5}. A duration of
+    0 removes the silences. The silences are saved in a single write.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    try:
+        matchers = LabelIndex.parse_selector(body.get("selector") or "")
+    except (AttributeError, ValueError):
+        return 'Parameter "selector" must be of the form "key1=value1,key2=value2".', 400
+    silence_period_h = body.get("duration_h")
+    # Not isinstance(), which accepts booleans: bool is a subclass of int.
+    if type(silence_period_h) is not int or silence_period_h < 0:
+        return 'Parameter "duration_h" must be a non-negative integer.', 400
+
+    silence_until = None
+    if silence_period_h > 0:
+        now = state["clock"].now()
+        silence_until = now + datetime.timedelta(hours=silence_period_h)
+    clientids = sorted(config["label_index"].select(matchers))
+    AlerterState.silence_clients(clientids, silence_until)
+    logger.info("Silenced %d client(s) matching %s.", len(clientids), body["selector"])
+    return {
+        "clients": clientids,
+        "silenced_until": silence_until.isoformat() if silence_until is not None else None,
+    }
+
+
+@admin_endpoint
+def profile():
+    """Endpoint starting (POST) or stopping (DELETE) a profile of the daemon.
+
+    The duration of the profile defaults to the "profile_duration" config value and can be set
+    with a JSON body such as {"duration_s": 60}.
+    """
+    if request.method == "DELETE":
+        profiler.stop()
+        return {"running": False}
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    duration = body.get("duration_s", config["profile_duration"])
+    if not isinstance(duration, (int, float)) or not 0 < duration <= MAX_DURATION:
+        return f'Parameter "duration_s" must be a number between 0 and {MAX_DURATION}.', 400
+    paths = profiler.start(config["base_dir"], duration)
+    if paths is None:
+        return "A profile is already running.", 409
+    return {"running": True, "files": {kind: str(path) for kind, path in paths.items()}}, 202
+
+
+def replicate():
+    """Endpoint receiving the heartbeats of the peers.
+
+    The body is a JSON object like {"heartbeats": {"<clientid>": <unix timestamp>}} and the
+    request is authenticated with the peer key as a bearer token, whose hash is the replication
+    key.
+    """
+    key = config["replication"]["key"]
+    if not key:
+        return "Replication is disabled.", 403
+    if state["handed_off"]:
+        # The peer keeps the batch and sends it again, to the new process.
+        return "Handed off to a new process, retry.", 503
+    scheme, _, provided = request.headers.get("Authorization", "").partition(" ")
+    if scheme != "Bearer" or not provided:
+        return "Invalid credentials", 401
+    provided_hash = hashlib.sha512(provided.encode()).hexdigest()
+    if not hmac.compare_digest(key, provided_hash):
+        return "Invalid credentials", 401
+    body = request.get_json(silent=True)
+    heartbeats = body.get("heartbeats") if isinstance(body, dict) else None
+    if not isinstance(heartbeats, dict) or not all(
+        _is_timestamp(timestamp) for timestamp in heartbeats.values()
+    ):
+        return 'Parameter "heartbeats" must map client IDs to timestamps.', 400
+    return merge(heartbeats)
+
+
+def _is_timestamp(value) -> bool:
+    """Check that a JSON value is a finite number.
+
+    JSON parsing accepts NaN and Infinity. A NaN heartbeat would keep its client up forever.
+    """
+    # Not isinstance(), which accepts booleans: bool is a subclass of int.
+    return type(value) in (int, float) and math.isfinite(value)
+
+
 def log_request():
-    """Log every HTTP request."""
+    """Log every HTTP request except heartbeats, which alive() logs once handled."""
+    if request.path == "/alive":
+        return
     logger.info(
         "Request: %s %s",
         request.method,
@@ -0,0 +1,85 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Persistence of the silences."""
+
+import datetime
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SilenceStore:
+    """Store the silences of all the clients in a single file.
+
+    Any number of silences can be changed with a single write. The file is replaced atomically so
+    it is never left half written.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._silences: Dict[str, datetime.datetime] = {}
+
+    def load(self, clientids: Iterable[str]) -> Dict[str, datetime.datetime]:
+        """Load the silences from the disk.
+
+        Silences saved in a "<client_id>.silenced" file by older versions are migrated.
+
+        Returns:
+            The end of the silence for each silenced client.
+        """
+        clientids = set(clientids)
+        silences = {}
+        if self.path.exists():
+            with self.path.open() as f:
+                silences = json.load(f)
+
+        legacy_files = []
+        for clientid in clientids:
+            legacy_path = self.path.parent / f"{clientid}.silenced"
+            if legacy_path.exists():
+                with legacy_path.open() as f:
+                    silences.setdefault(clientid, json.load(f))
+                legacy_files.append(legacy_path)
+
+        with self._lock:
+            self._silences = {
+                clientid: datetime.datetime.fromisoformat(silenced_until)
+                for clientid, silenced_until in silences.items()
+                if clientid in clientids and silenced_until is not None
+            }
+            if legacy_files:
+                logger.info("Migrating %d silence(s) to %s.", len(legacy_files), self.path)
+                self._save()
+                for legacy_path in legacy_files:
+                    legacy_path.unlink()
+            return dict(self._silences)
+
+    def update(self, silences: Dict[str, Optional[datetime.datetime]]):
+        """Set or clear (with None) the silences of some clients and save them."""
+        with self._lock:
+            for clientid, silenced_until in silences.items():
+                if silenced_until is None:
+                    self._silences.pop(clientid, None)
+                else:
+                    self._silences[clientid] = silenced_until
+            self._save()
+
+    def _save(self):
+        """Write the silences to the disk. Must be called with the lock held."""
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(
+                {
+                    clientid: silenced_until.isoformat()
+                    for clientid, silenced_until in self._silences.items()
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,132 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Constant memory statistics about the heartbeats of a client."""
+
+import math
+from array import array
+from typing import Dict, List, Optional
+
+# Gaps are bucketed on a logarithmic scale between MIN_GAP and MIN_GAP * GAMMA ** BUCKETS
+# (about 4 days), which bounds the relative error of the quantiles to about 6%.
+MIN_GAP = 0.1
+GAMMA = 1.125
+BUCKETS = 128
+_LOG_GAMMA = math.log(GAMMA)
+
+# When the sketch holds this many gaps, all the counts are halved so that recent gaps weigh more
+# than old ones.
+DECAY_THRESHOLD = 1024
+
+RECENT_ARRIVALS = 32
+
+
+class GapSketch:
+    """Logarithmic histogram of inter-arrival gaps used to estimate quantiles.
+
+    The buckets are preallocated so recording a gap does not allocate.
+    """
+
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = array("L", bytes(BUCKETS * array("L").itemsize))
+        self.total = 0
+
+    def add(self, gap: float):
+        """Record a gap in seconds."""
+        if gap <= MIN_GAP:
+            bucket = 0
+        else:
+            bucket = min(int(math.log(gap / MIN_GAP) / _LOG_GAMMA), BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.total += 1
+        if self.total >= DECAY_THRESHOLD:
+            self._decay()
+
+    def _decay(self):
+        """Halve all the counts."""
+        total = 0
+        for bucket in range(BUCKETS):
+            self.counts[bucket] >>= 1
+            total += self.counts[bucket]
+        self.total = total
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return an estimate of a quantile of the gaps, or None if there is no data."""
+        if self.total == 0:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bucket in range(BUCKETS):
+            seen += self.counts[bucket]
+            if seen >= rank and self.counts[bucket]:
+                # Geometric middle of the bucket.
+                return MIN_GAP * GAMMA ** (bucket + 0.5)
+        return MIN_GAP * GAMMA ** (BUCKETS - 0.5)  # pragma: no cover
+
+
+class HeartbeatStats:
+    """Streaming statistics about the heartbeats of one client.
+
+    Keeps a ring buffer of the most recent arrival times, a quantile sketch of the gaps between
+    arrivals and exponentially weighted moving averages of the gap and of its deviation (jitter).
+    The memory used does not grow with the number of heartbeats.
+    """
+
+    __slots__ = ("arrivals", "position", "count", "last_gap", "mean_gap", "jitter", "sketch")
+
+    # Weight of the latest gap in the moving averages.
+    ALPHA = 0.125
+
+    def __init__(self):
+        self.arrivals = array("d", bytes(RECENT_ARRIVALS * array("d").itemsize))
+        self.position = 0
+        self.count = 0
+        self.last_gap = None
+        self.mean_gap = None
+        self.jitter = 0.0
+        self.sketch = GapSketch()
+
+    def record(self, arrival: float):
+        """Record a heartbeat received at `arrival` (monotonic seconds)."""
+        if self.count:
+            previous = self.arrivals[(self.position - 1) % RECENT_ARRIVALS]
+            gap = arrival - previous
+            self.last_gap = gap
+            if self.mean_gap is None:
+                self.mean_gap = gap
+            else:
+                self.jitter += self.ALPHA * (abs(gap - self.mean_gap) - self.jitter)
+                self.mean_gap += self.ALPHA * (gap - self.mean_gap)
+            self.sketch.add(gap)
+        self.arrivals[self.position] = arrival
+        self.position = (self.position + 1) % RECENT_ARRIVALS
+        self.count += 1
+
+    def last_arrival(self) -> Optional[float]:
+        """Return the arrival time of the last heartbeat recorded, if any."""
+        if not self.count:
+            return None
+        return self.arrivals[(self.position - 1) % RECENT_ARRIVALS]
+
+    def recent_gaps(self) -> List[float]:
+        """Return the gaps between the most recent arrivals, oldest first."""
+        size = min(self.count, RECENT_ARRIVALS)
+        start = self.position - size
+        arrivals = [self.arrivals[i % RECENT_ARRIVALS] for i in range(start, self.position)]
+        return [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        """Return the statistics as a dict."""
+        recent_gaps = self.recent_gaps()
+        return {
+            "count": self.count,
+            "recent_max_gap": max(recent_gaps) if recent_gaps else None,
+            "last_gap": self.last_gap,
+            "mean_gap": self.mean_gap,
+            "jitter": self.jitter if self.mean_gap is not None else None,
+            "p50": self.sketch.quantile(0.5),
+            "p90": self.sketch.quantile(0.9),
+            "p99": self.sketch.quantile(0.99),
+        }
@@ -0,0 +1,246 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""API worker processes sharing the heartbeats through memory.
+
+With "api_workers" set, several processes serve /alive on the same address (SO_REUSEPORT lets the
+kernel spread the connections between them) so that receiving heartbeats is not limited to one
+core by the GIL. Workers do not hold the state of the clients. They write the time of each
+heartbeat to a table in shared memory, which the main process reads to update the clients.
+"""
+
+import logging
+import mmap
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+import waitress
+
+from .alerter import AlerterState, checker_health, config, state
+from .metrics import HEARTBEAT_RESULTS
+from .replication import record_heartbeat
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two reads of the heartbeat table by the main process.
+INGEST_INTERVAL = 0.1
+# Number of slots compared at once when looking for new heartbeats.
+CHUNK = 64
+# How often the main process publishes its readiness for the workers, in seconds.
+READINESS_INTERVAL = 1.0
+
+_RESULTS = tuple(HEARTBEAT_RESULTS)
+
+
+class SharedCounter:
+    """A counter in shared memory, incremented by a single process."""
+
+    def __init__(self, values: memoryview, index: int):
+        self._values = values
+        self._index = index
+
+    def inc(self, amount: float = 1):
+        """Increment the counter."""
+        self._values[self._index] += int(amount)
+
+
+class HeartbeatTable:
+    """Heartbeats of the clients in shared memory.
+
+    The memory is mapped before forking the workers, so that all the processes share it. Each
+    worker has its own row of slots, one per client, holding the number of heartbeats it received
+    and the monotonic time of the last one (CLOCK_MONOTONIC is shared by all the processes). Each
+    slot is written by a single process, so no update is lost. Each worker also has its own row of
+    heartbeat result counters, and the main process publishes whether it is ready.
+
+    Layout, in native 8 bytes words:
+        checker time (f64), checker ready (u64),
+        result counters (u64, one row per worker),
+        heartbeat counts (u64, one row of clients per worker),
+        heartbeat times (f64, one row of clients per worker)
+    """
+
+    def __init__(self, clientids: Iterable[str], workers: int):
+        self.clientids = list(clientids)
+        self.slots = {clientid: slot for slot, clientid in enumerate(self.clientids)}
+        clients = len(self.clientids)
+        results = workers * len(_RESULTS)
+        slots = workers * clients
+        self._map = mmap.mmap(-1, 8 * (2 + results + 2 * slots))
+        words = memoryview(self._map)
+        self._checker_time = words[0:8].cast("d")
+        self._checker_ready = words[8:16].cast("Q")
+        offset = 16
+        self._results = words[offset : offset + 8 * results].cast("Q")
+        offset += 8 * results
+        self._counts_bytes = words[offset : offset + 8 * slots]
+        self._counts = self._counts_bytes.cast("Q")
+        offset += 8 * slots
+        self._times = words[offset : offset + 8 * slots].cast("d")
+        self._seen = bytes(8 * slots)
+        self._results_seen = [0] * len(_RESULTS)
+        self._row = 0
+
+    def set_worker(self, worker: int):
+        """Write the heartbeats of this process to the row of `worker`. Called by each worker."""
+        self._row = worker * len(self.clientids)
+
+    def record(self, clientid: str, arrival: float):
+        """Record a heartbeat. Called by the workers."""
+        slot = self._row + self.slots[clientid]
+        # The time is written before the count so that a new count comes with its time.
+        self._times[slot] = arrival
+        self._counts[slot] += 1
+
+    def worker_counters(self, worker: int) -> Dict[str, SharedCounter]:
+        """Return the heartbeat result counters of a worker."""
+        return {
+            result: SharedCounter(self._results, worker * len(_RESULTS) + i)
+            for i, result in enumerate(_RESULTS)
+        }
+
+    def changes(self) -> List[Tuple[str, float]]:
+        """Return the clients that sent heartbeats since the last call, with the latest time.
+
+        Called by the main process. Whole chunks of counts are compared at once, so that looking
+        for changes among many idle clients is cheap.
+        """
+        counts = bytes(self._counts_bytes)
+        if counts == self._seen:
+            return []
+        changed = {}
+        for start in range(0, len(counts), 8 * CHUNK):
+            end = start + 8 * CHUNK
+            if counts[start:end] == self._seen[start:end]:
+                continue
+            for slot in range(start // 8, min(end, len(counts)) // 8):
+                if counts[8 * slot : 8 * slot + 8] != self._seen[8 * slot : 8 * slot + 8]:
+                    # Several workers may have received heartbeats of the client.
+                    clientid = self.clientids[slot % len(self.clientids)]
+                    changed[clientid] = max(changed.get(clientid, 0.0), self._times[slot])
+        self._seen = counts
+        return list(changed.items())
+
+    def result_deltas(self) -> Dict[str, int]:
+        """Return the heartbeat results counted by all the workers since the last call."""
+        deltas = {}
+        for i, result in enumerate(_RESULTS):
+            total = sum(self._results[i :: len(_RESULTS)])
+            deltas[result] = total - self._results_seen[i]
+            self._results_seen[i] = total
+        return deltas
+
+    def set_checker_status(self, now: float, ready: bool):
+        """Publish the readiness of the main process to the workers."""
+        self._checker_ready[0] = 1 if ready else 0
+        self._checker_time[0] = now
+
+    def checker_status(self, now: float) -> Tuple[bool, float]:
+        """Return whether the main process is ready and how long ago it said so."""
+        return bool(self._checker_ready[0]), now - self._checker_time[0]
+
+
+def ingest(table: HeartbeatTable):
+    """Apply the heartbeats received by the workers to the clients."""
+    for clientid, arrival in table.changes():
+        with AlerterState(clientid) as client_state:
+            client_state.reset_alert_timeout(arrival)
+        record_heartbeat(clientid, arrival)
+    for result, delta in table.result_deltas().items():
+        if delta:
+            HEARTBEAT_RESULTS[result].inc(delta)
+
+
+def ingest_loop(table: HeartbeatTable):
+    """Read the heartbeat table forever. Run by the main process."""
+    clock = state["clock"]
+    next_readiness = 0.0
+    while True:
+        try:
+            ingest(table)
+            now = clock.monotonic()
+            if now >= next_readiness:
+                health = checker_health()
+                ready = health["max_lag"] <= config["max_check_lag"] and not health["stalled"]
+                table.set_checker_status(now, ready)
+                next_readiness = now + READINESS_INTERVAL
+        except Exception:  # pragma: no cover
+            logger.exception("Error while reading the heartbeats of the API workers.")
+        clock.sleep(INGEST_INTERVAL)
+
+
+def reuseport_socket(listen_addr: str) -> socket.socket:
+    """Return a socket bound to "HOST:PORT" that other processes can bind too."""
+    host, _, port = listen_addr.rpartition(":")
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+        host.strip("[]"), int(port), type=socket.SOCK_STREAM
+    )[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(sockaddr)
+    return sock
+
+
+def _exit_with_parent(parent: int):
+    """Exit when the main process is gone."""
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+def run_worker(app, table: HeartbeatTable, worker: int, listen_addr: str):  # pragma: no cover
+    """Serve /alive from a worker process. Never returns.
+
+    This runs in forked processes so it is not seen by the coverage of the tests.
+    """
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    for signum in (signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, signal.SIG_IGN)
+    try:
+        table.set_worker(worker)
+        state["heartbeat_table"] = table
+        HEARTBEAT_RESULTS.update(table.worker_counters(worker))
+        threading.Thread(target=_exit_with_parent, args=(os.getppid(),), daemon=True).start()
+        waitress.serve(
+            app, sockets=[reuseport_socket(listen_addr)], clear_untrusted_proxy_headers=True
+        )
+    except BaseException:
+        logger.exception("API worker %d failed.", worker)
+    finally:
+        os._exit(1)
+
+
+def start_workers(app, table: HeartbeatTable, workers: int, listen_addr: str) -> List[int]:
+    """Fork the API worker processes.
+
+    Must be called before starting any thread, as only the calling thread exists in the workers.
+
+    Returns:
+        The PIDs of the workers.
+    """
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            run_worker(app, table, worker, listen_addr)
+        pids.append(pid)
+    logger.info("Started %d API workers on %s.", workers, listen_addr)
+    return pids
+
+
+def stop_workers(pids: Iterable[int]):
+    """Stop the API worker processes."""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except ChildProcessError:  # pragma: no cover
+            pass
+        except ProcessLookupError:  # pragma: no cover
+            pass
@@ -0,0 +1,145 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Simulation of a fleet of clients on virtual time.
+
+Used by the tests to run COS Alerter through days of heartbeats in a fraction of a second.
+"""
+
+import math
+import random
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import yaml
+from helpers import CONFIG
+
+from cos_alerter.alerter import AlerterState, config, state
+from cos_alerter.clock import VirtualClock
+from cos_alerter.scheduler import Scheduler
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+KEY = CONFIG["watch"]["clients"]["clientid1"]["key"]
+
+DAY = 24 * 60 * 60
+
+
+def heartbeats(
+    period: float,
+    outages: Iterable[Tuple[float, float]] = (),
+    jitter: float = 0.0,
+    seed: Optional[int] = None,
+) -> Iterator[float]:
+    """Generate heartbeat times, in seconds since the start of the simulation.
+
+    Args:
+        period: Time between heartbeats.
+        outages: (start, end) intervals during which no heartbeat is sent.
+        jitter: Maximum random delay added to each heartbeat.
+        seed: Seed of the random delays.
+    """
+    rng = random.Random(seed)
+    outages = sorted(outages)
+    t = 0.0
+    while True:
+        arrival = t + rng.uniform(0, jitter)
+        if not any(start <= arrival < end for start, end in outages):
+            yield arrival
+        t += period
+
+
+class FleetSimulation:
+    """Drive COS Alerter through virtual time.
+
+    Heartbeats are handled like the /alive endpoint handles them and each client is checked every
+    second like client_loop() does, except that the checks which can not change anything are
+    skipped. Notifications are recorded instead of being sent.
+
+    Must be used with the fake_fs fixture.
+    """
+
+    def __init__(self, patterns: Dict[str, Iterable[float]], watch: Optional[dict] = None):
+        with open("/etc/cos-alerter.yaml", "w") as f:
+            f.write(
+                yaml.dump(
+                    {
+                        "watch": {
+                            "down_interval": "5m",
+                            "wait_for_first_connection": True,
+                            **(watch or {}),
+                            "clients": {clientid: {"key": KEY} for clientid in patterns},
+                        },
+                        "notify": {"destinations": [], "repeat_interval": "1h"},
+                    }
+                )
+            )
+        config.reload()
+        self.clock = VirtualClock(START)
+        AlerterState.initialize(clock=self.clock, dispatcher=self._record)
+        self.start_time = self.clock.monotonic()
+
+        # (elapsed seconds, client) of the notifications sent and of the heartbeats received.
+        self.notifications: List[Tuple[float, str]] = []
+        self.received: Dict[str, List[float]] = {clientid: [] for clientid in patterns}
+
+        self._patterns = {clientid: iter(pattern) for clientid, pattern in patterns.items()}
+        self._events = Scheduler(self._handle, self.clock)
+        for clientid in patterns:
+            self._schedule_heartbeat(clientid)
+            with AlerterState(clientid) as client_state:
+                self._schedule_check(clientid, client_state.next_deadline())
+
+    def elapsed(self) -> float:
+        """Return the virtual time since the start of the simulation."""
+        return self.clock.monotonic() - self.start_time
+
+    def run(self, duration: float):
+        """Run the simulation for `duration` seconds of virtual time."""
+        end = self.start_time + duration
+        schedulers = (self._events, state["timers"])
+        while True:
+            deadlines = [s.next_deadline() for s in schedulers]
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            if not deadlines or min(deadlines) > end:
+                break
+            self.clock.set(max(min(deadlines), self.clock.monotonic()))
+            for scheduler in schedulers:
+                scheduler.run_pending()
+        self.clock.set(end)
+
+    def notifications_of(self, clientid: str) -> List[float]:
+        """Return the times of the notifications sent for a client."""
+        return [elapsed for elapsed, notified in self.notifications if notified == clientid]
+
+    def _record(self, dedup_key: str, **kwargs):
+        # The dedup key is "<client_id>-<last_alert_datetime>".
+        clientid = max(
+            (clientid for clientid in self._patterns if dedup_key.startswith(f"{clientid}-")),
+            key=len,
+        )
+        self.notifications.append((self.elapsed(), clientid))
+
+    def _handle(self, events: List[Tuple[str, str]]):
+        for kind, clientid in events:
+            with AlerterState(clientid) as client_state:
+                if kind == "heartbeat":
+                    self.received[clientid].append(self.elapsed())
+                    client_state.reset_alert_timeout()
+                    self._schedule_heartbeat(clientid)
+                else:
+                    client_state.check()
+                self._schedule_check(clientid, client_state.next_deadline())
+
+    def _schedule_heartbeat(self, clientid: str):
+        arrival = next(self._patterns[clientid], None)
+        if arrival is not None:
+            self._events.schedule(("heartbeat", clientid), self.start_time + arrival)
+
+    def _schedule_check(self, clientid: str, deadline: Optional[float]):
+        """Schedule the first check of client_loop() that happens after `deadline`."""
+        if deadline is None:
+            self._events.cancel(("check", clientid))
+            return
+        since_start = max(deadline, self.clock.monotonic()) - self.start_time
+        tick = self.start_time + math.floor(since_start) + 1
+        self._events.schedule(("check", clientid), tick)
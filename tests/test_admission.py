@@ -0,0 +1,140 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import logging
+import time
+import unittest.mock
+from datetime import datetime, timezone
+
+import pytest
+import yaml
+
+from cos_alerter import admission, server
+from cos_alerter.alerter import AlerterState, config
+from cos_alerter.clock import VirtualClock
+from cos_alerter.server import create_app
+
+PARAMS = {"clientid": "clientid1", "key": "clientkey1"}
+
+
+@pytest.fixture
+def flask_client():
+    return create_app(include_metrics=False).test_client()
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+
+
+def enable_admission(**settings):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["admission"] = {"enabled": True, **settings}
+    conf["runtime"] = "asyncio"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+
+
+def test_requires_asyncio_runtime(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["admission"] = {"enabled": True}
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    with pytest.raises(SystemExit):
+        config.reload()
+
+
+def test_parse_request_start():
+    assert admission.parse_request_start("t=1700000000.5") == 1700000000.5
+    assert admission.parse_request_start("1700000000500") == 1700000000.5
+    assert admission.parse_request_start("t=1700000000500000") == 1700000000.5
+    assert admission.parse_request_start("yesterday") is None
+
+
+def test_queue_time():
+    assert admission.queue_time({}) is None
+    assert admission.queue_time({"cos_alerter.request_start": time.monotonic() - 2}) >= 2
+    header = {"HTTP_X_REQUEST_START": f"t={int((time.time() - 3) * 1000)}"}
+    assert 3 <= admission.queue_time(header) < 4
+    assert admission.queue_time({"HTTP_X_REQUEST_START": "t=garbage"}) is None
+
+
+def test_disabled(flask_client, fake_fs, clock):
+    AlerterState.initialize(clock=clock)
+    with admission.controller.admit("clientid1", {}):
+        assert admission.controller.in_flight == 0
+        assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+
+
+def test_overloaded(flask_client, fake_fs, clock, caplog):
+    enable_admission(max_in_flight=1, max_retry_after="10s")
+    AlerterState.initialize(clock=clock)
+    with admission.controller.admit("another-client", {}) as rejection:
+        assert rejection is None
+        caplog.set_level(logging.INFO)
+        response = flask_client.post("/alive", query_string=PARAMS)
+        assert response.status_code == 503
+        assert 1 <= int(response.headers["Retry-After"]) <= 10
+        # Counted rather than logged, there can be many when overloaded.
+        assert not caplog.records
+        # Clients close to their deadline are admitted beyond the limit.
+        clock.advance(250)
+        assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+    assert admission.controller.in_flight == 0
+    # The heartbeat moved the deadline away. The asyncio runtime counts the queued requests too.
+    with admission.controller.admit("clientid1", {"cos_alerter.in_flight": 1}) as rejection:
+        assert rejection == "overloaded"
+    assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+
+
+def test_duplicate(flask_client, fake_fs, clock):
+    enable_admission()
+    AlerterState.initialize(clock=clock)
+    with admission.controller.admit("clientid1", {}):
+        response = flask_client.post("/alive", query_string=PARAMS)
+        assert response.status_code == 429
+        assert "Retry-After" in response.headers
+    assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+
+
+def test_unauthenticated_heartbeats(flask_client, fake_fs, clock):
+    enable_admission(max_in_flight=1)
+    AlerterState.initialize(clock=clock)
+    wrong_key = {"clientid": "clientid1", "key": "wrong"}
+    with admission.controller.admit("clientid1", {}):
+        # A heartbeat with a wrong key does not count as a duplicate of the real one...
+        clock.advance(250)
+        assert flask_client.post("/alive", query_string=wrong_key).status_code == 503
+    # ...nor has priority when the client is close to its deadline.
+    with admission.controller.admit("another-client", {}):
+        assert flask_client.post("/alive", query_string=wrong_key).status_code == 503
+        assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+    assert flask_client.post("/alive", query_string=wrong_key).status_code == 401
+    unknown = {"clientid": "unknown", "key": "clientkey1"}
+    assert flask_client.post("/alive", query_string=unknown).status_code == 404
+
+
+def test_key_checked_once(flask_client, fake_fs, clock):
+    enable_admission()
+    AlerterState.initialize(clock=clock)
+    with unittest.mock.patch(
+        "cos_alerter.server._is_key_correct", wraps=server._is_key_correct
+    ) as check_mock:
+        assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+    check_mock.assert_called_once_with("clientid1", "clientkey1")
+
+
+@unittest.mock.patch("cos_alerter.alerter.handle_pagerduty_incidents")
+def test_queue_time_limit(handle_mock, flask_client, fake_fs, clock):
+    enable_admission(max_queue_time="1s")
+    AlerterState.initialize(clock=clock)
+    headers = {"X-Request-Start": f"t={time.time() - 5}"}
+    response = flask_client.post("/alive", query_string=PARAMS, headers=headers)
+    assert response.status_code == 503
+    # Down clients have priority.
+    clock.advance(400)
+    response = flask_client.post("/alive", query_string=PARAMS, headers=headers)
+    assert response.status_code == 200
@@ -0,0 +1,338 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+import concurrent.futures
+import http.client
+import socket
+import sys
+import threading
+import unittest.mock
+from datetime import datetime, timezone
+
+import pytest
+import yaml
+
+from cos_alerter import aio, handoff
+from cos_alerter.alerter import AlerterState, config, state
+from cos_alerter.clock import VirtualClock
+from cos_alerter.daemon import main
+from cos_alerter.server import create_app
+
+
+def echo_app(environ, start_response):
+    body = environ["wsgi.input"].read()
+    if environ["PATH_INFO"] == "/error":
+        raise RuntimeError("Failed")
+    if environ["PATH_INFO"] == "/stream":
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return iter([b"first ", b"", b"second"])
+    response = f"{environ['REQUEST_METHOD']} {environ['QUERY_STRING']} ".encode() + body
+    start_response("200 OK", [("Content-Length", str(len(response)))])
+    return [response]
+
+
+@pytest.fixture
+def reset_handoff():
+    yield
+    for sock in handoff._listeners.values():
+        sock.close()
+    handoff._listeners.clear()
+    handoff._callbacks.clear()
+
+
+@pytest.fixture
+def serve():
+    """Serve WSGI apps with the asyncio HTTP server from a thread, return the port."""
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    servers = []
+
+    def start(app):
+        server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(
+                aio.HTTPServer(app, executor).handle,
+                "127.0.0.1",
+                0,
+                limit=aio.MAX_HEADER_SIZE,
+            ),
+            loop,
+        ).result()
+        servers.append(server)
+        return server.sockets[0].getsockname()[1]
+
+    async def shutdown():
+        for server in servers:
+            server.close()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    yield start
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    executor.shutdown()
+
+
+def raw_request(port, data):
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(data)
+        response = b""
+        while chunk := sock.recv(65536):
+            response += chunk
+    return response
+
+
+def test_parse_head():
+    assert aio.parse_head(b"GET /?a=b HTTP/1.1\r\nHost: x\r\nX-Key:  value \r\n\r\n") == (
+        "GET",
+        "/?a=b",
+        "HTTP/1.1",
+        [("host", "x"), ("x-key", "value")],
+    )
+    for head in (b"GET /\r\n\r\n", b"GET / HTTP/2\r\n\r\n", b"GET / HTTP/1.1\r\nHost\r\n\r\n"):
+        with pytest.raises(aio.BadRequestError):
+            aio.parse_head(head)
+
+
+def test_make_environ():
+    headers = [
+        ("content-type", "text/plain"),
+        ("content-length", "3"),
+        ("x-forwarded-for", "10.0.0.2"),
+        ("x-forwarded-for", "10.0.0.3"),
+        ("x_forwarded_for", "10.0.0.4"),
+    ]
+    environ = aio.make_environ(
+        "POST", "/a%20b?c=d", "HTTP/1.1", headers, b"abc", ("127.0.0.1", 80), ("10.0.0.1", 1234)
+    )
+    assert environ["PATH_INFO"] == "/a b"
+    assert environ["QUERY_STRING"] == "c=d"
+    assert environ["CONTENT_TYPE"] == "text/plain"
+    assert environ["CONTENT_LENGTH"] == "3"
+    assert environ["REMOTE_ADDR"] == "10.0.0.1"
+    # Repeated headers are joined, headers with underscores are dropped.
+    assert environ["HTTP_X_FORWARDED_FOR"] == "10.0.0.2,10.0.0.3"
+    assert environ["wsgi.input"].read() == b"abc"
+
+
+def test_call_app_error_after_body_started():
+    def app(environ, start_response):
+        start_response("200 OK", [])
+        yield b"first"
+        try:
+            raise RuntimeError("Failed")
+        except RuntimeError:
+            start_response("500 Internal Server Error", [], sys.exc_info())
+
+    status, _, first, iterator, _ = aio.call_app(app, {})
+    assert (status, first) == ("200 OK", b"first")
+    # The status was already sent, so the error is raised instead.
+    with pytest.raises(RuntimeError):
+        next(iterator)
+
+
+def test_keep_alive(serve):
+    port = serve(echo_app)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    connection.request("POST", "/?clientid=1", body=b"body")
+    response = connection.getresponse()
+    assert response.read() == b"POST clientid=1 body"
+    assert response.headers["Connection"] == "keep-alive"
+    # Same connection.
+    connection.request("GET", "/")
+    assert connection.getresponse().read() == b"GET  "
+    connection.request("HEAD", "/")
+    response = connection.getresponse()
+    assert response.headers["Content-Length"] == "6"
+    assert response.read() == b""
+    connection.close()
+
+
+def test_streaming(serve):
+    port = serve(echo_app)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    connection.request("GET", "/stream")
+    response = connection.getresponse()
+    assert response.headers["Transfer-Encoding"] == "chunked"
+    assert response.read() == b"first second"
+    # HTTP/1.0 clients get the body until the connection is closed.
+    response = raw_request(port, b"GET /stream HTTP/1.0\r\n\r\n")
+    assert response.startswith(b"HTTP/1.0 200 OK\r\n")
+    assert b"Connection: close" in response
+    assert response.endswith(b"\r\n\r\nfirst second")
+
+
+def test_errors(serve):
+    port = serve(echo_app)
+    assert raw_request(port, b"garbage\r\n\r\n").startswith(b"HTTP/1.1 400 ")
+    too_large = b"POST / HTTP/1.1\r\nContent-Length: 2000000\r\n\r\n"
+    assert raw_request(port, too_large).startswith(b"HTTP/1.1 413 ")
+    chunked = b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+    assert raw_request(port, chunked).startswith(b"HTTP/1.1 400 ")
+    long_header = b"GET / HTTP/1.1\r\nX: " + b"x" * aio.MAX_HEADER_SIZE + b"\r\n\r\n"
+    assert raw_request(port, long_header).startswith(b"HTTP/1.1 431 ")
+    response = raw_request(port, b"GET /error HTTP/1.1\r\n\r\n")
+    assert response.startswith(b"HTTP/1.1 500 ")
+    for length in (b"x", b"-1"):
+        head = b"POST / HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n"
+        assert raw_request(port, head).startswith(b"HTTP/1.1 400 ")
+    # The connection is closed in the middle of the head.
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(b"GET / HTTP/1.1\r\n")
+        sock.shutdown(socket.SHUT_WR)
+        assert sock.recv(65536) == b""
+
+
+def test_flask_app(serve, fake_fs):
+    AlerterState.initialize()
+    port = serve(create_app(include_metrics=False))
+    state["clients"]["clientid1"]["alert_time"] = None
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    connection.request("POST", "/alive?clientid=clientid1&key=clientkey1")
+    assert connection.getresponse().read() == b"Success!"
+    assert state["clients"]["clientid1"]["alert_time"] is not None
+
+
+@unittest.mock.patch("cos_alerter.alerter.handle_pagerduty_incidents")
+def test_checker(handle_mock, fake_fs):
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+    dispatcher = unittest.mock.Mock()
+    AlerterState.initialize(clock=clock, dispatcher=dispatcher)
+    checker = aio.Checker()
+    checker.tick()
+    assert state["clients"]["clientid1"]["last_evaluated"] == 1000
+
+    # Idle clients are not checked every second.
+    clock.advance(1)
+    checker.tick()
+    assert state["clients"]["clientid1"]["last_evaluated"] == 1000
+    clock.advance(4)
+    checker.tick()
+    assert state["clients"]["clientid1"]["last_evaluated"] == 1005
+
+    # Both clients go down at 1300.
+    for _ in range(300):
+        clock.advance(1)
+        checker.tick()
+    assert dispatcher.call_count == 2
+    assert state["clients"]["clientid1"]["check_lag"] < 1
+
+    # A heartbeat changes the status, so the client is checked on the next tick.
+    with AlerterState("clientid1") as client_state:
+        client_state.reset_alert_timeout()
+    clock.advance(1)
+    checker.tick()
+    assert state["clients"]["clientid1"]["last_evaluated"] == clock.monotonic()
+    assert dispatcher.call_count == 2
+
+
+@unittest.mock.patch.object(AlerterState, "next_deadline", return_value=None)
+@unittest.mock.patch.object(AlerterState, "check", side_effect=RuntimeError("Failed"))
+def test_checker_survives_errors(check_mock, next_deadline_mock, fake_fs):
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+    AlerterState.initialize(clock=clock, dispatcher=unittest.mock.Mock())
+    checker = aio.Checker()
+    checker.tick()
+    assert state["clients"]["clientid1"]["last_evaluated"] == 1000
+    # Without a deadline, clients are checked again within max_check_lag.
+    clock.advance(config["max_check_lag"] / 2)
+    checker.tick()
+    assert state["clients"]["clientid1"]["last_evaluated"] == 1005
+    assert check_mock.call_count == 4
+
+
+@pytest.mark.parametrize("error", [None, RuntimeError("Failed")])
+@unittest.mock.patch("cos_alerter.aio.send_all_notifications")
+def test_notification_dispatcher(send_mock, error):
+    send_mock.side_effect = error
+
+    async def dispatch():
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            dispatcher = aio.NotificationDispatcher(loop, executor)
+            # Notifications are dispatched from other threads too.
+            thread = threading.Thread(target=dispatcher, kwargs={"dedup_key": "key"})
+            thread.start()
+            thread.join()
+            await asyncio.sleep(0)
+            await asyncio.gather(*dispatcher.tasks)
+
+    asyncio.run(dispatch())
+    send_mock.assert_called_once_with(dedup_key="key")
+
+
+@unittest.mock.patch("cos_alerter.alerter.handle_pagerduty_incidents")
+def test_serve(handle_mock, fake_fs, reset_handoff):
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+    AlerterState.initialize(clock=clock)
+    state["clients"]["clientid1"]["alert_time"] = None
+    app = create_app(include_metrics=False)
+
+    async def scenario():
+        serving = asyncio.create_task(aio.serve([(app, "web", "127.0.0.1:0")], run_for=10))
+        while "web" not in handoff._listeners:
+            await asyncio.sleep(0.01)
+        address = handoff._listeners["web"].getsockname()
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(b"POST /alive?clientid=clientid1&key=clientkey1 HTTP/1.1\r\n\r\n")
+        assert (await reader.readline()).startswith(b"HTTP/1.1 200 ")
+        writer.close()
+        assert isinstance(state["dispatch"], aio.NotificationDispatcher)
+        # The clients are checked by their own thread.
+        while state["clients"]["another-client"]["last_evaluated"] is None:
+            await asyncio.sleep(0.01)
+
+        # Once handed off, connections are accepted by the new process.
+        await asyncio.get_running_loop().run_in_executor(None, handoff._callbacks[0])
+        await asyncio.sleep(0)
+        with pytest.raises(ConnectionRefusedError):
+            await asyncio.open_connection(*address)
+        clock.advance(10)
+        await serving
+
+    asyncio.run(scenario())
+    assert state["clients"]["clientid1"]["alert_time"] is not None
+
+
+@unittest.mock.patch("cos_alerter.daemon.client_loop")
+@unittest.mock.patch("cos_alerter.handoff.listen_socket")
+def test_main_asyncio_runtime(listen_socket_mock, client_loop_mock, fake_fs, reset_handoff):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["runtime"] = "asyncio"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    sock = handoff.bind_tcp("127.0.0.1:0")
+    listen_socket_mock.return_value = sock
+    main(run_for=0, argv=["cos-alerter"])
+    listen_socket_mock.assert_called_once_with("web", "0.0.0.0:8080")
+    assert isinstance(state["dispatch"], aio.NotificationDispatcher)
+    client_loop_mock.assert_not_called()
+    sock.close()
+
+
+def test_invalid_runtime(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["runtime"] = "processes"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    with pytest.raises(SystemExit):
+        config.reload()
+
+
+def test_flask_streaming(serve, fake_fs):
+    AlerterState.initialize()
+    port = serve(create_app(include_metrics=False))
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    connection.request("GET", "/api/v1/clients")
+    response = connection.getresponse()
+    assert response.status == 200
+    assert len(response.read().splitlines()) == 2
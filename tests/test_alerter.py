@@ -1,6 +1,7 @@
 # Copyright 2023 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import json
 import os
 import textwrap
 import threading
@@ -17,10 +18,13 @@ from pdpyras import EventsAPISession
 from cos_alerter.alerter import (
     AlerterState,
     config,
+    handle_pagerduty_incidents,
     send_test_notification,
     split_destinations,
+    state,
     up_time,
 )
+from cos_alerter.clock import VirtualClock
 
 
 def assert_notifications(notify_mock, add_mock, pd_mock, title, body, dedup_key):
@@ -102,6 +106,21 @@ def test_invalid_hashes(fake_fs):
         assert False
 
 
+def test_api_workers_require_dashboard_address(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["api_workers"] = 2
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    with pytest.raises(SystemExit):
+        config.reload()
+    conf["dashboard_listen_addr"] = "127.0.0.1:8081"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    assert config["api_workers"] == 2
+
+
 def test_config_default_partial_file(fake_fs):
     conf = yaml.dump({"log_level": "info"})
     with open("/etc/cos-alerter.yaml", "w") as f:
@@ -286,6 +305,21 @@ def test_send_test_notification(pd_mock, notify_mock, add_mock, fake_fs):
     )
 
 
+@unittest.mock.patch("cos_alerter.alerter.EventsAPISession")
+def test_pagerduty_events_url(session_mock, fake_fs):
+    assert config["notify"]["pagerduty_events_url"] == "https://events.pagerduty.com"
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["notify"]["pagerduty_events_url"] = "http://127.0.0.1:9999"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    handle_pagerduty_incidents("resolve", "dedup", ["pagerduty://integration-key@api-key"])
+    session_mock.assert_called_once_with("integration-key")
+    assert session_mock.return_value.url == "http://127.0.0.1:9999"
+    session_mock.return_value.resolve.assert_called_once_with("dedup")
+
+
 def test_last_alert_datetime(fake_fs):
     with freezegun.freeze_time("2026-05-05T05:00:00+00:00") as frozen_datetime:
         AlerterState.initialize()
@@ -413,3 +447,179 @@ def test_unsilence_on_reset_alert_timeout(
     mock_is_down.return_value = is_down
     state.reset_alert_timeout()
     assert state.is_silenced() is False
+
+
+def test_reset_alert_timeout_does_not_save_silences(fake_fs):
+    AlerterState.initialize()
+    with unittest.mock.patch.object(state["silences"], "_save") as save_mock:
+        AlerterState(clientid="clientid1").reset_alert_timeout()
+    save_mock.assert_not_called()
+
+
+def test_next_deadline(fake_fs):
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+    dispatcher = unittest.mock.Mock()
+    AlerterState.initialize(clock=clock, dispatcher=dispatcher)
+    state = AlerterState(clientid="clientid1")
+    with state:
+        assert state.next_deadline() == 1300  # Down interval since the start.
+        clock.set(1100)
+        state.reset_alert_timeout()
+        assert state.next_deadline() == 1400
+        clock.set(1401)
+        assert state.next_deadline() == 1401  # Down and never notified: right away.
+        state.check()
+        dispatcher.assert_called_once()
+        assert state.next_deadline() == 1401 + 3600  # Repeat interval.
+        state.silence_until(clock.now() + timedelta(hours=2))
+        assert state.next_deadline() == 1401 + 7200  # End of the silence.
+        state.data["alert_time"] = None
+        assert state.next_deadline() is None
+
+
+@unittest.mock.patch("time.monotonic")
+def test_adaptive_down_interval(monotonic_mock, fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["watch"]["adaptive_down_interval"] = {"enabled": True, "min_heartbeats": 5}
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    state = AlerterState(clientid="clientid1")
+    with state:
+        for i in range(1, 5):
+            monotonic_mock.return_value = 1000 + i * 10
+            state.reset_alert_timeout()
+        assert state.data["down_interval"] == 300  # Not enough heartbeats yet.
+        monotonic_mock.return_value = 1050
+        state.reset_alert_timeout()
+        # 3 times the gap, clamped to the minimum of 30 seconds.
+        assert state.data["down_interval"] == pytest.approx(30.7, abs=2)
+        monotonic_mock.return_value = 1070
+        assert state.is_down() is False
+        monotonic_mock.return_value = 1085
+        assert state.is_down() is True
+
+
+@unittest.mock.patch("time.monotonic")
+def test_adaptive_down_interval_clamped(monotonic_mock, fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["watch"]["adaptive_down_interval"] = {"enabled": True, "min_heartbeats": 2, "max": "2m"}
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    assert config["watch"]["adaptive_down_interval"]["max"] == 120
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    state = AlerterState(clientid="clientid1")
+    with state:
+        for now in (1100, 1200):
+            monotonic_mock.return_value = now
+            state.reset_alert_timeout()
+        assert state.data["down_interval"] == 120
+        assert state.heartbeat_stats()["down_interval"] == 120
+
+
+def test_adaptive_down_interval_defaults(fake_fs):
+    assert config["watch"]["adaptive_down_interval"]["enabled"] is False
+    assert config["watch"]["adaptive_down_interval"]["min"] == 30
+    assert config["watch"]["adaptive_down_interval"]["max"] is None
+    assert config["intervals"]["clientid1"]["max_down_interval"] == 300
+
+
+def test_interval_overrides(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["watch"]["groups"] = {"staging": {"down_interval": "15m", "repeat_interval": "12h"}}
+    conf["watch"]["clients"]["clientid1"]["group"] = "staging"
+    conf["watch"]["clients"]["clientid1"]["down_interval"] = "10m"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    assert config["intervals"] == {
+        "clientid1": {
+            "down_interval": 600,
+            "repeat_interval": 43200,
+            "max_down_interval": 600,
+        },
+        "another-client": {
+            "down_interval": 300,
+            "repeat_interval": 3600,
+            "max_down_interval": 300,
+        },
+    }
+    AlerterState.initialize()
+    assert AlerterState("clientid1").data["repeat_interval"] == 43200
+
+
+def test_interval_overrides_unknown_group(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["watch"]["clients"]["clientid1"]["group"] = "production"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    with pytest.raises(SystemExit) as exc:
+        config.reload()
+    assert exc.value.code == 1
+
+
+def test_invalid_admin_key(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["admin_key"] = "not-a-hash"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    with pytest.raises(SystemExit) as exc:
+        config.reload()
+    assert exc.value.code == 1
+
+
+def test_silence_clients(fake_fs):
+    AlerterState.initialize()
+    t = datetime(2100, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+    with unittest.mock.patch.object(
+        state["silences"], "_save", wraps=state["silences"]._save
+    ) as save_mock:
+        AlerterState.silence_clients(["clientid1", "another-client"], t)
+    save_mock.assert_called_once()
+    assert AlerterState("clientid1").get_silenced_until() == t
+    assert AlerterState("another-client").get_silenced_until() == t
+    assert state["index"].count("silenced") == 2
+
+
+@unittest.mock.patch.object(AlerterState, "check")
+def test_silence_expiry_timer(check_mock, fake_fs):
+    AlerterState.initialize()
+    client_state = AlerterState(clientid="clientid1")
+    client_state.silence_until(datetime.now(timezone.utc) + timedelta(hours=1))
+    assert client_state.is_silenced() is True
+    deadline = client_state.data["silence_deadline"]
+    assert state["timers"].next_deadline() == deadline
+
+    state["timers"].run_pending(now=deadline - 1)
+    assert client_state.get_silenced_until() is not None
+    check_mock.assert_not_called()
+
+    with unittest.mock.patch("time.monotonic", return_value=deadline):
+        state["timers"].run_pending()
+    assert client_state.get_silenced_until() is None
+    assert client_state.data["silence_deadline"] is None
+    assert state["index"].count("silenced") == 0
+    check_mock.assert_called_once()
+    with config["silences_file"].open() as f:
+        assert json.load(f) == {}
+
+
+def test_silence_expiry_after_change(fake_fs):
+    AlerterState.initialize()
+    client_state = AlerterState(clientid="clientid1")
+    client_state.silence_until(datetime.now(timezone.utc) + timedelta(hours=1))
+    deadline = client_state.data["silence_deadline"]
+    client_state.silence_until(datetime.now(timezone.utc) + timedelta(hours=2))
+    # A stale expiry does not end the new silence.
+    with unittest.mock.patch("time.monotonic", return_value=deadline + 1):
+        AlerterState.expire_silences(["clientid1"])
+    assert client_state.data["silence_deadline"] is not None
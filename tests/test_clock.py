@@ -0,0 +1,28 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+from datetime import datetime, timezone
+
+import pytest
+
+from cos_alerter.clock import VirtualClock
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_virtual_clock_only_moves_when_told():
+    clock = VirtualClock(START, monotonic_start=50)
+    assert clock.monotonic() == 50
+    assert clock.now() == START
+    clock.sleep(10)
+    clock.advance(5)
+    assert clock.monotonic() == 65
+    assert clock.now() == datetime(2024, 1, 1, 0, 0, 15, tzinfo=timezone.utc)
+    clock.set(100)
+    assert clock.monotonic() == 100
+
+
+def test_virtual_clock_can_not_go_backwards():
+    clock = VirtualClock(START)
+    with pytest.raises(ValueError):
+        clock.set(clock.monotonic() - 1)
@@ -0,0 +1,62 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import threading
+import time
+import unittest.mock
+
+from prometheus_client import REGISTRY
+
+from cos_alerter import contention
+from cos_alerter.alerter import AlerterState
+from cos_alerter.metrics import register_collectors
+
+
+def hold_lock(acquired, release):
+    with AlerterState("clientid1"):
+        acquired.set()
+        release.wait()
+
+
+def wait_for_lock():
+    with AlerterState("clientid1"):
+        pass
+
+
+@unittest.mock.patch("cos_alerter.contention.SAMPLE_EVERY", 1)
+def test_wait_and_hold_times_by_call_site(fake_fs):
+    register_collectors()
+    AlerterState.initialize()
+    before = contention.summary()
+
+    acquired = threading.Event()
+    release = threading.Event()
+    holder = threading.Thread(target=hold_lock, args=(acquired, release))
+    holder.start()
+    acquired.wait()
+    waiter = threading.Thread(target=wait_for_lock)
+    waiter.start()
+    time.sleep(0.05)
+    release.set()
+    holder.join()
+    waiter.join()
+
+    summary = contention.summary()
+    holding = summary["test_contention.hold_lock"]
+    waiting = summary["test_contention.wait_for_lock"]
+    assert holding["count"] - before.get("test_contention.hold_lock", {}).get("count", 0) == 1
+    assert holding["hold_seconds"] >= 0.05
+    assert waiting["wait_seconds"] >= 0.04
+    assert waiting["hold_seconds"] < 0.04
+    labels = {"site": "test_contention.wait_for_lock"}
+    assert REGISTRY.get_sample_value("cos_alerter_lock_wait_seconds_count", labels) >= 1
+    assert REGISTRY.get_sample_value("cos_alerter_lock_hold_seconds_sum", labels) < 0.04
+
+
+def test_uncontended_acquisitions_are_sampled(fake_fs):
+    AlerterState.initialize()
+    before = contention.summary().get("test_contention.wait_for_lock", {}).get("count", 0)
+    for _ in range(contention.SAMPLE_EVERY * 3):
+        wait_for_lock()
+    after = contention.summary()["test_contention.wait_for_lock"]["count"]
+    assert after - before == 3
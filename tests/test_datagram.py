@@ -0,0 +1,124 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import socket
+import threading
+import time
+import unittest.mock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from cos_alerter import datagram, handoff
+from cos_alerter.alerter import AlerterState, state
+from cos_alerter.metrics import register_collectors
+
+
+def test_parse_address():
+    assert datagram.parse_address("udp://127.0.0.1:8090") == (
+        socket.AF_INET,
+        ("127.0.0.1", 8090),
+    )
+    assert datagram.parse_address("udp://[::1]:8090") == (socket.AF_INET6, ("::1", 8090))
+    assert datagram.parse_address("unix:///run/cos-alerter.sock") == (
+        socket.AF_UNIX,
+        "/run/cos-alerter.sock",
+    )
+    for address in ("127.0.0.1:8090", "udp://127.0.0.1", "tcp://127.0.0.1:8090", "unix://"):
+        with pytest.raises(ValueError):
+            datagram.parse_address(address)
+
+
+@unittest.mock.patch("time.monotonic")
+def test_handle_packet(monotonic_mock, fake_fs):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    monotonic_mock.return_value = 1010
+
+    assert datagram.handle_packet(b"clientid1\nclientkey1") == "accepted"
+    assert state["clients"]["clientid1"]["alert_time"] == 1010
+    assert datagram.handle_packet(b"clientid1\nwrong") == "unauthorized"
+    assert datagram.handle_packet(b"unknown\nclientkey1") == "unknown_client"
+    assert datagram.handle_packet(b"clientid1") == "bad_request"
+    assert datagram.handle_packet(b"clientid1\nclientkey1\nmore") == "bad_request"
+    assert datagram.handle_packet(b"\xff\nclientkey1") == "bad_request"
+    assert state["clients"]["another-client"]["alert_time"] == 1000
+
+
+def test_bind_unix_socket(tmp_path):
+    path = str(tmp_path / "cos-alerter.sock")
+    datagram.bind(f"unix://{path}").close()
+    # The socket left by a previous run is replaced.
+    sock = datagram.bind(f"unix://{path}")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+        sender.sendto(b"clientid1\nclientkey1", path)
+    assert sock.recv(datagram.MAX_PACKET_SIZE) == b"clientid1\nclientkey1"
+    sock.close()
+    # Other files are left alone.
+    other = tmp_path / "other"
+    other.write_text("data")
+    with pytest.raises(OSError):
+        datagram.bind(f"unix://{other}")
+    assert other.read_text() == "data"
+
+
+def test_serve_hands_off(fake_fs, caplog, monkeypatch):
+    AlerterState.initialize()
+    AlerterState.pause_for_handoff()
+    monkeypatch.setattr(handoff, "_handed_off_at", 0.0)
+    sock = datagram.bind("udp://127.0.0.1:0")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        sender.sendto(b"clientid1\nwrong", sock.getsockname())
+        sender.sendto(b"clientid1\nclientkey1", sock.getsockname())
+    datagram.serve(sock)
+    assert "Rejected heartbeat packet" in caplog.text
+    # The heartbeat is left for the new process.
+    assert sock.recv(datagram.MAX_PACKET_SIZE) == b"clientid1\nclientkey1"
+    sock.close()
+    AlerterState.resume_after_handoff()
+
+
+def test_serve_resumes_after_failed_handoff(fake_fs):
+    AlerterState.initialize()
+    register_collectors()
+    state["clients"]["clientid1"]["alert_time"] = None
+    sock = datagram.bind("udp://127.0.0.1:0")
+    thread = threading.Thread(target=datagram.serve, args=(sock,), daemon=True)
+    labels = {"result": "unavailable"}
+    unavailable = REGISTRY.get_sample_value("cos_alerter_heartbeats_total", labels)
+
+    with handoff._lock:  # A handoff is in progress.
+        AlerterState.pause_for_handoff()
+        thread.start()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sender.sendto(b"clientid1\nclientkey1", sock.getsockname())
+        for _ in range(100):
+            if REGISTRY.get_sample_value("cos_alerter_heartbeats_total", labels) > unavailable:
+                break
+            time.sleep(0.01)
+        # The new process failed to take over.
+        AlerterState.resume_after_handoff()
+
+    # The requeued heartbeat is applied by this process.
+    for _ in range(100):
+        if state["clients"]["clientid1"]["alert_time"] is not None:
+            break
+        time.sleep(0.01)
+    assert state["clients"]["clientid1"]["alert_time"] is not None
+    assert thread.is_alive()
+
+
+def test_udp_listener(fake_fs):
+    AlerterState.initialize()
+    sock = datagram.bind("udp://127.0.0.1:0")
+    thread = threading.Thread(target=datagram.serve, args=(sock,), daemon=True)
+    thread.start()
+    state["clients"]["clientid1"]["alert_time"] = None
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        sender.sendto(b"clientid1\nclientkey1", sock.getsockname())
+    for _ in range(100):
+        if state["clients"]["clientid1"]["alert_time"] is not None:
+            break
+        time.sleep(0.01)
+    assert state["clients"]["clientid1"]["alert_time"] is not None
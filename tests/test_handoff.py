@@ -0,0 +1,293 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import textwrap
+import types
+import unittest.mock
+from datetime import datetime, timezone
+
+import pytest
+import yaml
+
+from cos_alerter import handoff
+from cos_alerter.alerter import AlerterState, config, is_leader, state
+from cos_alerter.clock import VirtualClock
+from cos_alerter.server import create_app
+
+PARAMS = {"clientid": "clientid1", "key": "clientkey1"}
+
+# Takes over like a new COS Alerter process, then answers one connection with the alert time of
+# clientid1 from the snapshot.
+NEW_PROCESS = textwrap.dedent("""
+    from cos_alerter import handoff
+    handoff.load_inherited()
+    snapshot = handoff.receive_state()
+    sock = handoff.listen_socket("web", "unused")
+    handoff.confirm()
+    connection, _ = sock.accept()
+    connection.sendall(str(snapshot["clients"]["clientid1"]["alert_time"]).encode())
+    connection.close()
+    """)
+
+# Gets ready, then exits without taking over.
+FAILING_PROCESS = textwrap.dedent("""
+    from cos_alerter import handoff
+    handoff.load_inherited()
+    handoff._channel.sendall(b"ready\\n")
+    """)
+
+
+@pytest.fixture
+def flask_client():
+    return create_app(include_metrics=False).test_client()
+
+
+@pytest.fixture(autouse=True)
+def reset_handoff():
+    yield
+    for sock in [*handoff._listeners.values(), *handoff._inherited.values()]:
+        sock.close()
+    handoff._listeners.clear()
+    handoff._inherited.clear()
+    handoff._callbacks.clear()
+    handoff._handed_off_at = None
+    if handoff._channel is not None:
+        handoff._channel.close()
+        handoff._channel = None
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+
+
+def test_load_inherited():
+    sock = handoff.bind_tcp("127.0.0.1:0")
+    fd = os.dup(sock.fileno())
+    environ = {"LISTEN_FDS": "1", "LISTEN_FDNAMES": "web"}
+    with unittest.mock.patch.object(handoff, "SD_LISTEN_FDS_START", fd):
+        # Meant for another process.
+        handoff.load_inherited({**environ, "LISTEN_PID": "1"})
+        assert handoff._inherited == {}
+        handoff.load_inherited(environ)
+    assert environ == {}
+    inherited = handoff.listen_socket("web", "127.0.0.1:1")
+    assert inherited.getsockname() == sock.getsockname()
+    assert not os.get_inheritable(inherited.fileno())
+    sock.close()
+
+
+def test_load_inherited_channel():
+    channel, child = socket.socketpair()
+    # Two consecutive file descriptors, as passed by the previous process.
+    start = max(channel.fileno(), child.fileno()) + 10
+    os.dup2(channel.fileno(), start)
+    os.dup2(child.fileno(), start + 1)
+    environ = {"LISTEN_FDS": "2", "LISTEN_FDNAMES": "web:handoff"}
+    with unittest.mock.patch.object(handoff, "SD_LISTEN_FDS_START", start):
+        handoff.load_inherited(environ)
+    assert handoff._channel is not None and handoff._channel.fileno() == start + 1
+    assert list(handoff._inherited) == ["web"]
+    channel.close()
+    child.close()
+
+
+@unittest.mock.patch("cos_alerter.handoff.notify_systemd")
+def test_receive_state_and_confirm(notify_mock, monkeypatch):
+    channel, child = socket.socketpair()
+    monkeypatch.setattr(handoff, "_channel", child)
+    channel.sendall(pickle.dumps({"clients": {}}))
+    channel.shutdown(socket.SHUT_WR)
+    assert handoff.receive_state() == {"clients": {}}
+    handoff.confirm()
+    assert handoff._channel is None
+    assert handoff._read_line(channel, 5) == b"ready"
+    assert handoff._read_line(channel, 5) == b"started"
+    # The previous process tells systemd.
+    notify_mock.assert_not_called()
+    handoff.confirm()
+    notify_mock.assert_called_once_with("READY=1")
+    channel.close()
+
+
+@pytest.mark.parametrize("abstract", [False, True])
+def test_notify_systemd(abstract, tmp_path, monkeypatch):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        if abstract:
+            sock.bind(f"\0cos-alerter-test-{os.getpid()}")
+            monkeypatch.setenv("NOTIFY_SOCKET", f"@cos-alerter-test-{os.getpid()}")
+        else:
+            sock.bind(str(tmp_path / "notify"))
+            monkeypatch.setenv("NOTIFY_SOCKET", str(tmp_path / "notify"))
+        handoff.notify_systemd("READY=1")
+        assert sock.recv(100) == b"READY=1"
+
+
+def test_notify_systemd_error(tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv("NOTIFY_SOCKET", str(tmp_path / "missing"))
+    handoff.notify_systemd("READY=1")
+    assert "Failed to notify systemd." in caplog.text
+
+
+def test_command_line(monkeypatch):
+    assert handoff.command_line() == sys.orig_argv
+    # Before Python 3.10.
+    monkeypatch.delattr(sys, "orig_argv")
+    monkeypatch.setattr(sys, "argv", ["/usr/bin/cos-alerter", "--config", "a.yaml"])
+    main = types.ModuleType("__main__")
+    monkeypatch.setitem(sys.modules, "__main__", main)
+    assert handoff.command_line() == [sys.executable, "/usr/bin/cos-alerter", "--config", "a.yaml"]
+    main.__spec__ = unittest.mock.Mock()
+    main.__spec__.name = "cos_alerter.daemon"
+    assert handoff.command_line() == [
+        sys.executable,
+        "-m",
+        "cos_alerter.daemon",
+        "--config",
+        "a.yaml",
+    ]
+
+
+def test_read_line_timeout():
+    channel, child = socket.socketpair()
+    assert handoff._read_line(channel, 0.01) == b""
+    channel.close()
+    child.close()
+
+
+def test_abort_exited_process():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    handoff._abort(process.pid)
+
+
+def test_pause_and_restore(flask_client, fake_fs, clock):
+    AlerterState.initialize(clock=clock)
+    clock.advance(10)
+    flask_client.post("/alive", query_string=PARAMS)
+    snapshot = pickle.loads(pickle.dumps(AlerterState.pause_for_handoff()))
+
+    # Heartbeats are not applied and notifications are not sent anymore.
+    assert not is_leader()
+    response = flask_client.post("/alive", query_string=PARAMS)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert state["clients"]["clientid1"]["alert_time"] == 1010
+
+    clock.advance(5)
+    AlerterState.initialize(clock=clock, snapshot=snapshot)
+    assert state["start_time"] == 1000
+    assert state["clients"]["clientid1"]["alert_time"] == 1010
+    assert state["clients"]["clientid1"]["heartbeats"].count == 1
+    assert state["clients"]["another-client"]["alert_time"] == 1000
+    assert is_leader()
+    assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+
+
+def test_restore_adaptive_down_interval(flask_client, fake_fs, clock):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["watch"]["adaptive_down_interval"] = {"enabled": True, "min_heartbeats": 3}
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    AlerterState.initialize(clock=clock)
+    for _ in range(3):
+        clock.advance(20)
+        flask_client.post("/alive", query_string=PARAMS)
+    learned = state["clients"]["clientid1"]["down_interval"]
+    assert learned < 300
+    snapshot = pickle.loads(pickle.dumps(AlerterState.pause_for_handoff()))
+
+    AlerterState.initialize(clock=clock, snapshot=snapshot)
+    assert state["clients"]["clientid1"]["down_interval"] == learned
+    # Not enough heartbeats to adapt it.
+    assert state["clients"]["another-client"]["down_interval"] == 300
+
+
+def test_resume(flask_client, fake_fs, clock):
+    AlerterState.initialize(clock=clock)
+    AlerterState.pause_for_handoff()
+    AlerterState.resume_after_handoff()
+    assert is_leader()
+    assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+
+
+@unittest.mock.patch("cos_alerter.handoff.notify_systemd")
+def test_hand_off(notify_mock, fake_fs, clock, monkeypatch):
+    AlerterState.initialize(clock=clock)
+    state["clients"]["clientid1"]["alert_time"] = 1234.5
+    sock = handoff.listen_socket("web", "127.0.0.1:0")
+    address = sock.getsockname()
+    callback = unittest.mock.Mock()
+    handoff.on_handed_off(callback)
+    monkeypatch.setitem(state, "lease", unittest.mock.Mock())
+
+    # The file descriptors are really passed to a new process.
+    fake_fs.pause()
+    assert handoff.hand_off([sys.executable, "-c", NEW_PROCESS])
+    assert state["handed_off"]
+    assert not handoff.finished()
+    assert handoff.wait_for_outcome()
+    callback.assert_called_once_with()
+    state["lease"].release.assert_called_once_with()
+    # systemd follows the new process.
+    (message,) = notify_mock.call_args.args
+    assert message.startswith("MAINPID=") and message != f"MAINPID={os.getpid()}"
+    # Only once.
+    assert not handoff.hand_off([sys.executable, "-c", NEW_PROCESS])
+    # The new process serves the socket with the state of this one.
+    with socket.create_connection(address, timeout=10) as connection:
+        assert connection.recv(100) == b"1234.5"
+    os.waitpid(-1, 0)
+
+
+def test_failed_hand_off(fake_fs, clock):
+    AlerterState.initialize(clock=clock)
+    handoff.listen_socket("web", "127.0.0.1:0")
+    fake_fs.pause()
+    assert not handoff.hand_off([sys.executable, "-c", "pass"])
+    assert not state["handed_off"]
+    assert handoff._handed_off_at is None
+    assert not handoff.wait_for_outcome()
+
+
+def test_failed_take_over(fake_fs, clock):
+    AlerterState.initialize(clock=clock)
+    handoff.listen_socket("web", "127.0.0.1:0")
+    pause = AlerterState.pause_for_handoff
+
+    def pause_once_exited():
+        # The snapshot can not be sent anymore.
+        os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+        return pause()
+
+    fake_fs.pause()
+    with unittest.mock.patch.object(AlerterState, "pause_for_handoff", pause_once_exited):
+        assert not handoff.hand_off([sys.executable, "-c", FAILING_PROCESS])
+    assert not state["handed_off"]
+    assert is_leader()
+
+
+def test_hand_off_not_possible(fake_fs, clock, monkeypatch):
+    AlerterState.initialize(clock=clock)
+    monkeypatch.setenv("COS_ALERTER_HANDOFF", "disabled")
+    assert not handoff.hand_off([sys.executable, "-c", "pass"])
+    monkeypatch.delenv("COS_ALERTER_HANDOFF")
+    with handoff._lock:  # Already in progress.
+        assert not handoff.hand_off([sys.executable, "-c", "pass"])
+
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["api_workers"] = 2
+    conf["dashboard_listen_addr"] = "127.0.0.1:8081"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    assert not handoff.hand_off([sys.executable, "-c", "pass"])
+    assert not state["handed_off"]
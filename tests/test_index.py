@@ -0,0 +1,146 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import pytest
+
+from cos_alerter.index import LabelIndex, StatusIndex
+
+NAMES = {
+    "client-a": "Charlie",
+    "client-b": "alpha",
+    "client-c": "Bravo",
+    "client-d": "Delta",
+}
+
+
+@pytest.fixture
+def index():
+    index = StatusIndex(NAMES)
+    index.update("client-a", "up", False)
+    index.update("client-b", "down", True)
+    index.update("client-c", "down", False)
+    index.update("client-d", "unknown", False)
+    return index
+
+
+def test_update_reports_changes(index):
+    assert index.update("client-a", "up", False) is False
+    assert index.update("client-a", "down", False) is True
+    assert index.update("client-a", "down", True) is True
+
+
+def test_update_moves_between_sets(index):
+    index.update("client-b", "up", False)
+    assert index.count("down") == 1
+    assert index.count("up") == 2
+    assert index.count("silenced") == 0
+
+
+def test_counts(index):
+    assert index.count("up") == 1
+    assert index.count("down") == 2
+    assert index.count("unknown") == 1
+    assert index.count("silenced") == 1
+
+
+def test_page_unfiltered_sorted_by_name(index):
+    assert index.page() == (4, ["client-b", "client-c", "client-a", "client-d"])
+    assert index.page(reverse=True) == (4, ["client-d", "client-a", "client-c", "client-b"])
+
+
+def test_page_pagination(index):
+    assert index.page(offset=1, limit=2) == (4, ["client-c", "client-a"])
+    assert index.page(offset=1, limit=2, reverse=True) == (4, ["client-a", "client-c"])
+    assert index.page(offset=6, limit=2, reverse=True) == (4, [])
+    assert index.page(sort="client_id", offset=3, limit=2) == (4, ["client-d"])
+
+
+def test_page_filter_by_status(index):
+    assert index.page(status="down") == (2, ["client-b", "client-c"])
+    assert index.page(status="silenced") == (1, ["client-b"])
+    assert index.page(status="up", limit=0) == (1, [])
+
+
+def test_page_search(index):
+    assert index.page(search="ALPHA") == (1, ["client-b"])
+    assert index.page(search="client-c") == (1, ["client-c"])
+    assert index.page(status="up", search="alpha") == (0, [])
+
+
+def test_page_sort_by_status(index):
+    total, clientids = index.page(sort="status")
+    assert total == 4
+    assert clientids == ["client-b", "client-c", "client-d", "client-a"]
+
+
+def test_changed_since(index):
+    cursor, changed = index.changed_since(0)
+    assert cursor == 4
+    assert changed == ["client-a", "client-b", "client-c", "client-d"]
+
+    index.update("client-b", "up", False)
+    index.mark_changed("client-a")
+    assert index.changed_since(cursor) == (6, ["client-b", "client-a"])
+    assert index.changed_since(6) == (6, [])
+
+
+def test_subscribe_receives_changes(index):
+    subscription = index.subscribe()
+    index.update("client-a", "down", False)
+    index.update("client-a", "down", False)  # Not a change
+    # Not shown on the dashboard.
+    assert index.update("client-a", "down", False, notified=True)
+    assert subscription.events.get_nowait() == {
+        "client_id": "client-a",
+        "status": "down",
+        "is_silenced": False,
+        "previous_status": "up",
+        "was_silenced": False,
+        "revision": 5,
+    }
+    assert subscription.events.empty()
+
+    index.unsubscribe(subscription)
+    index.update("client-a", "up", False)
+    assert subscription.events.empty()
+
+
+def test_subscribe_overflow(index):
+    subscription = index.subscribe(maxsize=1)
+    index.update("client-a", "down", False)
+    assert subscription.overflowed is False
+    index.update("client-b", "up", False)
+    assert subscription.overflowed is True
+    assert index.subscriber_count() == 0
+
+
+def test_subscribe_limit(index):
+    first = index.subscribe(limit=2)
+    assert index.subscribe(limit=2) is not None
+    assert index.subscribe(limit=2) is None
+    index.unsubscribe(first)
+    assert index.subscribe(limit=2) is not None
+    assert index.subscriber_count() == 2
+
+
+def test_label_index_select():
+    labels = LabelIndex(
+        {
+            "client-a": {"region": "eu", "env": "prod"},
+            "client-b": {"region": "eu", "env": "staging"},
+            "client-c": {"region": "us", "env": "prod"},
+            "client-d": {},
+        }
+    )
+    assert labels.select({"region": "eu"}) == {"client-a", "client-b"}
+    assert labels.select({"region": "eu", "env": "prod"}) == {"client-a"}
+    assert labels.select({"region": "asia"}) == set()
+    assert labels.select({}) == set()
+
+
+def test_label_index_parse_selector():
+    assert LabelIndex.parse_selector("region=eu, env = prod") == {"region": "eu", "env": "prod"}
+    with pytest.raises(ValueError):
+        LabelIndex.parse_selector("")
+    with pytest.raises(ValueError):
+        LabelIndex.parse_selector("region=eu,=prod")
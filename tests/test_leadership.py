@@ -0,0 +1,146 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import socket
+import unittest.mock
+from datetime import datetime, timezone
+
+import pytest
+from prometheus_client import REGISTRY
+
+from cos_alerter.alerter import AlerterState, state
+from cos_alerter.clock import VirtualClock
+from cos_alerter.leadership import Lease
+from cos_alerter.metrics import register_collectors
+
+LEASE_FILE = "/srv/cos-alerter.lease"
+
+
+@pytest.fixture
+def clock(fake_fs):
+    fake_fs.create_dir("/srv")
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+    dispatcher = unittest.mock.Mock()
+    AlerterState.initialize(clock=clock, dispatcher=dispatcher)
+    return clock
+
+
+def failovers():
+    return REGISTRY.get_sample_value("cos_alerter_leader_failover_seconds_count") or 0
+
+
+def leadership_changes():
+    return REGISTRY.get_sample_value("cos_alerter_leadership_changes_total") or 0
+
+
+def test_default_instance_id(clock):
+    assert Lease(LEASE_FILE, 15).instance_id == f"{socket.gethostname()}:{os.getpid()}"
+
+
+def test_single_leader(clock):
+    register_collectors()
+    first = Lease(LEASE_FILE, 15, "first")
+    second = Lease(LEASE_FILE, 15, "second")
+    assert first.renew()
+    assert not second.renew()
+    clock.advance(5)
+    assert first.renew()
+    assert first.is_leader()
+    assert not second.is_leader()
+
+    # The leader stops renewing the lease.
+    before = failovers()
+    clock.advance(14)
+    assert not second.renew()
+    clock.advance(2)
+    assert not first.is_leader()
+    assert second.renew()
+    assert second.is_leader()
+    assert failovers() == before + 1
+    assert REGISTRY.get_sample_value("cos_alerter_leader_failover_seconds_sum") >= 16
+    assert not first.renew()
+
+
+def test_release(clock):
+    register_collectors()
+    first = Lease(LEASE_FILE, 15, "first")
+    second = Lease(LEASE_FILE, 15, "second")
+    first.renew()
+    changes = leadership_changes()
+    first.release()
+    assert leadership_changes() == changes + 1
+    assert not first.is_leader()
+    before = failovers()
+    assert second.renew()
+    assert failovers() == before
+    # Releasing does not remove the lease of another instance.
+    first.release()
+    assert not Lease(LEASE_FILE, 15, "third").renew()
+    # A released lease is not taken again.
+    second.release()
+    assert not first.renew()
+    first.run()
+
+
+def test_invalid_lease_file(clock):
+    with open(LEASE_FILE, "w") as f:
+        f.write("not json")
+    assert Lease(LEASE_FILE, 15, "first").renew()
+
+
+def test_release_invalid_lease_file(clock):
+    lease = Lease(LEASE_FILE, 15, "first")
+    lease.renew()
+    with open(LEASE_FILE, "w") as f:
+        f.write("not json")
+    lease.release()
+    assert not lease.is_leader()
+    with open(LEASE_FILE) as f:
+        assert f.read() == "not json"
+
+
+def test_run_survives_errors(clock):
+    lease = Lease(LEASE_FILE, 15, "first")
+    with unittest.mock.patch.object(lease, "renew", side_effect=OSError) as renew_mock:
+        with unittest.mock.patch.object(
+            clock, "sleep", side_effect=lambda _: lease.release()
+        ) as sleep_mock:
+            lease.run()
+    renew_mock.assert_called_once_with()
+    sleep_mock.assert_called_once_with(5)
+
+
+def test_only_leader_notifies(clock, monkeypatch):
+    register_collectors()
+    follower = Lease(LEASE_FILE, 15, "follower")
+    Lease(LEASE_FILE, 15, "leader").renew()
+    follower.renew()
+    monkeypatch.setitem(state, "lease", follower)
+    assert REGISTRY.get_sample_value("cos_alerter_leader") == 0
+
+    clock.advance(301)
+    with AlerterState("clientid1") as client_state:
+        client_state.check()
+        assert client_state.data["notify_time"] is None
+    state["dispatch"].assert_not_called()
+
+    # The leader is gone.
+    clock.advance(16)
+    follower.renew()
+    assert REGISTRY.get_sample_value("cos_alerter_leader") == 1
+    with AlerterState("clientid1") as client_state:
+        client_state.check()
+    state["dispatch"].assert_called_once()
+
+
+@unittest.mock.patch("cos_alerter.alerter.handle_pagerduty_incidents")
+def test_only_leader_resolves(handle_mock, clock, monkeypatch):
+    monkeypatch.setitem(state, "lease", Lease(LEASE_FILE, 15, "follower"))
+    with AlerterState("clientid1") as client_state:
+        client_state.resolve_existing_alerts()
+    handle_mock.assert_not_called()
+    state["lease"].renew()
+    with AlerterState("clientid1") as client_state:
+        client_state.resolve_existing_alerts()
+    handle_mock.assert_called_once()
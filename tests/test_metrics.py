@@ -0,0 +1,169 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import time
+import unittest.mock
+from datetime import datetime, timezone
+
+import pytest
+import yaml
+from prometheus_client import REGISTRY
+
+from cos_alerter.alerter import AlerterState, config, state
+from cos_alerter.metrics import METRICS_REGISTRY, register_collectors
+from cos_alerter.server import create_app
+
+
+@pytest.fixture(autouse=True)
+def collectors():
+    register_collectors()
+    register_collectors()  # Registering twice is a no-op.
+
+
+def test_status_counters(fake_fs):
+    AlerterState.initialize()
+    assert REGISTRY.get_sample_value("cos_alerter_clients", {"status": "unknown"}) == 2
+    assert REGISTRY.get_sample_value("cos_alerter_clients", {"status": "up"}) == 0
+
+    with AlerterState("clientid1") as client_state:
+        client_state.reset_alert_timeout()
+        client_state._set_notify_time()
+    assert REGISTRY.get_sample_value("cos_alerter_clients", {"status": "unknown"}) == 1
+    assert REGISTRY.get_sample_value("cos_alerter_clients", {"status": "up"}) == 1
+    assert REGISTRY.get_sample_value("cos_alerter_clients_silenced") == 0
+    assert REGISTRY.get_sample_value("cos_alerter_clients_recently_notified") == 1
+
+
+def test_status_counters_uninitialized():
+    index = state.pop("index", None)
+    try:
+        assert REGISTRY.get_sample_value("cos_alerter_clients_silenced") is None
+    finally:
+        if index is not None:
+            state["index"] = index
+
+
+def test_client_metrics(fake_fs):
+    AlerterState.initialize()
+    with AlerterState("clientid1") as client_state:
+        client_state.reset_alert_timeout()
+        client_state._set_notify_time()
+        client_state.silence_until(datetime(2100, 1, 1, tzinfo=timezone.utc))
+    labels = {"client_id": "clientid1"}
+    assert REGISTRY.get_sample_value("cos_alerter_client_last_heartbeat_age_seconds", labels) < 5
+    assert REGISTRY.get_sample_value("cos_alerter_client_down", labels) == 0
+    assert REGISTRY.get_sample_value("cos_alerter_client_silenced", labels) == 1
+    assert (
+        REGISTRY.get_sample_value("cos_alerter_client_silenced_until_timestamp_seconds", labels)
+        == 4102444800
+    )
+    assert REGISTRY.get_sample_value(
+        "cos_alerter_client_last_notification_timestamp_seconds", labels
+    ) == pytest.approx(time.time(), abs=5)
+
+    labels = {"client_id": "another-client"}
+    assert (
+        REGISTRY.get_sample_value("cos_alerter_client_last_heartbeat_age_seconds", labels) is None
+    )
+    assert REGISTRY.get_sample_value("cos_alerter_client_silenced", labels) == 0
+    assert REGISTRY.get_sample_value("cos_alerter_client_series_dropped") == 0
+
+
+@unittest.mock.patch("time.monotonic")
+def test_client_metrics_limit(monotonic_mock, fake_fs):
+    monotonic_mock.return_value = 1000
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["per_client_metrics_limit"] = 1
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    AlerterState.initialize()
+    with AlerterState("another-client") as client_state:
+        monotonic_mock.return_value = 1100
+        client_state.reset_alert_timeout()
+        monotonic_mock.return_value = 2000
+        client_state.refresh_status()
+    assert REGISTRY.get_sample_value("cos_alerter_client_series_dropped") == 1
+    assert REGISTRY.get_sample_value("cos_alerter_client_down", {"client_id": "clientid1"}) is None
+    assert (
+        REGISTRY.get_sample_value("cos_alerter_client_down", {"client_id": "another-client"}) == 1
+    )
+
+    # Without clients down, the limit is filled with the others.
+    with unittest.mock.patch("cos_alerter.alerter.handle_pagerduty_incidents"):
+        with AlerterState("another-client") as client_state:
+            client_state.reset_alert_timeout()
+    assert REGISTRY.get_sample_value("cos_alerter_client_series_dropped") == 1
+    exported = [
+        REGISTRY.get_sample_value("cos_alerter_client_down", {"client_id": clientid})
+        for clientid in ("clientid1", "another-client")
+    ]
+    assert exported.count(None) == 1
+    assert 1 not in exported
+
+    conf["per_client_metrics_limit"] = 0
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    assert REGISTRY.get_sample_value("cos_alerter_client_series_dropped") is None
+
+
+@pytest.fixture
+def flask_client():
+    return create_app(include_metrics=False).test_client()
+
+
+def test_heartbeat_counters(flask_client, fake_fs):
+    AlerterState.initialize()
+    register_collectors(METRICS_REGISTRY)
+
+    def count(result):
+        return METRICS_REGISTRY.get_sample_value(
+            "cos_alerter_heartbeats_total", {"result": result}
+        )
+
+    before = {result: count(result) for result in ("accepted", "unauthorized", "bad_request")}
+    flask_client.post("/alive", query_string={"clientid": "clientid1", "key": "clientkey1"})
+    flask_client.post("/alive", query_string={"clientid": "clientid1", "key": "wrong"})
+    flask_client.post("/alive")
+    for result in before:
+        assert count(result) == before[result] + 1
+    assert METRICS_REGISTRY.get_sample_value("cos_alerter_clients", {"status": "up"}) == 1
+    assert METRICS_REGISTRY.get_sample_value("flask_http_request_total") is None
+
+
+@unittest.mock.patch("time.monotonic")
+def test_client_heartbeat_metrics(monotonic_mock, fake_fs):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    with AlerterState("clientid1") as client_state:
+        for now in (1060, 1120, 1180):
+            monotonic_mock.return_value = now
+            client_state.reset_alert_timeout()
+    labels = {"client_id": "clientid1", "quantile": "0.99"}
+    assert REGISTRY.get_sample_value(
+        "cos_alerter_client_heartbeat_interval_seconds", labels
+    ) == pytest.approx(60, rel=0.07)
+    assert (
+        REGISTRY.get_sample_value(
+            "cos_alerter_client_heartbeat_jitter_seconds", {"client_id": "clientid1"}
+        )
+        == 0
+    )
+
+
+@unittest.mock.patch("time.monotonic")
+def test_checker_metrics(monotonic_mock, fake_fs):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    state["clients"]["clientid1"]["last_evaluated"] = 1000
+    state["clients"]["clientid1"]["check_lag"] = 0.25
+    monotonic_mock.return_value = 1005
+    assert REGISTRY.get_sample_value("cos_alerter_check_max_lag_seconds") == 0.25
+    assert REGISTRY.get_sample_value("cos_alerter_check_stalled_clients") == 0
+    assert REGISTRY.get_sample_value(
+        "cos_alerter_client_last_evaluated_timestamp_seconds", {"client_id": "clientid1"}
+    ) == pytest.approx(state["start_date"])
+    monotonic_mock.return_value = 1020
+    assert REGISTRY.get_sample_value("cos_alerter_check_stalled_clients") == 2
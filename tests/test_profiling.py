@@ -0,0 +1,75 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import threading
+import tracemalloc
+import unittest.mock
+
+from cos_alerter.profiling import Profiler, _cpu_time, thread_dump
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_thread_dump():
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait, name="waiting", daemon=True)
+    thread.start()
+    dump = thread_dump()
+    stop.set()
+    assert 'Thread "waiting"' in dump
+    assert "in wait" in dump
+    assert 'Thread "MainThread"' in dump
+
+
+def test_profile(tmp_path):
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop,), name="busy", daemon=True)
+    thread.start()
+    waiting = threading.Thread(target=stop.wait, name="waiting", daemon=True)
+    waiting.start()
+    profiler = Profiler(sample_interval=0.001)
+    paths = profiler.start(tmp_path, 0.2)
+    assert profiler.running()
+    assert profiler.start(tmp_path, 0.2) is None  # Already running.
+    profiler.join()
+    stop.set()
+    assert not profiler.running()
+
+    assert 'Thread "busy"' in paths["threads"].read_text()
+    lines = paths["cpu"].read_text().splitlines()
+    assert lines
+    stack, _, count = lines[0].rpartition(" ")
+    assert int(count) > 0
+    assert any(line.startswith("busy;") and "busy (test_profiling.py:" in line for line in lines)
+    # Only the threads using CPU are sampled.
+    assert not any(line.startswith("waiting;") for line in lines)
+    assert isinstance(json.loads(paths["locks"].read_text()), dict)
+    snapshot = tracemalloc.Snapshot.load(str(paths["memory"]))
+    assert snapshot.traceback_limit == 10
+    assert not tracemalloc.is_tracing()
+
+
+def test_cpu_time_of_exited_thread():
+    with unittest.mock.patch("time.pthread_getcpuclockid", side_effect=ProcessLookupError):
+        assert _cpu_time(threading.get_ident()) is None
+    assert _cpu_time(threading.get_ident()) > 0
+
+
+def test_interval_grows_with_threads():
+    profiler = Profiler(sample_interval=0.01)
+    assert profiler.interval(10) == 0.01
+    assert profiler.interval(10000) == 1
+
+
+def test_toggle(tmp_path):
+    profiler = Profiler()
+    profiler.toggle(tmp_path, 60)
+    assert profiler.running()
+    profiler.toggle(tmp_path, 60)
+    profiler.join()
+    assert not profiler.running()
+    assert len(list(tmp_path.iterdir())) == 4
@@ -0,0 +1,243 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import threading
+import unittest.mock
+import urllib.error
+
+import pytest
+import waitress
+import yaml
+
+from cos_alerter import replication
+from cos_alerter.alerter import AlerterState, config, state
+from cos_alerter.replication import Replicator, merge, record_heartbeat
+from cos_alerter.server import create_app
+
+PARAMS = {"clientid": "clientid1", "key": "clientkey1"}
+PEER_KEY_HASH = "72213288dea007251003ceeb52f1c50bc14b8b9dbe455cf846523995e4bee6fc0e5d60aaee214380c2abef6374257b40cda6699910a884f4141349205d424885"
+HEADERS = {"Authorization": "Bearer peerkey"}
+
+
+@pytest.fixture
+def flask_client():
+    return create_app(include_metrics=False).test_client()
+
+
+@pytest.fixture
+def replication_config(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["replication"] = {
+        "peers": ["http://127.0.0.1:1"],
+        "key": PEER_KEY_HASH,
+        "peer_key": "peerkey",
+    }
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {"peers": ["http://127.0.0.1:1"], "key": PEER_KEY_HASH},
+        # The key must be hashed.
+        {"key": "peerkey"},
+    ],
+)
+def test_invalid_keys(settings, fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["replication"] = settings
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    with pytest.raises(SystemExit):
+        config.reload()
+
+
+@unittest.mock.patch("time.monotonic")
+def test_merge(monotonic_mock, fake_fs):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    start_date = state["start_date"]
+    monotonic_mock.return_value = 1100
+
+    counts = merge({"clientid1": start_date + 50, "unknown": start_date + 50})
+    assert counts == {"applied": 1, "stale": 0, "unknown": 1}
+    assert state["clients"]["clientid1"]["alert_time"] == 1050
+
+    # Older heartbeats and repeated batches change nothing.
+    assert merge({"clientid1": start_date + 40})["stale"] == 1
+    assert merge({"clientid1": start_date + 50})["stale"] == 1
+    assert state["clients"]["clientid1"]["alert_time"] == 1050
+
+    # Heartbeats from a peer with a clock ahead are taken as received now.
+    assert merge({"clientid1": start_date + 500})["applied"] == 1
+    assert state["clients"]["clientid1"]["alert_time"] == 1100
+
+
+def test_replicator_batches():
+    replicator = Replicator(["http://a", "http://b"], "peerkey")
+    replicator.record("clientid1", 10.0)
+    replicator.record("clientid1", 12.0)
+    replicator.record("clientid1", 11.0)
+    replicator.record("another-client", 5.0)
+
+    def urlopen(request, timeout):
+        if request.full_url.startswith("http://b"):
+            raise urllib.error.URLError("down")
+        return unittest.mock.MagicMock()
+
+    with unittest.mock.patch("urllib.request.urlopen", side_effect=urlopen) as urlopen_mock:
+        replicator.send()
+    request = next(
+        call.args[0]
+        for call in urlopen_mock.call_args_list
+        if call.args[0].full_url.startswith("http://a")
+    )
+    assert request.full_url == "http://a/api/v1/replication"
+    assert request.headers["Authorization"] == "Bearer peerkey"
+    assert json.loads(request.data) == {"heartbeats": {"clientid1": 12.0, "another-client": 5.0}}
+
+    # The batch that failed is sent again with the new heartbeats.
+    replicator.record("clientid1", 13.0)
+    with unittest.mock.patch("urllib.request.urlopen") as urlopen_mock:
+        replicator.send()
+    sent = sorted(
+        (call.args[0].full_url, json.loads(call.args[0].data))
+        for call in urlopen_mock.call_args_list
+    )
+    assert [batch for _, batch in sent] == [
+        {"heartbeats": {"clientid1": 13.0}},
+        {"heartbeats": {"clientid1": 13.0, "another-client": 5.0}},
+    ]
+    with unittest.mock.patch("urllib.request.urlopen") as urlopen_mock:
+        replicator.send()
+    urlopen_mock.assert_not_called()
+
+
+def test_peers_are_sent_in_parallel():
+    replicator = Replicator(["http://a", "http://b"], "peerkey")
+    replicator.record("clientid1", 10.0)
+    both_sending = threading.Barrier(2, timeout=5)
+
+    def urlopen(request, timeout):
+        both_sending.wait()  # Fails if the peers are sent to one after the other.
+        return unittest.mock.MagicMock()
+
+    with unittest.mock.patch("urllib.request.urlopen", side_effect=urlopen) as urlopen_mock:
+        replicator.send()
+    assert urlopen_mock.call_count == 2
+
+
+def test_run(fake_fs):
+    AlerterState.initialize()
+    replicator = Replicator([], "peerkey")
+    with unittest.mock.patch.object(replicator, "send") as send_mock:
+        with unittest.mock.patch.object(
+            state["clock"], "sleep", side_effect=[None, StopIteration]
+        ) as sleep_mock:
+            with pytest.raises(StopIteration):
+                replicator.run(2.0)
+    send_mock.assert_called_once_with()
+    sleep_mock.assert_called_with(2.0)
+
+
+def test_not_supported_with_api_workers(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["replication"] = {"key": PEER_KEY_HASH}
+    conf["api_workers"] = 2
+    conf["dashboard_listen_addr"] = "127.0.0.1:8081"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    with pytest.raises(SystemExit):
+        config.reload()
+
+
+def test_alive_records_for_peers(flask_client, replication_config, monkeypatch):
+    AlerterState.initialize()
+    replicator = Replicator(config["replication"]["peers"], "peerkey")
+    monkeypatch.setitem(state, "replicator", replicator)
+    flask_client.post("/alive", query_string=PARAMS)
+    with unittest.mock.patch("urllib.request.urlopen") as urlopen_mock:
+        replicator.send()
+    heartbeats = json.loads(urlopen_mock.call_args.args[0].data)["heartbeats"]
+    assert list(heartbeats) == ["clientid1"]
+    assert heartbeats["clientid1"] == pytest.approx(
+        state["clients"]["clientid1"]["alert_time"] - state["start_time"] + state["start_date"]
+    )
+
+
+def test_replication_endpoint(flask_client, replication_config):
+    AlerterState.initialize()
+    body = {"heartbeats": {"clientid1": state["start_date"]}}
+    assert flask_client.post("/api/v1/replication", json=body).status_code == 401
+    response = flask_client.post(
+        "/api/v1/replication", json=body, headers={"Authorization": "Bearer wrong"}
+    )
+    assert response.status_code == 401
+    # The hash is not a valid key.
+    response = flask_client.post(
+        "/api/v1/replication", json=body, headers={"Authorization": f"Bearer {PEER_KEY_HASH}"}
+    )
+    assert response.status_code == 401
+    response = flask_client.post("/api/v1/replication", json=body, headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json == {"applied": 0, "stale": 1, "unknown": 0}
+
+
+@pytest.mark.parametrize("timestamp", ['"now"', "true", "NaN", "Infinity", "-Infinity", "null"])
+def test_replication_endpoint_invalid_timestamps(timestamp, flask_client, replication_config):
+    AlerterState.initialize()
+    response = flask_client.post(
+        "/api/v1/replication",
+        data=f'{{"heartbeats": {{"clientid1": {timestamp}}}}}',
+        content_type="application/json",
+        headers=HEADERS,
+    )
+    assert response.status_code == 400
+    assert state["clients"]["clientid1"]["alert_time"] == state["start_time"]
+
+
+def test_replication_endpoint_is_served_with_the_api(replication_config):
+    dashboard = create_app(include_api=False, include_metrics=False).test_client()
+    response = dashboard.post("/api/v1/replication", json={"heartbeats": {}}, headers=HEADERS)
+    assert response.status_code == 404
+
+
+def test_replication_during_handoff(flask_client, replication_config):
+    AlerterState.initialize()
+    AlerterState.pause_for_handoff()
+    response = flask_client.post("/api/v1/replication", json={"heartbeats": {}}, headers=HEADERS)
+    assert response.status_code == 503
+    AlerterState.resume_after_handoff()
+
+
+def test_replication_disabled(flask_client, fake_fs):
+    response = flask_client.post("/api/v1/replication", json={"heartbeats": {}}, headers=HEADERS)
+    assert response.status_code == 403
+
+
+def test_replication_over_http(replication_config, monkeypatch):
+    # The server runs in the process of the tests, which can be slow on a loaded machine.
+    monkeypatch.setattr(replication, "TIMEOUT", 60)
+    AlerterState.initialize()
+    server = waitress.create_server(
+        create_app(include_metrics=False), listen="127.0.0.1:0", clear_untrusted_proxy_headers=True
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        # The instance is its own peer.
+        replicator = Replicator([f"http://127.0.0.1:{server.effective_port}"], "peerkey")
+        monkeypatch.setitem(state, "replicator", replicator)
+        arrival = state["clock"].monotonic()
+        record_heartbeat("clientid1", arrival)
+        state["clients"]["clientid1"]["alert_time"] = None
+        replicator.send()
+        assert state["clients"]["clientid1"]["alert_time"] == pytest.approx(arrival)
+    finally:
+        server.close()
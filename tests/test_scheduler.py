@@ -0,0 +1,67 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import time
+import unittest.mock
+from datetime import datetime, timezone
+
+import pytest
+
+from cos_alerter.clock import VirtualClock
+from cos_alerter.scheduler import Scheduler
+
+
+def test_run_pending_fires_due_keys_in_one_batch():
+    handler = unittest.mock.Mock()
+    scheduler = Scheduler(handler)
+    scheduler.schedule("a", 10)
+    scheduler.schedule("b", 20)
+    scheduler.schedule("c", 10)
+    scheduler.run_pending(now=5)
+    handler.assert_not_called()
+    scheduler.run_pending(now=15)
+    handler.assert_called_once_with(["a", "c"])
+    assert scheduler.next_deadline() == 20
+
+
+def test_reschedule_and_cancel():
+    handler = unittest.mock.Mock()
+    scheduler = Scheduler(handler)
+    scheduler.schedule("a", 10)
+    scheduler.schedule("a", 30)
+    scheduler.schedule("b", 20)
+    scheduler.schedule("b", 20)
+    scheduler.cancel("b")
+    assert scheduler.next_deadline() == 30
+    scheduler.run_pending(now=25)
+    handler.assert_not_called()
+    scheduler.run_pending(now=30)
+    handler.assert_called_once_with(["a"])
+    assert scheduler.next_deadline() is None
+
+
+# SystemExit ends the thread, so that it does not outlive the test.
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_thread_fires_timers():
+    def handler(keys):
+        raise SystemExit()
+
+    scheduler = Scheduler(handler)
+    thread = scheduler.start()
+    scheduler.schedule("a", time.monotonic() + 0.05)
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_scheduler_uses_its_clock():
+    handler = unittest.mock.Mock()
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=0)
+    scheduler = Scheduler(handler, clock)
+    scheduler.schedule("b", 10)
+    scheduler.schedule("a", 10)
+    scheduler.run_pending()
+    handler.assert_not_called()
+    clock.advance(10)
+    scheduler.run_pending()
+    # Keys with the same deadline fire in the order they were scheduled.
+    handler.assert_called_once_with(["b", "a"])
@@ -2,17 +2,25 @@
 # See LICENSE file for licensing details.
 
 import copy
+import json
+import logging
+import unittest.mock
+from datetime import datetime, timedelta, timezone
 
 import freezegun
 import pytest
 import yaml
 from helpers import CONFIG
+from prometheus_client import REGISTRY
 from werkzeug.datastructures import MultiDict
 
-from cos_alerter.alerter import AlerterState, config
-from cos_alerter.server import create_app
+from cos_alerter.alerter import AlerterState, config, state
+from cos_alerter.clock import VirtualClock
+from cos_alerter.server import create_app, server_threads
 
 PARAMS = {"clientid": "clientid1", "key": "clientkey1"}
+ADMIN_KEY_HASH = "0458fd7edd02ec0cd3f23ddf1458d6f36c8c2eecb8657e46521c696d4fd61bee0ce2f242f428a2111bb7fd521e7e29677e12f04294a71b66a044337c34cd3304"
+ADMIN_HEADERS = {"Authorization": "Bearer adminkey"}
 
 
 @pytest.fixture
@@ -51,6 +59,90 @@ def test_alive_updates_time(flask_client, fake_fs, state_init):
         assert state.data["alert_time"] > state.start_time
 
 
+@pytest.fixture
+def coalescing_clock(fake_fs):
+    with open("/etc/cos-alerter.yaml") as f:
+        conf = yaml.safe_load(f)
+    conf["watch"]["coalesce_window"] = "10s"
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        yaml.dump(conf, f)
+    config.reload()
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+    AlerterState.initialize(clock=clock)
+    return clock
+
+
+def test_repeat_heartbeats_are_coalesced(flask_client, coalescing_clock, caplog):
+    clock = coalescing_clock
+    data = state["clients"]["clientid1"]
+    coalesced = REGISTRY.get_sample_value("cos_alerter_heartbeats_coalesced_total")
+    caplog.set_level(logging.INFO, logger="cos_alerter")
+
+    # The first heartbeat is applied under the lock.
+    clock.advance(1)
+    flask_client.post("/alive", query_string=PARAMS)
+    assert data["heartbeats"].count == 1
+
+    clock.advance(1)
+    cursor = flask_client.get("/api/v1/clients").headers["X-Cursor"]
+    with unittest.mock.patch.object(AlerterState, "__enter__", side_effect=AssertionError):
+        assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+    assert data["alert_time"] == 1002
+    # The last heartbeat changed.
+    response = flask_client.get("/api/v1/clients", query_string={"since": cursor})
+    assert [json.loads(line)["client_id"] for line in response.data.splitlines()] == ["clientid1"]
+    assert data["heartbeats"].count == 1
+    assert REGISTRY.get_sample_value("cos_alerter_heartbeats_coalesced_total") == coalesced + 1
+
+    # Past the window.
+    clock.advance(10)
+    flask_client.post("/alive", query_string=PARAMS)
+    assert data["heartbeats"].count == 2
+
+    # A heartbeat ends the silence of a client.
+    with AlerterState("clientid1") as client_state:
+        client_state.silence_until(clock.now() + timedelta(hours=1))
+    flask_client.post("/alive", query_string=PARAMS)
+    assert data["silenced_until"] is None
+    assert REGISTRY.get_sample_value("cos_alerter_heartbeats_coalesced_total") == coalesced + 1
+
+    # Heartbeats are logged once, and only when applied under the lock.
+    messages = [record.getMessage() for record in caplog.records]
+    assert len([message for message in messages if "Received alert" in message]) == 3
+    assert not [message for message in messages if message.startswith("Request: POST")]
+
+
+def test_steady_heartbeats_update_stats(flask_client, coalescing_clock):
+    clock = coalescing_clock
+    data = state["clients"]["clientid1"]
+
+    # A heartbeat every second, each within the window of the previous one.
+    for _ in range(25):
+        clock.advance(1)
+        flask_client.post("/alive", query_string=PARAMS)
+    # One heartbeat per window is applied under the lock.
+    assert data["heartbeats"].count == 3
+    assert data["heartbeats"].last_arrival() == 1021
+    assert data["heartbeats"].last_gap == 10
+    assert data["alert_time"] == 1025
+
+
+def test_heartbeat_coalesced_during_handoff(flask_client, coalescing_clock):
+    coalescing_clock.advance(1)
+    flask_client.post("/alive", query_string=PARAMS)
+
+    class ClientState(dict):
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value)
+            # The snapshot is taken right after the heartbeat is coalesced.
+            state["handed_off"] = True
+
+    state["clients"]["clientid1"] = ClientState(state["clients"]["clientid1"])
+    coalescing_clock.advance(1)
+    # Sent again to the new process.
+    assert flask_client.post("/alive", query_string=PARAMS).status_code == 503
+
+
 def test_metrics_succeeds(flask_client, fake_fs, state_init):
     assert flask_client.get("/metrics").status_code == 200
 
@@ -198,6 +290,7 @@ def test_silence_client_works(fake_fs):
     AlerterState.initialize()
     app_instance = create_app(include_api=True, include_dashboard=True)
     client = app_instance.test_client()
+    assert AlerterState("clientid1").get_silenced_until_iso_str() is None
     response = client.post(
         "/silence/clientid1", data={"client-key": "clientkey1", "silence-duration-h": 5}
     )
@@ -206,3 +299,331 @@ def test_silence_client_works(fake_fs):
         AlerterState("clientid1").get_silenced_until_iso_str()
         == "2026-04-17T20:33:23.690551+00:00"
     )
+
+
+@pytest.mark.parametrize(
+    "query_string",
+    [
+        {"status": "broken"},
+        {"sort": "age"},
+        {"order": "sideways"},
+        {"page": 0},
+        {"per_page": 100000},
+    ],
+)
+def test_dashboard_invalid_params(query_string, flask_client, fake_fs, state_init):
+    assert flask_client.get("/", query_string=query_string).status_code == 400
+
+
+def test_dashboard_filters_and_paginates(flask_client, fake_fs, state_init):
+    response = flask_client.get("/", query_string={"status": "unknown", "per_page": 1, "page": 2})
+    assert response.status_code == 200
+    assert b"Instance Name 2" in response.data
+    assert b"Instance Name 1" not in response.data
+    assert b"Page 2 of 2" in response.data
+
+    flask_client.post("/alive", query_string=PARAMS)
+    response = flask_client.get("/", query_string={"status": "up"})
+    assert b"Instance Name 1" in response.data
+    assert b"Instance Name 2" not in response.data
+
+
+def test_dashboard_search(flask_client, fake_fs, state_init):
+    response = flask_client.get("/", query_string={"q": "another"})
+    assert b"Instance Name 2" in response.data
+    assert b"Instance Name 1" not in response.data
+
+
+def test_clients_api(flask_client, fake_fs, state_init):
+    response = flask_client.get("/api/v1/clients")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [line["client_id"] for line in lines] == ["another-client", "clientid1"]
+    assert lines[1] == {
+        "client_id": "clientid1",
+        "client_name": "Instance Name 1",
+        "status": "unknown",
+        "last_heartbeat": None,
+        "is_silenced": False,
+        "silenced_until": None,
+        "last_notification": None,
+        "labels": {},
+    }
+
+    state["clients"]["clientid1"]["notify_time"] = state["start_time"] + 10
+    response = flask_client.get("/api/v1/clients")
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert lines[1]["last_notification"] == pytest.approx(state["start_date"] + 10)
+
+
+def test_clients_api_since(flask_client, fake_fs, state_init):
+    cursor = flask_client.get("/api/v1/clients").headers["X-Cursor"]
+    response = flask_client.get("/api/v1/clients", query_string={"since": cursor})
+    assert response.data == b""
+    assert response.headers["X-Cursor"] == cursor
+    assert "X-Full-Resync" not in response.headers
+
+    flask_client.post("/alive", query_string=PARAMS)
+    response = flask_client.get("/api/v1/clients", query_string={"since": cursor})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert len(lines) == 1
+    assert lines[0]["client_id"] == "clientid1"
+    assert lines[0]["status"] == "up"
+    assert isinstance(lines[0]["last_heartbeat"], float)
+    epoch, _, revision = response.headers["X-Cursor"].partition("-")
+    assert epoch == cursor.partition("-")[0]
+    assert int(revision) > int(cursor.partition("-")[2])
+
+    # A heartbeat of a client which is already up changes its last heartbeat.
+    cursor = response.headers["X-Cursor"]
+    flask_client.post("/alive", query_string=PARAMS)
+    response = flask_client.get("/api/v1/clients", query_string={"since": cursor})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [line["client_id"] for line in lines] == ["clientid1"]
+
+
+def test_clients_api_stale_cursor(flask_client, fake_fs, state_init):
+    cursor = flask_client.get("/api/v1/clients").headers["X-Cursor"]
+    # Revisions start over in a new process.
+    AlerterState.initialize(clock=state["clock"])
+    for stale in (cursor, "12"):
+        response = flask_client.get("/api/v1/clients", query_string={"since": stale})
+        assert response.headers["X-Full-Resync"] == "true"
+        assert response.headers["X-Cursor"] != cursor
+        assert len(response.data.decode().splitlines()) == 2
+
+
+@pytest.mark.parametrize("since", ["yesterday", "abc-²", "abc-١٢"])
+def test_clients_api_invalid_since(since, flask_client, fake_fs, state_init):
+    epoch = state["index"].epoch
+    response = flask_client.get(
+        "/api/v1/clients", query_string={"since": since.replace("abc", epoch)}
+    )
+    assert response.status_code == 400
+
+
+def test_events_stream(flask_client, fake_fs, state_init):
+    response = flask_client.get("/events", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    assert next(response.response) == b"retry: 15000\n\n"
+    flask_client.post("/alive", query_string=PARAMS)
+    lines = next(response.response).decode().splitlines()
+    assert lines[1] == "event: status"
+    data = json.loads(lines[2][len("data: ") :])
+    assert data["client_id"] == "clientid1"
+    assert data["status"] == "up"
+    assert data["previous_status"] == "unknown"
+    response.close()
+    assert state["index"].subscriber_count() == 0
+
+
+def test_events_stream_keepalive_and_reset(flask_client, fake_fs, state_init):
+    with unittest.mock.patch("cos_alerter.server.EVENT_STREAM_KEEPALIVE", 0):
+        response = flask_client.get("/events", buffered=False)
+        assert next(response.response) == b"retry: 0\n\n"
+        assert next(response.response) == b": keepalive\n\n"
+        subscription = next(iter(state["index"]._subscriptions))
+        subscription.overflowed = True
+        assert next(response.response).startswith(b"event: reset")
+        # The browser reloads the page and opens a new stream.
+        with pytest.raises(StopIteration):
+            next(response.response)
+        assert state["index"].subscriber_count() == 0
+        response.close()
+
+
+def test_events_stream_limit(flask_client, fake_fs, state_init):
+    config.data["max_event_streams"] = 1
+    stream = flask_client.get("/events", buffered=False)
+    response = flask_client.get("/events")
+    # Browsers over the limit poll instead, they would not retry after an error.
+    assert response.status_code == 200
+    assert response.data == b'event: poll\ndata: {"interval": 15}\n\n'
+    assert state["index"].subscriber_count() == 1
+    stream.close()
+
+
+def test_server_threads(fake_fs):
+    # The event streams get threads of their own.
+    assert server_threads(create_app()) == 8
+    assert server_threads(create_app(include_dashboard=False)) == 4
+    assert server_threads(object()) == 4
+
+
+def test_summary_api(flask_client, fake_fs, state_init):
+    flask_client.post("/alive", query_string=PARAMS)
+    response = flask_client.get("/api/v1/summary")
+    assert response.status_code == 200
+    assert response.json == {
+        "up": 1,
+        "down": 0,
+        "unknown": 1,
+        "silenced": 0,
+        "notified": 0,
+        "total": 2,
+        "revision": response.json["revision"],
+    }
+
+
+def test_summary_counts_never_seen_clients_as_down(flask_client, fake_fs):
+    clock = VirtualClock(datetime(2024, 1, 1, tzinfo=timezone.utc), monotonic_start=1000)
+    AlerterState.initialize(clock=clock, dispatcher=unittest.mock.Mock())
+    # wait_for_first_connection is false: the clients are paged after the down interval.
+    clock.advance(301)
+    for clientid in AlerterState.clients():
+        with AlerterState(clientid) as client_state:
+            client_state.check()
+    counts = flask_client.get("/api/v1/summary").json
+    assert counts["down"] == counts["notified"] == 2
+    assert counts["unknown"] == 0
+
+
+def test_create_app_without_metrics(fake_fs, state_init):
+    app_instance = create_app(include_metrics=False)
+    client = app_instance.test_client()
+    assert client.get("/metrics").status_code == 404
+    assert client.post("/alive", query_string=PARAMS).status_code == 200
+
+
+def test_client_details_shows_heartbeats(flask_client, fake_fs, state_init):
+    for _ in range(3):
+        flask_client.post("/alive", query_string=PARAMS)
+    response = flask_client.get("/clients/clientid1")
+    assert b"<td>3</td>" in response.data
+
+
+@pytest.fixture
+def admin_config(fake_fs):
+    conf = copy.deepcopy(CONFIG)
+    conf["admin_key"] = ADMIN_KEY_HASH
+    conf["watch"]["clients"]["clientid1"]["labels"] = {"region": "eu", "env": "prod"}
+    conf["watch"]["clients"]["another-client"]["labels"] = {"region": "eu", "env": "staging"}
+    with open("/etc/cos-alerter.yaml", "w") as f:
+        f.write(yaml.dump(conf))
+    config.reload()
+    AlerterState.initialize()
+
+
+def test_bulk_silence(flask_client, admin_config):
+    response = flask_client.post(
+        "/api/v1/admin/silence",
+        json={"selector": "region=eu", "duration_h": 5},
+        headers=ADMIN_HEADERS,
+    )
+    assert response.status_code == 200
+    assert response.json["clients"] == ["another-client", "clientid1"]
+    assert AlerterState("clientid1").is_silenced()
+    assert AlerterState("another-client").is_silenced()
+
+    response = flask_client.post(
+        "/api/v1/admin/silence",
+        json={"selector": "region=eu,env=staging", "duration_h": 0},
+        headers=ADMIN_HEADERS,
+    )
+    assert response.json == {"clients": ["another-client"], "silenced_until": None}
+    assert AlerterState("clientid1").is_silenced()
+    assert not AlerterState("another-client").is_silenced()
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        None,
+        [],
+        {"duration_h": 5},
+        {"selector": "region", "duration_h": 5},
+        {"selector": 5, "duration_h": 5},
+        {"selector": "region=eu"},
+        {"selector": "region=eu", "duration_h": -1},
+        {"selector": "region=eu", "duration_h": True},
+    ],
+)
+def test_bulk_silence_invalid_body(body, flask_client, admin_config):
+    response = flask_client.post("/api/v1/admin/silence", json=body, headers=ADMIN_HEADERS)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "headers", [{}, {"Authorization": "Bearer wrongkey"}, {"Authorization": "adminkey"}]
+)
+def test_bulk_silence_wrong_key(headers, flask_client, admin_config):
+    response = flask_client.post(
+        "/api/v1/admin/silence", json={"selector": "region=eu", "duration_h": 5}, headers=headers
+    )
+    assert response.status_code == 401
+
+
+def test_bulk_silence_disabled(flask_client, fake_fs, state_init):
+    response = flask_client.post(
+        "/api/v1/admin/silence",
+        json={"selector": "region=eu", "duration_h": 5},
+        headers=ADMIN_HEADERS,
+    )
+    assert response.status_code == 403
+
+
+@unittest.mock.patch("cos_alerter.server.profiler")
+def test_profile(profiler_mock, flask_client, admin_config):
+    profiler_mock.start.return_value = {"cpu": config["base_dir"] / "cpu.folded"}
+    response = flask_client.post("/api/v1/admin/profile", headers=ADMIN_HEADERS)
+    assert response.status_code == 202
+    assert response.json == {
+        "running": True,
+        "files": {"cpu": str(config["base_dir"] / "cpu.folded")},
+    }
+    profiler_mock.start.assert_called_once_with(config["base_dir"], 30)
+
+    response = flask_client.post(
+        "/api/v1/admin/profile", json={"duration_s": 5}, headers=ADMIN_HEADERS
+    )
+    profiler_mock.start.assert_called_with(config["base_dir"], 5)
+
+    profiler_mock.start.return_value = None
+    response = flask_client.post("/api/v1/admin/profile", headers=ADMIN_HEADERS)
+    assert response.status_code == 409
+
+    response = flask_client.delete("/api/v1/admin/profile", headers=ADMIN_HEADERS)
+    assert response.json == {"running": False}
+    profiler_mock.stop.assert_called_once_with()
+
+
+@pytest.mark.parametrize("duration", [0, -1, 601, "5"])
+def test_profile_invalid_duration(duration, flask_client, admin_config):
+    response = flask_client.post(
+        "/api/v1/admin/profile", json={"duration_s": duration}, headers=ADMIN_HEADERS
+    )
+    assert response.status_code == 400
+
+
+def test_profile_requires_admin_key(flask_client, admin_config):
+    assert flask_client.post("/api/v1/admin/profile").status_code == 401
+
+
+@unittest.mock.patch("time.monotonic")
+def test_ready(monotonic_mock, flask_client, fake_fs):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    assert flask_client.get("/ready").status_code == 200  # Just started.
+
+    monotonic_mock.return_value = 1012
+    response = flask_client.get("/ready")
+    assert response.status_code == 503
+    assert response.json["stalled_clients"] == 2
+    assert sorted(response.json["stalled_examples"]) == ["another-client", "clientid1"]
+
+    for client in state["clients"].values():
+        client["last_evaluated"] = 1011
+        client["check_lag"] = 0.01
+    response = flask_client.get("/ready")
+    assert response.json == {
+        "ready": True,
+        "max_lag_seconds": 0.01,
+        "stalled_clients": 0,
+        "stalled_examples": [],
+    }
+
+    state["clients"]["clientid1"]["check_lag"] = 10.5
+    response = flask_client.get("/ready")
+    assert response.status_code == 503
+    assert response.json["max_lag_seconds"] == 10.5
@@ -0,0 +1,38 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+from cos_alerter.silences import SilenceStore
+
+T1 = datetime(2026, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+T2 = datetime(2026, 2, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def test_update_and_load(fs):
+    fs.create_dir("/state")
+    store = SilenceStore(Path("/state/silences.json"))
+    assert store.load(["a", "b"]) == {}
+    store.update({"a": T1, "b": T2})
+    store.update({"b": None})
+    assert SilenceStore(Path("/state/silences.json")).load(["a", "b"]) == {"a": T1}
+    assert not Path("/state/silences.json.tmp").exists()
+
+
+def test_load_ignores_unknown_clients(fs):
+    fs.create_dir("/state")
+    SilenceStore(Path("/state/silences.json")).update({"a": T1, "gone": T2})
+    assert SilenceStore(Path("/state/silences.json")).load(["a"]) == {"a": T1}
+
+
+def test_load_migrates_legacy_files(fs):
+    fs.create_file("/state/a.silenced", contents=json.dumps(T1.isoformat()))
+    fs.create_file("/state/b.silenced", contents="null")
+    store = SilenceStore(Path("/state/silences.json"))
+    assert store.load(["a", "b"]) == {"a": T1}
+    assert not Path("/state/a.silenced").exists()
+    assert not Path("/state/b.silenced").exists()
+    with open("/state/silences.json") as f:
+        assert json.load(f) == {"a": T1.isoformat()}
@@ -0,0 +1,72 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+from datetime import timedelta
+
+from simulation import DAY, START, FleetSimulation, heartbeats
+
+from cos_alerter.alerter import AlerterState
+
+DOWN_INTERVAL = 5 * 60
+REPEAT_INTERVAL = 60 * 60
+
+
+def detection_latency(sim, clientid, notified):
+    """Return the time between the client going down and the notification."""
+    last_heartbeat = max(t for t in sim.received[clientid] if t < notified)
+    return notified - (last_heartbeat + DOWN_INTERVAL)
+
+
+def test_outage_is_notified_within_a_second(fake_fs):
+    sim = FleetSimulation({"client": heartbeats(60, outages=[(3600, 3600 + 9000)])})
+    sim.run(DAY)
+    notifications = sim.notifications_of("client")
+    assert notifications == [3841, 3841 + REPEAT_INTERVAL + 1, 3841 + 2 * (REPEAT_INTERVAL + 1)]
+    assert 0 < detection_latency(sim, "client", notifications[0]) <= 1
+
+
+def test_heartbeats_within_down_interval_never_notify(fake_fs):
+    sim = FleetSimulation({"client": heartbeats(DOWN_INTERVAL - 1, jitter=0.5, seed=1)})
+    sim.run(7 * DAY)
+    assert sim.notifications == []
+    assert len(sim.received["client"]) > 2000
+
+
+def test_client_never_connected_is_not_notified(fake_fs):
+    sim = FleetSimulation({"client": iter(())})
+    sim.run(DAY)
+    assert sim.notifications == []
+
+
+def test_silence_delays_notification(fake_fs):
+    sim = FleetSimulation({"client": iter(())}, watch={"wait_for_first_connection": False})
+    with AlerterState("client") as client_state:
+        client_state.silence_until(START + timedelta(hours=2))
+    sim.run(5 * 60 * 60)
+    # The silence timer checks the client as soon as the silence expires.
+    assert sim.notifications_of("client") == [2 * 60 * 60, 3 * 60 * 60 + 1, 4 * 60 * 60 + 2]
+
+
+def test_fleet_over_days(fake_fs):
+    clients = 50
+    outage = 3 * 60 * 60
+    patterns = {}
+    for i in range(clients):
+        outages = []
+        if i % 10 == 0:
+            start = (i + 1) * 1500
+            outages.append((start, start + outage))
+        patterns[f"client-{i}"] = heartbeats(60, outages=outages, jitter=5, seed=i)
+    sim = FleetSimulation(patterns)
+    sim.run(2 * DAY)
+
+    for i in range(clients):
+        clientid = f"client-{i}"
+        notifications = sim.notifications_of(clientid)
+        if i % 10:
+            assert notifications == []
+            continue
+        # Notified on detection and after each repeat interval until the client is back.
+        assert len(notifications) == 3
+        assert 0 < detection_latency(sim, clientid, notifications[0]) <= 1
+        assert notifications[1] - notifications[0] == REPEAT_INTERVAL + 1
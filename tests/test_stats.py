@@ -0,0 +1,74 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import pytest
+
+from cos_alerter.stats import DECAY_THRESHOLD, RECENT_ARRIVALS, GapSketch, HeartbeatStats
+
+
+def test_sketch_empty():
+    assert GapSketch().quantile(0.5) is None
+
+
+def test_sketch_quantiles():
+    sketch = GapSketch()
+    for _ in range(90):
+        sketch.add(60)
+    for _ in range(10):
+        sketch.add(600)
+    assert sketch.quantile(0.5) == pytest.approx(60, rel=0.07)
+    assert sketch.quantile(0.99) == pytest.approx(600, rel=0.07)
+
+
+def test_sketch_out_of_range_gaps():
+    sketch = GapSketch()
+    sketch.add(0.001)
+    sketch.add(10**9)
+    assert sketch.quantile(0) < 0.11
+    assert sketch.quantile(1) > 10**5
+
+
+def test_sketch_decays():
+    sketch = GapSketch()
+    for _ in range(DECAY_THRESHOLD - 1):
+        sketch.add(60)
+    assert sketch.total == DECAY_THRESHOLD - 1
+    sketch.add(1)
+    assert sketch.total == DECAY_THRESHOLD // 2 - 1
+
+
+def test_heartbeat_stats_empty():
+    stats = HeartbeatStats()
+    stats.record(100)
+    assert stats.summary() == {
+        "count": 1,
+        "recent_max_gap": None,
+        "last_gap": None,
+        "mean_gap": None,
+        "jitter": None,
+        "p50": None,
+        "p90": None,
+        "p99": None,
+    }
+
+
+def test_heartbeat_stats():
+    stats = HeartbeatStats()
+    for i in range(100):
+        stats.record(i * 60 + (5 if i % 2 else 0))
+    summary = stats.summary()
+    assert summary["count"] == 100
+    assert summary["last_gap"] == 65
+    assert summary["recent_max_gap"] == 65
+    assert summary["mean_gap"] == pytest.approx(60, abs=5)
+    assert summary["jitter"] == pytest.approx(5, abs=1)
+    assert summary["p50"] == pytest.approx(60, rel=0.07)
+
+
+def test_heartbeat_stats_ring_buffer():
+    stats = HeartbeatStats()
+    for i in range(RECENT_ARRIVALS * 2):
+        stats.record(i * i)
+    gaps = stats.recent_gaps()
+    assert len(gaps) == RECENT_ARRIVALS - 1
+    assert gaps[-1] == (2 * RECENT_ARRIVALS - 1) ** 2 - (2 * RECENT_ARRIVALS - 2) ** 2
@@ -0,0 +1,203 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import http.client
+import multiprocessing
+
+# Imported up front: when first imported after the tests using pyfakefs, it gets a fake os module.
+import multiprocessing.queues  # noqa: F401
+import signal
+import time
+import unittest.mock
+
+import pytest
+import yaml
+from helpers import CONFIG
+from prometheus_client import REGISTRY
+
+from cos_alerter import workers
+from cos_alerter.alerter import AlerterState, config, state
+from cos_alerter.metrics import register_collectors
+from cos_alerter.server import create_app
+from cos_alerter.workers import HeartbeatTable, ingest, start_workers, stop_workers
+
+PARAMS = {"clientid": "clientid1", "key": "clientkey1"}
+
+
+@pytest.fixture
+def flask_client():
+    return create_app(include_metrics=False).test_client()
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = HeartbeatTable(["clientid1", "another-client"], 2)
+    monkeypatch.setitem(state, "heartbeat_table", table)
+    return table
+
+
+def test_changes_across_chunks():
+    clientids = [f"client-{i}" for i in range(150)]
+    table = HeartbeatTable(clientids, 1)
+    assert table.changes() == []
+
+    for i in (0, 63, 64, 149):
+        table.record(f"client-{i}", float(i))
+    table.record("client-64", 1000.0)
+    assert table.changes() == [
+        ("client-0", 0.0),
+        ("client-63", 63.0),
+        ("client-64", 1000.0),
+        ("client-149", 149.0),
+    ]
+    assert table.changes() == []
+
+    table.record("client-63", 2000.0)
+    assert table.changes() == [("client-63", 2000.0)]
+
+
+def test_workers_write_their_own_rows():
+    table = HeartbeatTable(["clientid1", "another-client"], 2)
+    table.record("clientid1", 5.0)
+    table.set_worker(1)
+    table.record("clientid1", 7.0)
+    table.record("another-client", 3.0)
+    # Heartbeats of the same client received by several workers are merged.
+    assert table.changes() == [("clientid1", 7.0), ("another-client", 3.0)]
+    table.set_worker(0)
+    table.record("clientid1", 9.0)
+    assert table.changes() == [("clientid1", 9.0)]
+
+
+def test_result_counters():
+    table = HeartbeatTable(["clientid1"], 2)
+    table.worker_counters(0)["accepted"].inc()
+    table.worker_counters(1)["accepted"].inc(2)
+    table.worker_counters(1)["unauthorized"].inc()
+    deltas = table.result_deltas()
+    assert deltas["accepted"] == 3
+    assert deltas["unauthorized"] == 1
+    assert deltas["bad_request"] == 0
+    table.worker_counters(0)["accepted"].inc()
+    assert table.result_deltas()["accepted"] == 1
+
+
+@unittest.mock.patch("time.monotonic")
+def test_alive_records_in_table(monotonic_mock, flask_client, fake_fs, table):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    register_collectors()
+    monotonic_mock.return_value = 1005
+
+    assert flask_client.post("/alive", query_string=PARAMS).status_code == 200
+    # The worker does not touch the clients, the daemon process does.
+    assert state["clients"]["clientid1"]["alert_time"] == 1000
+
+    before = REGISTRY.get_sample_value("cos_alerter_heartbeats_total", {"result": "accepted"})
+    table.worker_counters(0)["accepted"].inc()
+    monotonic_mock.return_value = 1006
+    ingest(table)
+    assert state["clients"]["clientid1"]["alert_time"] == 1005
+    assert state["clients"]["another-client"]["alert_time"] == 1000
+    after = REGISTRY.get_sample_value("cos_alerter_heartbeats_total", {"result": "accepted"})
+    assert after == before + 1
+
+
+@unittest.mock.patch("time.monotonic")
+def test_ingest_loop(monotonic_mock, fake_fs, table):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    table.record("clientid1", 1005)
+    with unittest.mock.patch.object(state["clock"], "sleep", side_effect=StopIteration):
+        with pytest.raises(StopIteration):
+            workers.ingest_loop(table)
+    assert state["clients"]["clientid1"]["alert_time"] == 1005
+    assert table.checker_status(1000) == (True, 0)
+
+
+@unittest.mock.patch("os._exit")
+@unittest.mock.patch("time.sleep")
+@unittest.mock.patch("os.getppid", side_effect=[10, 1])
+def test_exit_with_parent(getppid_mock, sleep_mock, exit_mock):
+    workers._exit_with_parent(10)
+    sleep_mock.assert_called_once_with(1)
+    exit_mock.assert_called_once_with(0)
+
+
+@unittest.mock.patch("time.monotonic")
+def test_worker_ready(monotonic_mock, flask_client, fake_fs, table):
+    monotonic_mock.return_value = 1000
+    AlerterState.initialize()
+    assert flask_client.get("/ready").status_code == 503  # Nothing published yet.
+
+    table.set_checker_status(1000, True)
+    response = flask_client.get("/ready")
+    assert response.status_code == 200
+    assert response.json == {"ready": True, "checker_status_age_seconds": 0}
+
+    monotonic_mock.return_value = 1011
+    assert flask_client.get("/ready").status_code == 503  # The daemon process stopped publishing.
+    table.set_checker_status(1011, False)
+    assert flask_client.get("/ready").status_code == 503
+
+
+def serve_heartbeat(config_path: str, port: int, results):
+    """Fork two API workers, send them a heartbeat and put what the table recorded in results.
+
+    Run in a new process: the workers must be forked before any thread starts, like in the
+    daemon, and the process of the tests has threads left running by other tests.
+    """
+    config.set_path(config_path)
+    config.reload()
+    AlerterState.initialize()
+    app = create_app(include_api=True, include_dashboard=False, include_metrics=False)
+    table = HeartbeatTable(["clientid1", "another-client"], 2)
+    pids = start_workers(app, table, 2, f"127.0.0.1:{port}")
+    try:
+        for _ in range(300):
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                connection.request("POST", "/alive?clientid=clientid1&key=clientkey1")
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        status = connection.getresponse().status
+    finally:
+        stop_workers(pids)
+    results.put((status, [clientid for clientid, _ in table.changes()], table.result_deltas()))
+
+
+def test_workers_serve_heartbeats(tmp_path, monkeypatch):
+    config_path = tmp_path / "cos-alerter.yaml"
+    config_path.write_text(yaml.dump(CONFIG))
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path))
+    # Hold the port so that the workers all bind the same one.
+    sock = workers.reuseport_socket("127.0.0.1:0")
+    port = sock.getsockname()[1]
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=serve_heartbeat, args=(str(config_path), port, results))
+    try:
+        process.start()
+        status, changes, deltas = results.get(timeout=120)
+    finally:
+        process.join(timeout=120)
+        sock.close()
+    assert status == 200
+    assert changes == ["clientid1"]
+    assert deltas["accepted"] == 1
+
+
+@unittest.mock.patch("os.waitpid")
+@unittest.mock.patch("os.kill")
+@unittest.mock.patch("os.fork", side_effect=[101, 102])
+def test_start_and_stop_workers(fork_mock, kill_mock, waitpid_mock):
+    table = HeartbeatTable(["clientid1"], 2)
+    pids = start_workers(unittest.mock.Mock(), table, 2, "127.0.0.1:8080")
+    assert pids == [101, 102]
+    stop_workers(pids)
+    assert [call.args for call in kill_mock.call_args_list] == [
+        (101, signal.SIGTERM),
+        (102, signal.SIGTERM),
+    ]
+    assert [call.args for call in waitpid_mock.call_args_list] == [(101, 0), (102, 0)]